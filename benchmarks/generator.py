@@ -0,0 +1,149 @@
+"""
+seeded generator of synthetic APC-style rows for the benchmarks
+participants have a Zipf-like number of admissions, each recording the
+participant's own ethnicity most of the time, with codes drawn from the
+reported ethnicity codes in resources/concept_codes.csv
+"""
+
+import csv
+import datetime
+import io
+import logging
+import numpy as np
+from etl import apc
+
+CONCEPT_DATA_FP = 'resources/concept_codes.csv'
+
+LOGGER = logging.getLogger(__name__)
+
+# rough share of each code among HES admissions, codes in concept_codes.csv
+# but not here get the floor weight
+CODE_WEIGHTS = {
+    'A': 0.70, 'Z': 0.06, '99': 0.04, 'C': 0.04, 'H': 0.025, 'J': 0.02,
+    'N': 0.015, 'M': 0.012, 'S': 0.012, 'L': 0.01, 'X': 0.01, 'K': 0.008,
+    'B': 0.006, 'R': 0.005, 'P': 0.004, 'F': 0.004, 'G': 0.004, 'D': 0.004,
+    'E': 0.002,
+}
+FLOOR_WEIGHT = 0.001
+
+# share of admissions recording something other than the participant's own
+# ethnicity, and share with a code or date the extraction query filters out
+NOISE_SHARE = 0.15
+INVALID_SHARE = 0.02
+
+APC_SCHEMA = 'q4_19_nhsd'
+
+CREATE_APC_TABLE_SQL = f"""
+create schema if not exists {APC_SCHEMA};
+drop table if exists {APC_SCHEMA}.apc;
+create table {APC_SCHEMA}.apc
+(participant_id varchar, ethnos varchar, admidate timestamp);
+"""
+
+COPY_APC_SQL = f"""
+copy {APC_SCHEMA}.apc (participant_id, ethnos, admidate)
+from stdin with (format csv)
+"""
+
+# the number of rows the apc extraction query returns
+COUNT_EXTRACTED_SQL = f"""
+select count(*)
+from ({apc.sql.format(filter='').rstrip().rstrip(';')}) x
+;
+"""
+
+
+def read_codes(fp=CONCEPT_DATA_FP):
+    """
+    read the reported ethnicity codes and their weights
+    :params fp: filepath of the concept codes csv
+    :returns: tuple of list of codes and numpy array of probabilities
+    """
+
+    with open(fp, 'r', newline='') as f:
+
+        codes = [x['concept_code'] for x in csv.DictReader(f)
+                 if x['codesystem'] == 'reported_ethnicity_code']
+
+    weights = np.array([CODE_WEIGHTS.get(x, FLOOR_WEIGHT) for x in codes])
+
+    return codes, weights / weights.sum()
+
+
+def generate_apc_rows(n_participants, seed=0, zipf_a=2.0,
+                      max_admissions=200, start=datetime.date(2000, 1, 1),
+                      end=datetime.date(2020, 1, 1), chunk_size=100000):
+    """
+    generate synthetic APC rows, the same rows every time for the same
+    arguments
+    :params n_participants: number of participants
+    :params seed: seed for the random number generator
+    :params zipf_a: Zipf distribution parameter for admissions per
+    participant, lower gives a longer tail
+    :params max_admissions: cap on any one participant's admissions
+    :params start: earliest admission date
+    :params end: admission dates are before this date
+    :params chunk_size: number of participants generated at a time
+    :returns: generator of lists of (participant_id, ethnos, admidate) tuples
+    """
+
+    rng = np.random.default_rng(seed)
+    codes, p = read_codes()
+    codes = np.array(codes, dtype=object)
+    days = (end - start).days
+
+    for i in range(0, n_participants, chunk_size):
+
+        n = min(chunk_size, n_participants - i)
+        ids = np.arange(i, i + n)
+
+        admissions = np.minimum(rng.zipf(zipf_a, n), max_admissions)
+        own = rng.choice(len(codes), n, p=p)
+
+        # one entry per admission
+        pid = np.repeat(ids, admissions)
+        code = np.repeat(own, admissions)
+
+        noisy = rng.random(len(pid)) < NOISE_SHARE
+        code[noisy] = rng.choice(len(codes), noisy.sum(), p=p)
+
+        ethnos = codes[code]
+        invalid = rng.random(len(pid)) < INVALID_SHARE
+        ethnos[invalid] = rng.choice(list('0123456789'), invalid.sum())
+
+        dates = [start + datetime.timedelta(days=int(x))
+                 for x in rng.integers(0, days, len(pid))]
+
+        yield [(f'{x:09d}', e, d) for x, e, d in zip(pid, ethnos, dates)]
+
+
+def load_apc_table(e, chunks):
+    """
+    replace the apc table with generated rows
+    :params e: engine for the db the apc source is read from
+    :params chunks: iterable of lists of row tuples, from generate_apc_rows
+    :returns: number of rows loaded
+    """
+
+    n = 0
+
+    with e.begin() as con:
+
+        cur = con.connection.cursor()
+        cur.execute(CREATE_APC_TABLE_SQL)
+
+        for chunk in chunks:
+
+            buf = io.StringIO()
+            csv.writer(buf).writerows(chunk)
+            buf.seek(0)
+
+            cur.copy_expert(COPY_APC_SQL, buf)
+            n += len(chunk)
+
+        cur.execute(f'analyze {APC_SCHEMA}.apc;')
+        cur.close()
+
+    LOGGER.info(f'loaded {n} synthetic apc rows')
+
+    return n
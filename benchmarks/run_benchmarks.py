@@ -0,0 +1,280 @@
+"""
+benchmark ETL throughput and best ethnicity view latency on synthetic APC
+data against a local PostgreSQL, writing the results to JSON so runs can be
+compared
+the apc table in the HES db is replaced with generated rows, so the HES db
+settings must point at a scratch db, and the diversity db is recreated for
+each measurement, so it only runs with the testing config
+usage: python -m benchmarks.run_benchmarks --participants 1000000
+"""
+
+import datetime
+import json
+import logging
+import subprocess
+import time
+import fire
+import numpy as np
+from sqlalchemy import text
+from config import ConfigFactory
+from modules import log, database, concept, best_ethnicity, bulk_load
+from etl import apc
+from benchmarks import generator
+
+LOGGER = logging.getLogger(__name__)
+
+LOOKUP_SQL = """
+select best_ethnicity_code
+from ethnicity_store.vw_participant_ethnicity
+where participant_id = :pid
+;
+"""
+
+SCAN_SQL = """
+select count(*)
+    ,count(distinct best_ethnicity_code)
+from ethnicity_store.vw_participant_ethnicity
+;
+"""
+
+SCHEMA_EXISTS_SQL = """
+select exists (
+    select 1
+    from information_schema.schemata
+    where schema_name = 'ethnicity_store'
+);
+"""
+
+# apc.run_etl arguments for each ETL measurement
+ETL_VARIANTS = {
+    'apc_run_etl': {},
+    'apc_run_etl_bulk': {'bulk': True},
+    'apc_run_etl_stream': {'bulk': True, 'stream': True},
+    'apc_run_etl_pipeline': {'bulk': True, 'pipeline': True},
+}
+
+
+def summarise(timings):
+    """
+    summarise a list of timings
+    :params timings: list of durations in seconds
+    :returns: dictionary of count, mean, p50 and p99 in milliseconds
+    """
+
+    ms = np.array(timings) * 1000
+
+    return {'n': len(ms),
+            'mean_ms': float(ms.mean()),
+            'p50_ms': float(np.percentile(ms, 50)),
+            'p99_ms': float(np.percentile(ms, 99))}
+
+
+def fresh_session(c):
+    """
+    recreate the diversity db, with its concepts, and open a session on it
+    :params c: a Config class instance
+    :returns: SQLAlchemy session
+    """
+
+    e = database.get_engine(c.div_db_conn_str, c)
+
+    if database.run_sql_query(e, SCHEMA_EXISTS_SQL).scalar():
+
+        database.drop_diversity_db(c)
+
+    database.create_diversity_db(c)
+    s = database.make_session(c)
+    concept.populate_concept_table(s)
+
+    return s
+
+
+def time_etl(c, n_rows, **kwargs):
+    """
+    time a full apc.run_etl into an empty diversity db
+    :params c: a Config class instance
+    :params n_rows: number of rows the extraction returns
+    :params kwargs: arguments to apc.run_etl
+    :returns: dictionary of seconds and rows/s
+    """
+
+    s = fresh_session(c)
+
+    start = time.perf_counter()
+    apc.run_etl(c, s, **kwargs)
+    s.commit()
+    elapsed = time.perf_counter() - start
+
+    s.close()
+
+    return {'seconds': elapsed, 'rows_per_s': n_rows / elapsed}
+
+
+def time_loader(c, rows, copy):
+    """
+    time loading already extracted rows into an empty diversity db
+    :params c: a Config class instance
+    :params rows: list of row mappings with id, ethnicity_code and
+    source_date
+    :params copy: stage the rows with COPY rather than inserts
+    :returns: dictionary of seconds and rows/s
+    """
+
+    s = fresh_session(c)
+
+    start = time.perf_counter()
+    bulk_load.load_source_rows(s, apc.SOURCE, rows, c.copy_batch_size,
+                               copy=copy)
+    s.commit()
+    elapsed = time.perf_counter() - start
+
+    s.close()
+
+    return {'seconds': elapsed, 'rows_per_s': len(rows) / elapsed}
+
+
+def time_view(c, n_participants, seed, lookups, scans):
+    """
+    time single participant lookups and full scans of vw_participant_ethnicity
+    against the db left by the last load
+    :params c: a Config class instance
+    :params n_participants: number of generated participants
+    :params seed: seed for choosing the participants looked up
+    :params lookups: number of single participant lookups
+    :params scans: number of full scans
+    :returns: dictionary of lookup and scan summaries
+    """
+
+    e = database.get_engine(c.div_db_conn_str, c)
+    rng = np.random.default_rng(seed)
+    pids = [f'{x:09d}' for x in rng.integers(0, n_participants, lookups)]
+
+    lookup_timings = []
+    scan_timings = []
+
+    with e.connect() as con:
+
+        con.execute('analyze;')
+
+        for x in pids:
+
+            start = time.perf_counter()
+            con.execute(text(LOOKUP_SQL), {'pid': x}).all()
+            lookup_timings.append(time.perf_counter() - start)
+
+        for _ in range(scans):
+
+            start = time.perf_counter()
+            con.execute(SCAN_SQL).all()
+            scan_timings.append(time.perf_counter() - start)
+
+    return {'view_lookup': summarise(lookup_timings),
+            'view_full_scan': summarise(scan_timings)}
+
+
+def get_git_commit():
+    """
+    the commit being benchmarked, None outside a git checkout
+    """
+
+    try:
+
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], check=True,
+                              capture_output=True, text=True).stdout.strip()
+
+    except (OSError, subprocess.CalledProcessError):
+
+        return None
+
+
+def run(participants=100000, seed=0, zipf_a=2.0, lookups=1000, scans=5,
+        out_fp='bench_output.json'):
+    """
+    run the benchmarks and write the results to JSON
+    :params participants: number of synthetic participants
+    :params seed: seed for the generated data and the lookups
+    :params zipf_a: Zipf parameter for admissions per participant
+    :params lookups: number of single participant view lookups
+    :params scans: number of full view scans
+    :params out_fp: filepath of the JSON results
+    :returns: dictionary of the results
+    """
+
+    c = ConfigFactory.factory()
+    log.setup_logger(c)
+
+    if not c.testing:
+
+        raise RuntimeError('benchmarks replace the apc table and the '
+                           'diversity db, so only run with ENV=testing')
+
+    hes = database.get_engine(c.hes_db_conn_str, c)
+    results = {}
+
+    start = time.perf_counter()
+    n_source_rows = generator.load_apc_table(
+        hes, generator.generate_apc_rows(participants, seed, zipf_a))
+    results['generate_and_load_apc'] = {
+        'seconds': time.perf_counter() - start}
+
+    n_rows = database.run_sql_query(hes, generator.COUNT_EXTRACTED_SQL).\
+        scalar()
+
+    for name, kwargs in ETL_VARIANTS.items():
+
+        LOGGER.info(f'benchmarking {name}')
+        results[name] = time_etl(c, n_rows, **kwargs)
+
+    # the loaders are timed on rows already in memory, without extraction
+    rows = [dict(x) for x in
+            database.run_sql_query(hes, apc.SOURCE.get_query()[0]).
+            mappings().all()]
+
+    for name, copy in [('load_source_rows_copy', True),
+                       ('load_source_rows_insert', False)]:
+
+        LOGGER.info(f'benchmarking {name}')
+        results[name] = time_loader(c, rows, copy)
+
+    s = database.make_session(c)
+    start = time.perf_counter()
+    best_ethnicity.refresh(s)
+    s.commit()
+    s.close()
+    results['best_ethnicity_refresh'] = {
+        'seconds': time.perf_counter() - start}
+
+    results.update(time_view(c, participants, seed, lookups, scans))
+
+    with database.get_engine(c.div_db_conn_str, c).connect() as con:
+
+        pg_version = con.execute('show server_version;').scalar()
+
+    database.drop_diversity_db(c)
+
+    d = {'run_at': datetime.datetime.now().isoformat(timespec='seconds'),
+         'git_commit': get_git_commit(),
+         'postgres_version': pg_version,
+         'parameters': {'participants': participants, 'seed': seed,
+                        'zipf_a': zipf_a, 'lookups': lookups,
+                        'scans': scans,
+                        'copy_batch_size': c.copy_batch_size,
+                        'etl_chunk_size': c.etl_chunk_size},
+         'source_rows': n_source_rows,
+         'extracted_rows': n_rows,
+         'results': results}
+
+    with open(out_fp, 'w') as f:
+
+        json.dump(d, f, indent=2)
+
+    LOGGER.info(f'wrote benchmark results to {out_fp}')
+
+    return d
+
+
+if __name__ == "__main__":
+    """
+    build the fire interface
+    """
+    fire.Fire(run)
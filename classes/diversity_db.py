@@ -5,7 +5,7 @@ provides the classes for interacting the database store
 import logging
 from sqlalchemy import BigInteger, Boolean, Column, Date, DateTime, Integer,\
     Numeric, String, Table, Text, UniqueConstraint, ForeignKey, text
-from sqlalchemy.dialects.postgresql import UUID
+from sqlalchemy.dialects.postgresql import UUID, insert
 from sqlalchemy.ext.declarative import declarative_base
 
 BASE = declarative_base()
@@ -46,6 +46,39 @@ class ReportedEthnicity(BASE):
     source_date = Column(Date, nullable=False, primary_key=True)
 
 
+class ReportedEthnicityStaging(BASE):
+    """
+    the SQLAlchemy class for reported_ethnicity_staging
+    holds a batch of extracted reported ethnicities, still as codes, while it
+    is merged into participant and reported_ethnicity
+    """
+
+    __tablename__ = 'reported_ethnicity_staging'
+    __table_args__ = ({'schema': 'ethnicity_store'})
+
+    # the table has no key, the mapper just needs one to be declared
+    participant_id = Column(String, primary_key=True, nullable=False)
+    ethnicity_code = Column(String, primary_key=True, nullable=False)
+    source_date = Column(Date, primary_key=True, nullable=False)
+
+
+class ReportedEthnicitySummary(BASE):
+    """
+    the SQLAlchemy class for reported_ethnicity_summary
+    stores the count and latest date of each participant's reported
+    ethnicities by source, maintained from reported_ethnicity by triggers
+    """
+
+    __tablename__ = 'reported_ethnicity_summary'
+    __table_args__ = ({'schema': 'ethnicity_store'})
+
+    participant_id = Column(String, primary_key=True, nullable=False)
+    ethnicity_cid = Column(UUID, primary_key=True, nullable=False)
+    source_cid = Column(UUID, primary_key=True, nullable=False)
+    eth_count = Column(BigInteger, nullable=False)
+    max_source_date = Column(Date, nullable=False)
+
+
 class Participant(BASE):
     """
     the SQLAlchemy class for participant
@@ -63,75 +96,128 @@ class Participant(BASE):
                            nullable=False)
 
 
-class ObservedParticipant(Participant):
+class ParticipantBestEthnicity(BASE):
     """
-    the class for participants observed in our data
-    provides methods to transition data from the sources into the database
+    the SQLAlchemy class for participant_best_ethnicity
+    stores the materialised best ethnicity of each participant, as given by
+    vw_participant_ethnicity
     """
 
-    # attributes to hold dictionaries of concept_code: uid so that observed
-    # groups and programmes can be converted into group_cids for loading
-    group_concept_codes = None
-    programme_concept_codes = None
+    __tablename__ = 'participant_best_ethnicity'
+    __table_args__ = ({'schema': 'ethnicity_store'})
 
-    # attribute to hold all participants already in database
-    participants_in_db = None
+    participant_id = Column(String,
+                            ForeignKey('ethnicity_store.participant.id'),
+                            primary_key=True, nullable=False)
+    best_ethnicity_code = Column(String, nullable=False)
+    refreshed_at = Column(DateTime, nullable=False,
+                          server_default=text("now()"))
 
-    def __init__(self, s, id, group, in_ngrl, programme,
-                 reported_ethnicities=[]):
-        """
-        create new ObservedParticipant
-        :params s: SQLAlchemy session bound to required engines
-        :params id: id of participant
-        :params group: group participant is a member of
-        :params in_ngrl: boolean, is participants in ngrl?
-        :params programme: participant programme membership
-        :params reported_ethnicities: list of dictionaries giving reported
-        ethnicity information
-        """
 
-        LOGGER.debug(f'creating new ObservedParticipant for {id}')
+class EtlRunState(BASE):
+    """
+    the SQLAlchemy class for etl_run_state
+    stores the high-water mark reached by the last ETL run of each source
+    """
 
-        # if we don't have any of the required reference data
-        # then populate them from the db
-        if not self.group_concept_codes:
+    __tablename__ = 'etl_run_state'
+    __table_args__ = ({'schema': 'ethnicity_store'})
 
-            q = s.query(Concept.concept_code,
-                        Concept.uid).\
-                filter(Concept.codesystem == 'group')
+    source_cid = Column(UUID, ForeignKey('ethnicity_store.concept.uid'),
+                        primary_key=True, nullable=False)
+    high_water_mark = Column(Date, nullable=False)
+    updated_at = Column(DateTime, nullable=False,
+                        server_default=text("now()"))
 
-            ObservedParticipant.group_concept_codes = \
-                {x[0]: x[1] for x in q}
 
-            assert len(ObservedParticipant.group_concept_codes) > 0
+class ParticipantSourceFingerprint(BASE):
+    """
+    the SQLAlchemy class for participant_source_fingerprint
+    stores a hash of each participant's reported ethnicities from each
+    source, as of the last full run that read all of them
+    """
 
-        if not self.programme_concept_codes:
+    __tablename__ = 'participant_source_fingerprint'
+    __table_args__ = ({'schema': 'ethnicity_store'})
 
-            q = s.query(Concept.concept_code,
-                        Concept.uid).\
-                filter(Concept.codesystem == 'programme')
+    participant_id = Column(String,
+                            ForeignKey('ethnicity_store.participant.id'),
+                            primary_key=True, nullable=False)
+    source_cid = Column(UUID, ForeignKey('ethnicity_store.concept.uid'),
+                        primary_key=True, nullable=False)
+    fingerprint = Column(String, nullable=False)
+    updated_at = Column(DateTime, nullable=False,
+                        server_default=text("now()"))
+
+
+class EtlRun(BASE):
+    """
+    the SQLAlchemy class for etl_run
+    stores each ETL run, finished_at and finish_seq are only set once the
+    run has committed, finish_seq numbering the runs in the order they did
+    """
+
+    __tablename__ = 'etl_run'
+    __table_args__ = ({'schema': 'ethnicity_store'})
+
+    run_id = Column(BigInteger, primary_key=True, nullable=False)
+    started_at = Column(DateTime, nullable=False,
+                        server_default=text("now()"))
+    finished_at = Column(DateTime)
+    finish_seq = Column(BigInteger, unique=True)
+    sources = Column(String)
+    incremental = Column(Boolean, nullable=False, default=False)
+
+
+class BestEthnicityChange(BASE):
+    """
+    the SQLAlchemy class for best_ethnicity_change
+    stores the participants whose best ethnicity each ETL run added, changed
+    or removed, with the codes before and after
+    """
 
-            ObservedParticipant.programme_concept_codes = \
-                {x[0]: x[1] for x in q}
+    __tablename__ = 'best_ethnicity_change'
+    __table_args__ = ({'schema': 'ethnicity_store'})
 
-            assert len(ObservedParticipant.programme_concept_codes) > 0
+    run_id = Column(BigInteger, ForeignKey('ethnicity_store.etl_run.run_id'),
+                    primary_key=True, nullable=False)
+    participant_id = Column(String, primary_key=True, nullable=False)
+    change_type = Column(String, nullable=False)
+    old_best_ethnicity_code = Column(String)
+    new_best_ethnicity_code = Column(String)
 
-        if not self.participants_in_db:
 
-            q = s.query(Participant)
+class ObservedParticipant(Participant):
+    """
+    the class for participants observed in our data
+    provides methods to transition data from the sources into the database
+    """
 
-            ObservedParticipant.participants_in_db = {x.id: x for x in q.all()}
+    def __init__(self, concepts, id, group, in_ngrl, programme,
+                 reported_ethnicities=[]):
+        """
+        create new ObservedParticipant
+        :params concepts: a loaded ConceptCache, used to convert the codes
+        into cids
+        :params id: id of participant
+        :params group: group participant is a member of
+        :params in_ngrl: boolean, is participants in ngrl?
+        :params programme: participant programme membership
+        :params reported_ethnicities: list of dictionaries giving reported
+        ethnicity information
+        """
 
+        # groups and programmes are converted into cids for loading
         self.id = id
-        self.group_cid = self.group_concept_codes[group]
+        self.group_cid = concepts.get_uids('group')[group]
         self.in_ngrl = in_ngrl
-        self.programme_cid = self.programme_concept_codes[programme]
+        self.programme_cid = concepts.get_uids('programme')[programme]
 
         # loop through each of the reported ethnicities and create instances
         # of observed reported ethnicities
         self.reported_ethnicities = [
-            ObservedReportedEthnicity.from_dict(s, {'participant_id':
-                                                    self.id, **x})
+            ObservedReportedEthnicity.from_dict(concepts, {'participant_id':
+                                                           self.id, **x})
             for x in reported_ethnicities]
 
     def add_to_db(self, s):
@@ -141,14 +227,7 @@ class ObservedParticipant(Participant):
         :params s: SQLAlchemy session bound to required engines
         """
 
-        # check whether participant is in database so either merge or add
-        if self.id in ObservedParticipant.participants_in_db.keys():
-
-            s.merge(self)
-
-        else:
-
-            s.add(self)
+        self.add_participant_to_db(s)
 
         for x in self.reported_ethnicities:
 
@@ -156,20 +235,61 @@ class ObservedParticipant(Participant):
 
         s.flush()
 
+    def add_participant_to_db(self, s):
+        """
+        write just the participant to the database, without its reported
+        ethnicities
+        :params s: SQLAlchemy session bound to required engines
+        """
+
+        ObservedParticipant.upsert(s, [self])
+
+    @staticmethod
+    def upsert(s, participants):
+        """
+        write participants to the database in a single statement, updating
+        any that are already there
+        :params s: SQLAlchemy session bound to required engines
+        :params participants: list of ObservedParticipant
+        """
+
+        # a row can only be updated once per statement, so the last
+        # observation of each participant wins
+        rows = {x.id: {'id': x.id,
+                       'group_cid': x.group_cid,
+                       'in_ngrl': x.in_ngrl,
+                       'programme_cid': x.programme_cid}
+                for x in participants}
+
+        if not rows:
+
+            return
+
+        stmt = insert(Participant.__table__)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=['id'],
+            set_={x: stmt.excluded[x]
+                  for x in ['group_cid', 'in_ngrl', 'programme_cid']})
+
+        # executed straight away on the session's connection, so the
+        # participants are in place for their reported ethnicities
+        s.connection(bind_arguments={'mapper': Participant}).\
+            execute(stmt, list(rows.values()))
+
     def __repr__(self):
 
         return f'<Participant {self.id}>'
 
     @classmethod
-    def from_dict(cls, s, d):
+    def from_dict(cls, concepts, d):
         """
         allows creation from a dictionary
-        :params s: SQLAlchemy session bound to required engines
+        :params concepts: a loaded ConceptCache
         :params d: dictionary with the required keys and values
         :returns: instance of ObservedParticipant
         """
 
-        return cls(s, **d)
+        return cls(concepts, **d)
 
 
 class ObservedReportedEthnicity(ReportedEthnicity):
@@ -178,55 +298,25 @@ class ObservedReportedEthnicity(ReportedEthnicity):
     provides methods to transition data from the sources to the database
     """
 
-    # attribute to hold a dictionary of ethnicity concept_code: uid
-    # so that observed ethnicities can be converted into ethnicity_cids for
-    # loading
-    ethnicity_concept_codes = None
-    # attribute to hold a dictionary of source concept_code: uid so that sources
-    # can be converted into source_cids for loading
-    source_concept_codes = None
-
-    def __init__(self, s, participant_id, ethnicity_code, source, source_date):
+    def __init__(self, concepts, participant_id, ethnicity_code, source,
+                 source_date):
         """
         create an instance of ObservedReportedEthnicity
-        :params s: SQLAlchemy session bound to required engines
+        :params concepts: a loaded ConceptCache, used to convert the codes
+        into cids
         :params participant_id: participant ID
         :params ethnicity_code: the single letter code for ethnicity
         :params source: the code for the data source
         :params source_date: the date for the data point
         """
 
-        LOGGER.debug('creating new instance of ObservedReportedEthnicity')
-
-        # if we don't have ethnicity_concept_codes or source_concept_codes
-        # populate them from the db
-        if not self.ethnicity_concept_codes:
-
-            q = s.query(Concept.concept_code,
-                        Concept.uid).\
-                filter(Concept.codesystem == 'reported_ethnicity_code')
-
-            ObservedReportedEthnicity.ethnicity_concept_codes = \
-                {x[0]: x[1] for x in q}
-
-            assert len(ObservedReportedEthnicity.ethnicity_concept_codes) > 0
-
-        if not self.source_concept_codes:
-
-            q = s.query(Concept.concept_code,
-                        Concept.uid).\
-                filter(Concept.codesystem == 'source')
-
-            ObservedReportedEthnicity.source_concept_codes = \
-                {x[0]: x[1] for x in q}
-
-            assert len(ObservedReportedEthnicity.source_concept_codes) > 0
-
+        # ethnicities and sources are converted into cids for loading
         self.participant_id = participant_id
         self.ethnicity_code = ethnicity_code
-        self.ethnicity_cid = self.ethnicity_concept_codes.get(ethnicity_code)
+        self.ethnicity_cid = concepts.get_uid('reported_ethnicity_code',
+                                              ethnicity_code)
         self.source = source
-        self.source_cid = self.source_concept_codes.get(source)
+        self.source_cid = concepts.get_uid('source', source)
         self.source_date = source_date
 
     def add_to_db(self, s):
@@ -243,12 +333,12 @@ class ObservedReportedEthnicity(ReportedEthnicity):
         return f'<Reported Ethnicity {self.participant_id}:{self.ethnicity_code}>'
 
     @classmethod
-    def from_dict(cls, s, d):
+    def from_dict(cls, concepts, d):
         """
         allows creation from a dictionary
-        :params s: SQLAlchemy session bound to required engines
+        :params concepts: a loaded ConceptCache
         :params d: dictionary with the required keys and values
         :returns: instance of ObservedReportedEthnicity
         """
 
-        return cls(s, **d)
+        return cls(concepts, **d)
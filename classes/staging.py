@@ -0,0 +1,29 @@
+"""
+provides the compact records extracted rows are held in between the extract
+and the load, where they can't stay as the db driver's rows
+"""
+
+import datetime
+from typing import NamedTuple
+
+
+class StagedRow(NamedTuple):
+    """
+    an extracted reported ethnicity, still as codes, that can be looked up by
+    column name like the row mappings it stands in for
+    a plain tuple underneath, so it is around a third of the size of a
+    dictionary of the same row
+    """
+
+    id: str
+    ethnicity_code: str
+    source_date: datetime.date
+
+    def __getitem__(self, key):
+
+        if isinstance(key, str):
+
+            return getattr(self, key)
+
+        return tuple.__getitem__(self, key)
+
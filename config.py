@@ -2,6 +2,7 @@
 provides a config factory to generate a environment-specific config object
 based on environmental variables provided in a .env file or already laoded
 """
+import datetime
 import os
 from dotenv import load_dotenv
 
@@ -38,11 +39,34 @@ class Config:
         self._hes_db_user = os.getenv('HES_DB_USER')
         self._hes_db_password = os.getenv('HES_DB_PASSWORD')
 
+        # connection pool config, shared by every engine in the registry
+        self.db_pool_size = int(os.getenv('DB_POOL_SIZE') or 5)
+        self.db_max_overflow = int(os.getenv('DB_MAX_OVERFLOW') or 10)
+        self.db_pool_pre_ping = \
+            (os.getenv('DB_POOL_PRE_PING') or 'true').lower() == 'true'
+        self.db_pool_recycle = int(os.getenv('DB_POOL_RECYCLE') or 3600)
+
+        # etl config
+        self.copy_batch_size = int(os.getenv('COPY_BATCH_SIZE') or 50000)
+        self.etl_chunk_size = int(os.getenv('ETL_CHUNK_SIZE') or 10000)
+        self.etl_queue_size = int(os.getenv('ETL_QUEUE_SIZE') or 4)
+        self.etl_partition_start_date = datetime.date.fromisoformat(
+            os.getenv('ETL_PARTITION_START_DATE') or '1989-04-01')
+        self.index_build_workers = int(os.getenv('INDEX_BUILD_WORKERS') or 4)
+
         # log config
         self.log_folder = os.getenv('LOG_FOLDER') or \
             os.path.join(basedir, 'logs')
         self.log_filename = os.getenv('LOG_FILENAME') or \
             'diversity_logs'
+        self.log_level = os.getenv('LOG_LEVEL') or 'DEBUG'
+        # debug records each logger may write per second, 0 for no limit
+        self.log_debug_rate = int(os.getenv('LOG_DEBUG_RATE') or 100)
+
+        # metrics config, each run appends a line of JSON to the metrics file
+        # in the log folder
+        self.metrics_filename = os.getenv('METRICS_FILENAME') or \
+            'etl_metrics.jsonl'
 
     @property
     def div_db_conn_str(self):
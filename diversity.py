@@ -1,38 +1,295 @@
 """
 provides interface to process ethnicity
+the config, logging and everything a command needs are set up when the
+command is run rather than on import, so the CLI starts quickly and each
+command only loads the models and ETL modules it uses
 """
 
+import contextlib
+import csv
+import functools
 import logging
+import os
+import sys
 import fire
-from config import ConfigFactory
-from modules import log, database, concept
-from classes import diversity_db
-from etl import apc
-
-c = ConfigFactory.factory()
-log.setup_logger(c)
 
 LOGGER = logging.getLogger(__name__)
 
 
+@functools.lru_cache(maxsize=None)
+def get_config():
+    """
+    build the config and set up logging, once per process
+    :returns: a Config class instance
+    """
+
+    from config import ConfigFactory
+    from modules import log
+
+    c = ConfigFactory.factory()
+    log.setup_logger(c)
+
+    return c
+
+
 class Diversity:
 
     def create_diversity_db(self):
 
+        from modules import database, concept
+
+        c = get_config()
         database.create_diversity_db(c)
         s = database.make_session(c)
         concept.populate_concept_table(s)
 
     def drop_diversity_db(self):
 
-        database.drop_diversity_db(c)
+        from modules import database
+
+        database.drop_diversity_db(get_config())
+
+    def run_etl(self, sources=None, bulk=False, stream=False,
+                incremental=False, concurrent=False, partitions=None,
+                partition_by='hash', rebuild=False, pipeline=False,
+                profile=False):
+
+        args = dict(sources=sources, bulk=bulk, stream=stream,
+                    incremental=incremental, concurrent=concurrent,
+                    partitions=partitions, partition_by=partition_by,
+                    rebuild=rebuild, pipeline=pipeline)
+
+        from modules import metrics
+
+        c = get_config()
+
+        # the metrics are logged and written even if the run fails
+        m = metrics.start_run()
+        fp = os.path.join(c.log_folder,
+                          f'run_etl_{m.started_at:%Y%m%d%H%M%S}.prof')
+        succeeded = False
+
+        try:
+
+            with metrics.profile(fp) if profile else contextlib.nullcontext():
+
+                self._run_etl(**args)
+
+            succeeded = True
+
+        finally:
+
+            m.log()
+            m.write(os.path.join(c.log_folder, c.metrics_filename),
+                    arguments=args, succeeded=succeeded)
+
+    def _run_etl(self, sources=None, bulk=False, stream=False,
+                 incremental=False, concurrent=False, partitions=None,
+                 partition_by='hash', rebuild=False, pipeline=False):
+
+        from modules import database, best_ethnicity, bulk_reload, \
+            run_state, metrics, lookup, fingerprint
+        from etl import common, runner
+
+        c = get_config()
 
-    def run_etl(self):
+        # fire gives a single source as a string and several as a tuple
+        if isinstance(sources, str):
+            sources = [sources]
 
+        sources = runner.get_sources(sources)
         s = database.make_session(c)
-        apc.run_etl(c, s)
+
+        if concurrent and partitions:
+
+            raise ValueError('partitions can not be used with concurrent')
+
+        if pipeline and (concurrent or partitions):
+
+            raise ValueError('pipeline can not be used with concurrent or '
+                             'partitions')
+
+        if rebuild and incremental:
+
+            raise ValueError('rebuild is a full reload and can not be '
+                             'incremental')
+
+        # a rebuild loads each source into a new table, without constraints,
+        # which is swapped in for the source's partition afterwards
+        tables = {}
+
+        run_id = run_state.start_run(s, [x.code for x in sources],
+                                     incremental)
+
+        if rebuild:
+
+            bulk = True
+            tables = bulk_reload.create_load_tables(s, [x.code
+                                                        for x in sources])
+            marks = {x.code: run_state.get_high_water_mark(s, x.code)
+                     for x in sources}
+
+            # the fingerprints are replaced along with the sources' rows
+            fingerprint.clear_fingerprints(s, list(tables))
+
+        if pipeline:
+
+            from etl import pipeline as etl_pipeline
+
+            touched = set()
+
+            for x in sources:
+
+                touched |= etl_pipeline.run_etl(c, s, x, bulk=bulk,
+                                                incremental=incremental,
+                                                table=tables.get(x.code))
+
+        elif concurrent:
+
+            touched = runner.run_etl(c, s, sources, bulk=bulk,
+                                     incremental=incremental, tables=tables)
+
+        else:
+
+            touched = set()
+
+            for x in sources:
+
+                touched |= common.run_etl(c, s, x, bulk=bulk, stream=stream,
+                                          incremental=incremental,
+                                          partitions=partitions,
+                                          partition_by=partition_by,
+                                          table=tables.get(x.code))
+
+        # the load is committed before the swap, as the indexes are built on
+        # separate connections
+        if rebuild:
+
+            with metrics.stage('commit'):
+
+                s.commit()
+
+            try:
+
+                with metrics.stage('swap'):
+
+                    bulk_reload.swap_source_partitions(c, tables)
+
+            except Exception:
+
+                # the old partitions are still in place, so the high-water
+                # marks go back to match them, and the new rows'
+                # fingerprints are cleared as they don't describe them
+                run_state.restore_high_water_marks(s, marks)
+                fingerprint.clear_fingerprints(s, list(tables))
+                s.commit()
+                raise
+
+        # a rebuild recomputes everyone in one pass, as it can remove rows of
+        # participants it doesn't extract, other runs just the participants
+        # they wrote to, which leaves out those skipped as unchanged, and
+        # either logs the changes against the run, which is finished in the
+        # same transaction
+        with metrics.stage('refresh', len(touched)):
+
+            best_ethnicity.refresh(s, None if rebuild else touched, run_id)
+            run_state.finish_run(s, run_id)
+
+        with metrics.stage('commit'):
+
+            s.commit()
+
+        # best ethnicities cached before the run may have changed
+        lookup.LOOKUP_CACHE.invalidate()
+
+        LOGGER.info(f'connection pools: {database.pool_metrics()}')
+
+    def refresh_best_ethnicity(self):
+
+        from modules import database, best_ethnicity, run_state
+
+        s = database.make_session(get_config())
+
+        # recorded as a run without sources, so its changes are in the feed
+        run_id = run_state.start_run(s)
+        best_ethnicity.refresh(s, run_id=run_id)
+        run_state.finish_run(s, run_id)
         s.commit()
 
+    def changes(self, since=0, out_fp=None, page_size=None):
+
+        from modules import database, changes
+
+        s = database.make_session(get_config())
+
+        # written as csv a page at a time, to stdout if there's no out_fp
+        with open(out_fp, 'w', newline='') if out_fp else \
+                contextlib.nullcontext(sys.stdout) as f:
+
+            w = csv.writer(f)
+            w.writerow(changes.CHANGES_COLUMNS)
+
+            for page in changes.get_changes(
+                    s, since, page_size or changes.CHANGES_PAGE_SIZE):
+
+                w.writerows(x.values() for x in page)
+
+        s.close()
+
+    def lookup(self, id_fp, out_fp=None, live=False):
+
+        from modules import database, lookup
+
+        s = database.make_session(get_config())
+        d = lookup.lookup(s, lookup.read_ids(id_fp), live=live)
+        s.close()
+
+        # written as csv, to stdout if there's no out_fp
+        with open(out_fp, 'w', newline='') if out_fp else \
+                contextlib.nullcontext(sys.stdout) as f:
+
+            w = csv.writer(f)
+            w.writerow(['participant_id', 'best_ethnicity_code'])
+            w.writerows(d.items())
+
+    def export(self, names=None, out_dir='.', fmt='csv', compress=False,
+               live=False):
+
+        from modules import export
+
+        # a single export can be given on its own
+        if isinstance(names, str):
+
+            names = [names]
+
+        return export.export(get_config(), names, out_dir, fmt, compress,
+                             live)
+
+    def snapshot(self, out_dir='.', compress=True):
+
+        from modules import snapshot
+
+        return snapshot.snapshot(get_config(), out_dir, compress)
+
+    def restore(self, snapshot_dir):
+
+        from modules import snapshot
+
+        snapshot.restore(get_config(), snapshot_dir)
+
+    def cross_check_best_ethnicity(self, out_fp=None):
+
+        from modules import database, resolver
+
+        s = database.make_session(get_config())
+        d = resolver.cross_check(s)
+        s.close()
+
+        if out_fp:
+
+            d.to_csv(out_fp, index=False)
+
+        return len(d)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,38 @@
+"""
+read ethnicity data from the AE database
+"""
+
+from etl import common
+
+# rows are ordered by participant so a streamed result can be split into
+# chunks without a participant's rows straddling two chunks
+sql = """
+select distinct participant_id as id
+    ,ethnos as ethnicity_code
+    ,arrivaldate::date as source_date
+from q4_19_nhsd.ae
+where ethnos not in ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9') and
+ethnos is not null and
+arrivaldate is not null
+{filter}
+order by participant_id
+;
+"""
+
+SOURCE = common.Source('hes_ae', sql, 'hes_db_conn_str', 'participant_id',
+                       'arrivaldate', '100k_ca', '100k')
+
+
+def run_etl(c, s, bulk=False, stream=False, incremental=False):
+    """
+    extract the AE ethnicity data and load it into the diversity db
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params bulk: load the reported ethnicities with COPY
+    :params stream: read the AE data in chunks of participants
+    :params incremental: only read rows from the high-water mark onwards
+    :returns: set of the ids of participants written to
+    """
+
+    return common.run_etl(c, s, SOURCE, bulk=bulk, stream=stream,
+                          incremental=incremental)
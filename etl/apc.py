@@ -2,9 +2,10 @@
 read ethnicity data from the APC database
 """
 
-from modules import database
-from classes import diversity_db
+from etl import common
 
+# rows are ordered by participant so a streamed result can be split into
+# chunks without a participant's rows straddling two chunks
 sql = """
 select distinct participant_id as id
     ,ethnos as ethnicity_code
@@ -13,31 +14,40 @@ from q4_19_nhsd.apc
 where ethnos not in ('0', '1', '2', '3', '4', '5', '6', '7', '8', '9') and
 ethnos is not null and
 admidate is not null
+{filter}
+order by participant_id
 ;
 """
 
-def run_etl(c, s):
-
-    e = database.get_engine(c.hes_db_conn_str)
-
-    cr = database.run_sql_query(e, sql)
-
-    d = cr.mappings().all()
-
-    # gather all participants
-    pids = set([x['id'] for x in d])
-
-    # make the observed partiicpants
-    obsd = {x: diversity_db.ObservedParticipant(s, x, '100k_ca', True, '100k') for x in pids}
-
-    # add the ethnicities
-    for x in d:
-
-        obsd[x['id']].reported_ethnicities.append(
-            diversity_db.ObservedReportedEthnicity(s, x['id'], x['ethnicity_code'], 'hes_apc', x['source_date'])
-        )
-
-    # add to session
-    for pid, o in obsd.items():
-
-        o.add_to_db(s)
+SOURCE = common.Source('hes_apc', sql, 'hes_db_conn_str', 'participant_id',
+                       'admidate', '100k_ca', '100k')
+
+
+def run_etl(c, s, bulk=False, stream=False, incremental=False,
+            partitions=None, partition_by='hash', pipeline=False):
+    """
+    extract the APC ethnicity data and load it into the diversity db
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params bulk: load the reported ethnicities with COPY
+    :params stream: read the APC data in chunks of participants
+    :params incremental: only read rows from the high-water mark onwards
+    :params partitions: number of worker processes to split the extraction
+    across
+    :params partition_by: split on a 'hash' of participant id or on admidate
+    'date' ranges
+    :params pipeline: extract each chunk while the one before is loaded,
+    through asyncio
+    :returns: set of the ids of participants written to
+    """
+
+    if pipeline:
+
+        from etl import pipeline as etl_pipeline
+
+        return etl_pipeline.run_etl(c, s, SOURCE, bulk=bulk,
+                                    incremental=incremental)
+
+    return common.run_etl(c, s, SOURCE, bulk=bulk, stream=stream,
+                          incremental=incremental, partitions=partitions,
+                          partition_by=partition_by)
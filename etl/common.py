@@ -0,0 +1,517 @@
+"""
+the source independent parts of the ETL: each source module describes its
+query with a Source and these functions extract, transform and load it
+"""
+
+import datetime
+import itertools
+import logging
+import multiprocessing
+import queue
+from concurrent.futures import ProcessPoolExecutor
+from classes.staging import StagedRow
+from modules import database, bulk_load, run_state, concept, metrics, \
+    fingerprint
+
+LOGGER = logging.getLogger(__name__)
+
+
+class Source:
+    """
+    describes how to extract reported ethnicity from one data source
+    """
+
+    def __init__(self, code, sql, conn_str_attr, id_column, date_column,
+                 group, programme, in_ngrl=True, updates_participant=False):
+        """
+        create new Source
+        :params code: the concept code of the source
+        :params sql: query returning id, ethnicity_code and source_date ordered
+        by id, with a {filter} placeholder in its where clause
+        :params conn_str_attr: name of the Config connection string property
+        for the db the source is read from
+        :params id_column: the query's participant id column
+        :params date_column: the query's source date column
+        :params group: group the source's participants are members of
+        :params programme: programme the source's participants are members of
+        :params in_ngrl: boolean, are the source's participants in ngrl?
+        :params updates_participant: boolean, does the source overwrite the
+        group, programme and ngrl membership of participants already in the
+        db? only registration sources should
+        """
+
+        self.code = code
+        self.sql = sql
+        self.conn_str_attr = conn_str_attr
+        self.id_column = id_column
+        self.date_column = date_column
+        self.group = group
+        self.programme = programme
+        self.in_ngrl = in_ngrl
+        self.updates_participant = updates_participant
+
+    def get_engine(self, c):
+        """
+        get the engine for the db the source is read from
+        :params c: a Config class instance
+        """
+
+        return database.get_engine(getattr(c, self.conn_str_attr), c)
+
+    def get_query(self, since=None, n_partitions=None, partition=None,
+                  range_start=None, range_end=None):
+        """
+        get the extraction query and its bind parameters
+        :params since: only read rows from this date onwards, all rows if None
+        :params n_partitions: number of partitions when splitting on a hash of
+        the participant id
+        :params partition: the hash partition to read, from 0 to
+        n_partitions - 1
+        :params range_start: only read rows from this date onwards
+        :params range_end: only read rows before this date
+        :returns: tuple of query string and dictionary of parameters, or None
+        """
+
+        filters = []
+        params = {}
+
+        # the high-water mark day itself is re-read, as rows for it may have
+        # arrived after the last run, rows already loaded are skipped
+        if since:
+
+            filters.append(f'and {self.date_column}::date >= :since')
+            params['since'] = since
+
+        # hashtext is masked to keep it positive
+        if n_partitions:
+
+            filters.append(f'and (hashtext({self.id_column}) & 2147483647) '
+                           f'% :n_partitions = :partition')
+            params.update(n_partitions=n_partitions, partition=partition)
+
+        if range_start:
+
+            filters.append(f'and {self.date_column}::date >= :range_start')
+            params['range_start'] = range_start
+
+        if range_end:
+
+            filters.append(f'and {self.date_column}::date < :range_end')
+            params['range_end'] = range_end
+
+        return self.sql.format(filter='\n'.join(filters)), params or None
+
+    def __repr__(self):
+
+        return f'<Source {self.code}>'
+
+
+def run_etl(c, s, source, bulk=False, stream=False, incremental=False,
+            partitions=None, partition_by='hash', table=None):
+    """
+    extract a source's ethnicity data and load it into the diversity db
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source to run
+    :params bulk: stage the reported ethnicities with COPY rather than
+    multi-row inserts
+    :params stream: read the source through a server-side cursor and load
+    it a chunk of participants at a time, rather than all in one go
+    :params incremental: only read rows from the source's high-water mark
+    onwards, rather than rebuilding from the source's full history
+    :params partitions: number of partitions to split the extraction into,
+    each extracted in its own worker process
+    :params partition_by: split on a 'hash' of participant id or on 'date'
+    ranges
+    :params table: table to load the reported ethnicities into, rather than
+    reported_ethnicity
+    :returns: set of the ids of participants written to
+    """
+
+    # reload the concepts if they have changed since they were last cached
+    concept.CONCEPT_CACHE.check(s)
+
+    since = get_since(s, source, incremental)
+    high_water_mark = since
+    touched = set()
+
+    # date ranges split a participant's rows between partitions
+    fingerprinted = not incremental and not (partitions and
+                                             partition_by == 'date')
+
+    if partitions:
+
+        chunks = extract_partitioned(c, source, since, partitions,
+                                     partition_by)
+
+    else:
+
+        chunks = extract(c, source, since, stream)
+
+    for rows in metrics.timed('extract', chunks):
+
+        metrics.count(f'rows.{source.code}', len(rows))
+
+        with metrics.stage('transform', len(rows)) as st:
+
+            changed, fingerprints = transform(s, source, rows, fingerprinted,
+                                              skip_unchanged=table is None)
+            st['rows_out'] = len(changed)
+            touched.update(x['id'] for x in changed)
+
+        load_rows(c, s, source, changed, bulk, table, fingerprints)
+        high_water_mark = max_date(high_water_mark, get_max_date(rows))
+
+        if stream or partitions:
+
+            # flush the chunk through and release it from the session
+            s.flush()
+            s.expunge_all()
+
+    set_high_water_mark(s, source, high_water_mark)
+
+    return touched
+
+
+def get_since(s, source, incremental):
+    """
+    get the date an incremental run of a source reads from
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source to run
+    :params incremental: is the run incremental?
+    :returns: the source's high-water mark, None for a full run
+    """
+
+    since = run_state.get_high_water_mark(s, source.code) \
+        if incremental else None
+
+    if since:
+
+        LOGGER.info('reading %s rows from %s', source.code, since)
+
+    return since
+
+
+def set_high_water_mark(s, source, high_water_mark):
+    """
+    record a source's new high-water mark in the session so it is committed
+    along with the data
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source that was run
+    :params high_water_mark: latest date loaded, None if nothing was
+    """
+
+    if high_water_mark:
+
+        run_state.set_high_water_mark(s, source.code, high_water_mark)
+
+
+def extract(c, source, since=None, stream=False):
+    """
+    extract a source's rows, grouped so that all of a participant's rows are
+    in the same chunk
+    :params c: a Config class instance
+    :params source: the Source to extract
+    :params since: only read rows from this date onwards, all rows if None
+    :params stream: read through a server-side cursor in chunks of
+    etl_chunk_size rows, rather than in a single chunk
+    :returns: generator of lists of row mappings
+    """
+
+    e = source.get_engine(c)
+    q, params = source.get_query(since)
+
+    if stream:
+
+        chunks = database.stream_sql_query(e, q, c.etl_chunk_size, params)
+
+        yield from chunk_by_participant(chunks)
+
+    else:
+
+        rows = database.run_sql_query(e, q, params).mappings().all()
+
+        if rows:
+
+            yield rows
+
+
+def extract_partitioned(c, source, since, n_partitions, partition_by='hash'):
+    """
+    extract a source split into partitions, each extracted and grouped by
+    participant in its own worker process, chunks are yielded as each
+    partition completes
+    :params c: a Config class instance
+    :params source: the Source to extract
+    :params since: only read rows from this date onwards, all rows if None
+    :params n_partitions: number of partitions
+    :params partition_by: split on a 'hash' of participant id, so each
+    participant is in one partition, or on 'date' ranges
+    :returns: generator of lists of StagedRow
+    """
+
+    if partition_by == 'hash':
+
+        partitions = [{'n_partitions': n_partitions, 'partition': i}
+                      for i in range(n_partitions)]
+
+    elif partition_by == 'date':
+
+        partitions = date_partitions(since or c.etl_partition_start_date,
+                                     n_partitions)
+
+    else:
+
+        raise ValueError(f'unrecognised partition_by: {partition_by}')
+
+    # spawned rather than forked so workers don't share the parent's pooled
+    # connections
+    ctx = multiprocessing.get_context('spawn')
+
+    with ctx.Manager() as m, \
+            ProcessPoolExecutor(max_workers=n_partitions,
+                                mp_context=ctx) as ex:
+
+        # workers hand over a chunk at a time through a bounded queue, so at
+        # most etl_queue_size chunks are held in memory rather than whole
+        # partitions
+        out = m.Queue(maxsize=c.etl_queue_size)
+        stop = m.Event()
+        futures = [ex.submit(extract_partition, c, source, since, x, out, stop)
+                   for x in partitions]
+
+        try:
+
+            # each worker puts None once it has finished, even if it failed
+            n_done = 0
+
+            while n_done < len(futures):
+
+                chunk = out.get()
+
+                if chunk is None:
+
+                    n_done += 1
+
+                else:
+
+                    yield list(itertools.starmap(StagedRow, chunk))
+
+            # raise any worker's error
+            for f in futures:
+
+                f.result()
+
+        finally:
+
+            # lets the workers return if the chunks stop being read early
+            stop.set()
+
+
+def date_partitions(start, n_partitions):
+    """
+    split the dates from start to today into equal ranges, the first and
+    last are left open so no rows are missed
+    :params start: the date to split from
+    :params n_partitions: number of ranges
+    :returns: list of dictionaries of range_start and range_end
+    """
+
+    span = (datetime.date.today() - start) / n_partitions
+    bounds = [None] + [start + span * i for i in range(1, n_partitions)] + \
+        [None]
+
+    return [{'range_start': bounds[i], 'range_end': bounds[i + 1]}
+            for i in range(n_partitions)]
+
+
+def extract_partition(c, source, since, partition, out, stop):
+    """
+    extract one partition of a source, run in a worker process
+    :params c: a Config class instance
+    :params source: the Source to extract
+    :params since: only read rows from this date onwards, all rows if None
+    :params partition: dictionary of partition arguments to Source.get_query
+    :params out: queue the lists of (id, ethnicity_code, source_date)
+    tuples, grouped by participant, are put on, followed by None once the
+    partition is done
+    :params stop: event set once the chunks are no longer wanted
+    """
+
+    try:
+
+        e = source.get_engine(c)
+        q, params = source.get_query(since, **partition)
+        chunks = database.stream_sql_query(e, q, c.etl_chunk_size, params)
+
+        for rows in chunk_by_participant(chunks):
+
+            # sent as plain tuples, which pickle quicker than dictionaries
+            # or named tuples
+            staged = [(x['id'], x['ethnicity_code'], x['source_date'])
+                      for x in rows]
+
+            if not put_unless_stopped(out, stop, staged):
+
+                return
+
+    finally:
+
+        put_unless_stopped(out, stop, None)
+
+
+def put_unless_stopped(out, stop, item):
+    """
+    put an item on a bounded queue, waiting for space until it's stopped
+    :params out: the queue
+    :params stop: event set once the items are no longer wanted
+    :params item: the item to put
+    :returns: True if the item was put on the queue
+    """
+
+    while not stop.is_set():
+
+        try:
+
+            out.put(item, timeout=1)
+
+            return True
+
+        except queue.Full:
+
+            continue
+
+    return False
+
+
+def transform(s, source, rows, fingerprinted, skip_unchanged=True):
+    """
+    fingerprint each participant's extracted rows and drop the rows of
+    participants whose fingerprint matches the one stored for the source
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source the rows were extracted from
+    :params rows: list of row mappings with id, ethnicity_code and
+    source_date
+    :params fingerprinted: do the rows hold all of each participant's rows
+    from the source? if not they are all passed through, unfingerprinted
+    :params skip_unchanged: drop unchanged participants' rows, not wanted
+    when the rows are loaded into a new, empty, table
+    :returns: tuple of the rows to load and dictionary of participant id:
+    fingerprint for their participants, empty if not fingerprinted
+    """
+
+    if not fingerprinted:
+
+        return rows, {}
+
+    # rows with codes the load can't resolve aren't counted as loaded
+    codes = set(concept.get_concept_cache(s).get_uids(
+        'reported_ethnicity_code'))
+    fingerprints = fingerprint.get_fingerprints(rows, codes)
+
+    if skip_unchanged:
+
+        stored = fingerprint.read_fingerprints(s, source.code,
+                                               list(fingerprints))
+        n = len(fingerprints)
+        fingerprints = {k: v for k, v in fingerprints.items()
+                        if stored.get(k) != v}
+        rows = [x for x in rows if x['id'] in fingerprints]
+
+        metrics.count(f'unchanged.{source.code}', n - len(fingerprints))
+        LOGGER.debug('skipping %d unchanged %s participants',
+                     n - len(fingerprints), source.code)
+
+    return rows, fingerprints
+
+
+def load_rows(c, s, source, rows, bulk, table=None, fingerprints=None):
+    """
+    load extracted rows, with their participants, through the staging
+    table
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source the rows were extracted from
+    :params rows: list of row mappings with id, ethnicity_code and source_date
+    :params bulk: load the reported ethnicities with COPY
+    :params table: table to load the reported ethnicities into, rather than
+    reported_ethnicity
+    :params fingerprints: dictionary of participant id: fingerprint of the
+    rows' participants, saved once the rows are loaded
+    :returns: the latest source_date in the rows
+    """
+
+    if not rows:
+
+        return None
+
+    LOGGER.debug('loading %d %s rows', len(rows), source.code)
+
+    with metrics.stage('load', len(rows)) as st:
+
+        st['rows_out'] = bulk_load.load_source_rows(
+            s, source, rows, c.copy_batch_size, copy=bulk, table=table)
+
+        if fingerprints:
+
+            fingerprint.save_fingerprints(s, source.code, fingerprints)
+
+    return get_max_date(rows)
+
+
+def get_max_date(rows):
+    """
+    the latest source_date in rows, None if there are none
+    """
+
+    return max((x['source_date'] for x in rows), default=None)
+
+
+def max_date(a, b):
+    """
+    the later of two dates, either of which may be None
+    """
+
+    return max((x for x in (a, b) if x is not None), default=None)
+
+
+def chunk_by_participant(chunks):
+    """
+    regroup chunks of rows ordered by participant so that all the rows for a
+    participant end up in the same chunk
+    :params chunks: iterable of lists of row mappings, ordered by id
+    :returns: generator of lists of row mappings
+    """
+
+    carry = []
+
+    for chunk in chunks:
+
+        rows, carry = split_last_participant(carry + list(chunk))
+
+        if rows:
+
+            yield rows
+
+    if carry:
+
+        yield carry
+
+
+def split_last_participant(rows):
+    """
+    split off the last participant's rows, as they may continue into the
+    next chunk
+    :params rows: list of row mappings, ordered by id
+    :returns: tuple of the rows before the last participant's and the last
+    participant's rows
+    """
+
+    last_id = rows[-1]['id']
+    split = len(rows)
+
+    while split > 0 and rows[split - 1]['id'] == last_id:
+
+        split -= 1
+
+    return rows[:split], rows[split:]
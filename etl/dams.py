@@ -0,0 +1,69 @@
+"""
+read ethnicity data from the DAMS cancer and rare disease registrations
+"""
+
+from etl import common
+
+# rows are ordered by participant so a streamed result can be split into
+# chunks without a participant's rows straddling two chunks
+cancer_sql = """
+select distinct r.participant_identifiers_id as id
+    ,r.ethnicity_id as ethnicity_code
+    ,ev.event_date::date as source_date
+from gelcancer.cancer_registration r
+join gelcancer.event_detail ev
+    on r.event_details_id = ev.id
+where r.ethnicity_id is not null and
+ev.event_date is not null
+{filter}
+order by r.participant_identifiers_id
+;
+"""
+
+rare_disease_sql = """
+select distinct r.participant_identifiers_id as id
+    ,r.ethnicity_id as ethnicity_code
+    ,msg.metadata_date::date as source_date
+from rarediseases.rare_diseases_registration r
+join rarediseases.rare_diseases_subject s
+    on r.subject_id = s.id
+join rarediseases.rare_diseases_message msg
+    on s.message_id = msg.id
+where r.ethnicity_id is not null and
+msg.metadata_date is not null
+{filter}
+order by r.participant_identifiers_id
+;
+"""
+
+CANCER_SOURCE = common.Source(
+    'dams', cancer_sql, 'dams_db_conn_str', 'r.participant_identifiers_id',
+    'ev.event_date', '100k_ca', '100k', updates_participant=True)
+
+RARE_DISEASE_SOURCE = common.Source(
+    'dams_rd', rare_disease_sql, 'dams_db_conn_str',
+    'r.participant_identifiers_id', 'msg.metadata_date', '100k_rd', '100k',
+    updates_participant=True)
+
+SOURCES = [CANCER_SOURCE, RARE_DISEASE_SOURCE]
+
+
+def run_etl(c, s, bulk=False, stream=False, incremental=False):
+    """
+    extract the DAMS ethnicity data and load it into the diversity db
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params bulk: load the reported ethnicities with COPY
+    :params stream: read the DAMS data in chunks of participants
+    :params incremental: only read rows from the high-water marks onwards
+    :returns: set of the ids of participants written to
+    """
+
+    touched = set()
+
+    for source in SOURCES:
+
+        touched |= common.run_etl(c, s, source, bulk=bulk, stream=stream,
+                                  incremental=incremental)
+
+    return touched
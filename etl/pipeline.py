@@ -0,0 +1,232 @@
+"""
+run the ETL for a source as an asyncio pipeline: the next chunk is fetched
+from the source db through asyncpg while the previous one is loaded into the
+diversity db, so neither db sits idle waiting on the other and a run takes
+about as long as the slower of the extract and the load, rather than both
+the load goes through the session on a worker thread, one chunk at a time,
+as the session isn't async
+"""
+
+import asyncio
+import logging
+import re
+import time
+import asyncpg
+from sqlalchemy.engine import make_url
+from modules import concept, metrics
+from etl import common
+
+LOGGER = logging.getLogger(__name__)
+
+# put on the queue when the extraction has finished
+DONE = object()
+
+# :name bind parameters, but not :: casts
+BIND_PARAM_RE = re.compile(r'(?<![:\w]):(\w+)')
+
+
+def run_etl(c, s, source, bulk=False, incremental=False, table=None):
+    """
+    extract a source's ethnicity data and load it into the diversity db,
+    overlapping the extraction of each chunk with the load of the one before
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source to run
+    :params bulk: stage the reported ethnicities with COPY rather than
+    multi-row inserts
+    :params incremental: only read rows from the source's high-water mark
+    onwards
+    :params table: table to load the reported ethnicities into, rather than
+    reported_ethnicity
+    :returns: set of the ids of participants written to
+    """
+
+    concept.CONCEPT_CACHE.check(s)
+
+    since = common.get_since(s, source, incremental)
+    start = time.perf_counter()
+
+    touched, high_water_mark = asyncio.run(
+        run_pipeline(c, s, source, since, bulk, table,
+                     fingerprinted=not incremental))
+
+    common.set_high_water_mark(s, source,
+                               common.max_date(since, high_water_mark))
+
+    LOGGER.info('ran %s pipeline in %.1fs', source.code,
+                time.perf_counter() - start)
+
+    return touched
+
+
+async def run_pipeline(c, s, source, since, bulk, table, fingerprinted=False):
+    """
+    load chunks as the extraction task puts them on a bounded queue
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source to run
+    :params since: only read rows from this date onwards, all rows if None
+    :params bulk: stage the reported ethnicities with COPY
+    :params table: table to load the reported ethnicities into, None for
+    reported_ethnicity
+    :params fingerprinted: do the rows hold all of each participant's rows,
+    so unchanged participants can be skipped?
+    :returns: tuple of the set of participant ids written to and the latest
+    source_date extracted
+    """
+
+    # bounded so a fast extraction waits for the load rather than filling
+    # memory
+    q = asyncio.Queue(maxsize=c.etl_queue_size)
+    extraction = asyncio.create_task(extract(c, source, since, q))
+
+    touched = set()
+    high_water_mark = None
+
+    try:
+
+        while True:
+
+            rows = await q.get()
+
+            if rows is DONE:
+
+                break
+
+            metrics.count(f'rows.{source.code}', len(rows))
+            high_water_mark = common.max_date(high_water_mark,
+                                              common.get_max_date(rows))
+
+            # the extraction carries on fetching while this waits
+            touched.update(await asyncio.to_thread(
+                load_chunk, c, s, source, rows, bulk, table, fingerprinted))
+
+        # raise any error from the extraction
+        await extraction
+
+    finally:
+
+        extraction.cancel()
+
+    return touched, high_water_mark
+
+
+async def extract(c, source, since, q):
+    """
+    fetch a source's rows through a server-side cursor, putting them on the
+    queue in chunks of participants, followed by DONE
+    :params c: a Config class instance
+    :params source: the Source to extract
+    :params since: only read rows from this date onwards, all rows if None
+    :params q: the asyncio queue
+    """
+
+    try:
+
+        sql, args = to_asyncpg_query(*source.get_query(since))
+        dsn = get_dsn(getattr(c, source.conn_str_attr))
+        con = await asyncpg.connect(dsn)
+
+        try:
+
+            # cursors only exist within a transaction
+            async with con.transaction():
+
+                cur = await con.cursor(sql, *args)
+                carry = []
+
+                while True:
+
+                    with metrics.stage('extract') as st:
+
+                        chunk = await cur.fetch(c.etl_chunk_size)
+                        st['rows_out'] = len(chunk)
+
+                    if not chunk:
+
+                        break
+
+                    rows, carry = common.split_last_participant(carry +
+                                                                chunk)
+
+                    if rows:
+
+                        await q.put(rows)
+
+                if carry:
+
+                    await q.put(carry)
+
+        finally:
+
+            await con.close()
+
+    finally:
+
+        # the load stops waiting even if the extraction failed, if the load
+        # has failed instead this task is cancelled again by asyncio.run
+        # should it wait here for space
+        await q.put(DONE)
+
+
+def load_chunk(c, s, source, rows, bulk, table, fingerprinted=False):
+    """
+    transform and load a chunk and release it from the session, run on a
+    worker thread, as the transform reads the stored fingerprints
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the Source the rows were extracted from
+    :params rows: list of row mappings
+    :params bulk: stage the reported ethnicities with COPY
+    :params table: table to load the reported ethnicities into, None for
+    reported_ethnicity
+    :params fingerprinted: do the rows hold all of each participant's rows?
+    :returns: set of the ids of participants written to
+    """
+
+    with metrics.stage('transform', len(rows)) as st:
+
+        changed, fingerprints = common.transform(
+            s, source, rows, fingerprinted, skip_unchanged=table is None)
+        st['rows_out'] = len(changed)
+
+    common.load_rows(c, s, source, changed, bulk, table, fingerprints)
+
+    s.flush()
+    s.expunge_all()
+
+    return {x['id'] for x in changed}
+
+
+def to_asyncpg_query(sql, params):
+    """
+    convert a query with :name bind parameters to asyncpg's $n parameters
+    :params sql: the query string
+    :params params: dictionary of values for the bind parameters, or None
+    :returns: tuple of the query string and list of arguments
+    """
+
+    names = []
+
+    def number(m):
+
+        if m.group(1) not in names:
+
+            names.append(m.group(1))
+
+        return f'${names.index(m.group(1)) + 1}'
+
+    sql = BIND_PARAM_RE.sub(number, sql)
+
+    return sql, [(params or {})[x] for x in names]
+
+
+def get_dsn(conn_str):
+    """
+    get the asyncpg dsn for a SQLAlchemy connection string
+    :params conn_str: the connection string
+    :returns: the dsn
+    """
+
+    return make_url(conn_str).set(drivername='postgresql').\
+        render_as_string(hide_password=False)
@@ -0,0 +1,177 @@
+"""
+run the ETL for several sources at once: each source is extracted on its own
+thread and connection, while the chunks are loaded one at a time on the
+calling thread through its session
+"""
+
+import logging
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from modules import concept, metrics
+from etl import common, apc, op, ae, dams
+
+LOGGER = logging.getLogger(__name__)
+
+SOURCES = {x.code: x for x in [apc.SOURCE, op.SOURCE, ae.SOURCE,
+                               *dams.SOURCES]}
+
+# put on the queue by an extraction thread when it has finished
+DONE = object()
+
+
+def get_sources(codes=None):
+    """
+    get the Sources to run
+    :params codes: list of source codes, all sources if None
+    :returns: list of Source
+    """
+
+    if codes is None:
+
+        return list(SOURCES.values())
+
+    unknown = set(codes) - set(SOURCES)
+
+    if unknown:
+
+        raise ValueError(f'unrecognised sources: {", ".join(sorted(unknown))}')
+
+    return [SOURCES[x] for x in codes]
+
+
+def run_etl(c, s, sources, bulk=False, incremental=False, tables=None):
+    """
+    extract sources concurrently and load them into the diversity db
+    :params c: a Config class instance
+    :params s: SQLAlchemy session bound to required engines
+    :params sources: list of Source to run
+    :params bulk: load the reported ethnicities with COPY
+    :params incremental: only read rows from each source's high-water mark
+    onwards
+    :params tables: dictionary of source code: table to load the source's
+    reported ethnicities into, rather than reported_ethnicity
+    :returns: set of the ids of participants written to
+    """
+
+    # the session isn't thread safe, so anything read through it is read
+    # up front on this thread
+    concept.CONCEPT_CACHE.check(s)
+    since = {x.code: common.get_since(s, x, incremental) for x in sources}
+    high_water_marks = dict(since)
+    touched = set()
+
+    # bounded so fast extractions wait for the load rather than filling
+    # memory
+    q = queue.Queue(maxsize=c.etl_queue_size)
+    stop = threading.Event()
+    start = time.perf_counter()
+
+    with ThreadPoolExecutor(max_workers=len(sources)) as ex:
+
+        futures = [ex.submit(extract_source, c, x, since[x.code], q, stop)
+                   for x in sources]
+
+        try:
+
+            remaining = len(sources)
+
+            while remaining:
+
+                source, rows = q.get()
+
+                if rows is DONE:
+
+                    remaining -= 1
+                    LOGGER.info('finished extracting %s after %.1fs',
+                                source.code, time.perf_counter() - start)
+                    continue
+
+                metrics.count(f'rows.{source.code}', len(rows))
+
+                table = (tables or {}).get(source.code)
+
+                with metrics.stage('transform', len(rows)) as st:
+
+                    changed, fingerprints = common.transform(
+                        s, source, rows, not incremental,
+                        skip_unchanged=table is None)
+                    st['rows_out'] = len(changed)
+                    touched.update(x['id'] for x in changed)
+
+                common.load_rows(c, s, source, changed, bulk, table,
+                                 fingerprints)
+                high_water_marks[source.code] = common.max_date(
+                    high_water_marks[source.code], common.get_max_date(rows))
+
+                # flush the chunk through and release it from the session
+                s.flush()
+                s.expunge_all()
+
+        finally:
+
+            # let extraction threads blocked on a full queue give up
+            stop.set()
+
+        # raise any error from the extraction threads
+        for f in futures:
+
+            f.result()
+
+    for x in sources:
+
+        common.set_high_water_mark(s, x, high_water_marks[x.code])
+
+    LOGGER.info('ran %d sources in %.1fs', len(sources),
+                time.perf_counter() - start)
+
+    return touched
+
+
+def extract_source(c, source, since, q, stop):
+    """
+    extract a source in chunks of participants onto a queue, run on an
+    extraction thread
+    :params c: a Config class instance
+    :params source: the Source to extract
+    :params since: only read rows from this date onwards, all rows if None
+    :params q: queue the (source, rows) chunks are put on, followed by
+    (source, DONE) when finished
+    :params stop: event set when the load has stopped and nothing more should
+    be put on the queue
+    """
+
+    try:
+
+        for rows in metrics.timed('extract', common.extract(
+                c, source, since, stream=True)):
+
+            if not put(q, (source, rows), stop):
+
+                return
+
+    finally:
+
+        put(q, (source, DONE), stop)
+
+
+def put(q, item, stop):
+    """
+    put an item on a bounded queue, giving up if stop is set while waiting
+    :returns: boolean, was the item put on the queue?
+    """
+
+    while not stop.is_set():
+
+        try:
+
+            q.put(item, timeout=1)
+
+            return True
+
+        except queue.Full:
+
+            continue
+
+    return False
@@ -0,0 +1,180 @@
+"""
+functions for maintaining and reading the materialised best ethnicity of each
+participant in participant_best_ethnicity
+when a refresh is part of an ETL run, the participants whose best ethnicity
+it adds, changes or removes are logged against the run in
+best_ethnicity_change first, and only those participants are then written
+"""
+
+import logging
+import time
+from sqlalchemy import text
+from modules import database
+from classes.diversity_db import ParticipantBestEthnicity
+
+LOGGER = logging.getLogger(__name__)
+
+# number of participant ids recomputed per statement
+REFRESH_BATCH_SIZE = 10000
+
+REFRESH_ALL_SQL = """
+truncate ethnicity_store.participant_best_ethnicity;
+insert into ethnicity_store.participant_best_ethnicity
+(participant_id, best_ethnicity_code)
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.vw_participant_ethnicity;
+"""
+
+DELETE_PARTICIPANTS_SQL = """
+delete from ethnicity_store.participant_best_ethnicity
+where participant_id = any(:pids);
+"""
+
+INSERT_PARTICIPANTS_SQL = """
+insert into ethnicity_store.participant_best_ethnicity
+(participant_id, best_ethnicity_code)
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.participant_ethnicity(:pids);
+"""
+
+
+# compares the materialised best ethnicities with those computed now, before
+# the table is updated
+# filled in with either every participant or a batch of them
+LOG_CHANGES_SQL = """
+insert into ethnicity_store.best_ethnicity_change
+(run_id, participant_id, change_type, old_best_ethnicity_code,
+ new_best_ethnicity_code)
+select cast(:run_id as bigint)
+    ,coalesce(o.participant_id, n.participant_id)
+    ,case
+        when o.participant_id is null then 'added'
+        when n.participant_id is null then 'removed'
+        else 'changed'
+    end
+    ,o.best_ethnicity_code
+    ,n.best_ethnicity_code
+from (
+    select participant_id
+        ,best_ethnicity_code
+    from ethnicity_store.participant_best_ethnicity
+    {where}
+) o
+full join ethnicity_store.participant_ethnicity({pids}) n
+    on n.participant_id = o.participant_id
+where o.best_ethnicity_code is distinct from n.best_ethnicity_code;
+"""
+
+APPLY_CHANGES_SQL = """
+delete from ethnicity_store.participant_best_ethnicity b
+using ethnicity_store.best_ethnicity_change c
+where c.run_id = cast(:run_id as bigint)
+    and c.participant_id = b.participant_id
+    {and_where};
+insert into ethnicity_store.participant_best_ethnicity
+(participant_id, best_ethnicity_code)
+select c.participant_id
+    ,c.new_best_ethnicity_code
+from ethnicity_store.best_ethnicity_change c
+where c.run_id = cast(:run_id as bigint)
+    and c.new_best_ethnicity_code is not null
+    {and_where};
+"""
+
+
+def refresh(s, pids=None, run_id=None):
+    """
+    recompute the best ethnicity of participants, in the session's
+    transaction
+    :params s: SQLAlchemy session bound to required engines
+    :params pids: iterable of participant ids touched by an ETL run, all
+    participants are recomputed if None
+    :params run_id: id of the ETL run the refresh is part of, to log the
+    changes against, None to not log them
+    :returns: the number of changes logged, None if they weren't logged
+    """
+
+    if run_id is not None:
+
+        return refresh_logged(s, pids, run_id)
+
+    con = database.get_div_db_connection(s)
+    start = time.perf_counter()
+
+    if pids is None:
+
+        con.execute(REFRESH_ALL_SQL)
+        LOGGER.info(f'refreshed best ethnicity for all participants in '
+                    f'{time.perf_counter() - start:.1f}s')
+
+        return
+
+    pids = list(pids)
+
+    for i in range(0, len(pids), REFRESH_BATCH_SIZE):
+
+        batch = pids[i:i + REFRESH_BATCH_SIZE]
+        con.execute(text(DELETE_PARTICIPANTS_SQL), {'pids': batch})
+        con.execute(text(INSERT_PARTICIPANTS_SQL), {'pids': batch})
+
+    LOGGER.info(f'refreshed best ethnicity for {len(pids)} participants in '
+                f'{time.perf_counter() - start:.1f}s')
+
+
+def refresh_logged(s, pids, run_id):
+    """
+    log the changes to participants' best ethnicities against an ETL run,
+    then write just the changed participants, in the session's transaction
+    :params s: SQLAlchemy session bound to required engines
+    :params pids: iterable of participant ids touched by the run, all
+    participants are compared if None
+    :params run_id: id of the run
+    :returns: the number of changes logged
+    """
+
+    con = database.get_div_db_connection(s)
+    start = time.perf_counter()
+
+    if pids is None:
+
+        n = con.execute(text(LOG_CHANGES_SQL.format(where='', pids='null')),
+                        {'run_id': run_id}).rowcount
+        con.execute(text(APPLY_CHANGES_SQL.format(and_where='')),
+                    {'run_id': run_id})
+
+    else:
+
+        pids = list(pids)
+        n = 0
+
+        for i in range(0, len(pids), REFRESH_BATCH_SIZE):
+
+            params = {'run_id': run_id,
+                      'pids': pids[i:i + REFRESH_BATCH_SIZE]}
+            n += con.execute(text(LOG_CHANGES_SQL.format(
+                where='where participant_id = any(:pids)', pids=':pids')),
+                params).rowcount
+            con.execute(text(APPLY_CHANGES_SQL.format(
+                and_where='and c.participant_id = any(:pids)')), params)
+
+    LOGGER.info('refreshed best ethnicity for %s participants in %.1fs, '
+                '%d changed in run %d',
+                'all' if pids is None else len(pids),
+                time.perf_counter() - start, n, run_id)
+
+    return n
+
+
+def get_best_ethnicity(s, pid):
+    """
+    get the best ethnicity code for a participant
+    :params s: SQLAlchemy session bound to required engines
+    :params pid: participant id
+    :returns: the best ethnicity code, None if the participant has none
+    """
+
+    d = s.query(ParticipantBestEthnicity).get(pid)
+
+    return d.best_ethnicity_code if d else None
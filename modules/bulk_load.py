@@ -0,0 +1,169 @@
+"""
+functions for bulk loading observed data into the diversity db
+extracted rows are written a batch at a time into an unlogged staging table
+and merged into participant and reported_ethnicity with a single statement
+each, with codes converted to cids by joining to concept on the server,
+rather than merged and flushed one row at a time
+"""
+
+import csv
+import io
+import logging
+import time
+from sqlalchemy import insert, text
+from modules import database, metrics
+from classes.diversity_db import ReportedEthnicityStaging
+
+LOGGER = logging.getLogger(__name__)
+
+STAGING_COLUMNS = ('participant_id', 'ethnicity_code', 'source_date')
+
+COPY_STAGING_SQL = f"""
+copy ethnicity_store.reported_ethnicity_staging ({', '.join(STAGING_COLUMNS)})
+from stdin with (format csv)
+"""
+
+# every row in a batch comes from the same source, so its participants all
+# have the same group, programme and ngrl membership, which only registration
+# sources overwrite for participants already in the db
+MERGE_STAGED_PARTICIPANTS_SQL = """
+insert into ethnicity_store.participant as p
+(id, group_cid, in_ngrl, programme_cid)
+select distinct st.participant_id
+    ,gc.uid
+    ,:in_ngrl
+    ,pc.uid
+from ethnicity_store.reported_ethnicity_staging st
+join ethnicity_store.concept gc
+    on gc.codesystem = 'group' and gc.concept_code = :group
+join ethnicity_store.concept pc
+    on pc.codesystem = 'programme' and pc.concept_code = :programme
+on conflict (id) do update
+set group_cid = excluded.group_cid
+    ,in_ngrl = excluded.in_ngrl
+    ,programme_cid = excluded.programme_cid
+where cast(:updates_participant as boolean);
+"""
+
+MERGE_STAGED_REPORTED_ETHNICITY_SQL = """
+insert into {table}
+(participant_id, ethnicity_cid, source_cid, source_date)
+select distinct st.participant_id
+    ,ec.uid
+    ,sc.uid
+    ,st.source_date
+from ethnicity_store.reported_ethnicity_staging st
+join ethnicity_store.concept ec
+    on ec.codesystem = 'reported_ethnicity_code'
+    and ec.concept_code = st.ethnicity_code
+join ethnicity_store.concept sc
+    on sc.codesystem = 'source' and sc.concept_code = :source
+on conflict do nothing;
+"""
+
+UNMATCHED_STAGED_CODES_SQL = """
+select distinct st.ethnicity_code
+from ethnicity_store.reported_ethnicity_staging st
+where not exists (
+    select 1
+    from ethnicity_store.concept ec
+    where ec.codesystem = 'reported_ethnicity_code'
+        and ec.concept_code = st.ethnicity_code
+);
+"""
+
+# only this transaction's rows are visible to it, as every load empties the
+# table again before committing, so concurrent loads don't see each other's
+# batches and a truncate, which would block them, isn't needed
+CLEAR_STAGING_SQL = """
+delete from ethnicity_store.reported_ethnicity_staging;
+"""
+
+
+def load_source_rows(s, source, rows, batch_size, copy=True, table=None):
+    """
+    load rows extracted from a source through the staging table
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the etl Source the rows were extracted from
+    :params rows: list of row mappings with id, ethnicity_code and
+    source_date
+    :params batch_size: number of rows staged and merged at a time
+    :params copy: write the rows into the staging table with COPY, rather
+    than multi-row inserts
+    :params table: the table the reported ethnicities are merged into,
+    reported_ethnicity if None
+    :returns: number of reported ethnicity rows inserted
+    """
+
+    con = database.get_div_db_connection(s)
+    params = {'source': source.code, 'group': source.group,
+              'programme': source.programme, 'in_ngrl': source.in_ngrl,
+              'updates_participant': source.updates_participant}
+
+    n_inserted = 0
+    start = time.perf_counter()
+
+    # a participant's rows may be split over two batches, which is fine as
+    # each batch upserts the participant before adding their ethnicities
+    for i in range(0, len(rows), batch_size):
+
+        batch = rows[i:i + batch_size]
+
+        if copy:
+
+            _copy_staging_batch(con, batch)
+
+        else:
+
+            con.execute(insert(ReportedEthnicityStaging.__table__),
+                        [{'participant_id': x['id'],
+                          'ethnicity_code': x['ethnicity_code'],
+                          'source_date': x['source_date']} for x in batch])
+
+        con.execute(text(MERGE_STAGED_PARTICIPANTS_SQL), params)
+        n_inserted += con.execute(
+            text(MERGE_STAGED_REPORTED_ETHNICITY_SQL.format(
+                table=table or 'ethnicity_store.reported_ethnicity')),
+            params).rowcount
+
+        unmatched = con.execute(UNMATCHED_STAGED_CODES_SQL).scalars().all()
+
+        if unmatched:
+
+            LOGGER.warning('skipped %s rows with unrecognised ethnicity '
+                           'codes: %s', source.code, ', '.join(unmatched))
+
+        con.execute(CLEAR_STAGING_SQL)
+
+    elapsed = time.perf_counter() - start
+    LOGGER.info('staged %d %s rows, %d new, in %.1fs (%.0f rows/s)',
+                len(rows), source.code, n_inserted, elapsed,
+                len(rows) / elapsed if elapsed else 0)
+
+    return n_inserted
+
+
+def _copy_staging_batch(con, batch):
+    """
+    copy a single batch of extracted rows into the staging table
+    :params con: the session's SQLAlchemy connection to the diversity db
+    :params batch: list of row mappings with id, ethnicity_code and
+    source_date
+    """
+
+    buf = io.StringIO()
+    w = csv.writer(buf)
+
+    for x in batch:
+
+        w.writerow([x['id'], x['ethnicity_code'], x['source_date']])
+
+    buf.seek(0)
+
+    cur = con.connection.cursor()
+    cur.copy_expert(COPY_STAGING_SQL, buf)
+    cur.close()
+
+    # the COPY bypasses SQLAlchemy, so isn't counted by its events
+    metrics.add_round_trips()
+
@@ -0,0 +1,287 @@
+"""
+functions for full reloads of sources in reported_ethnicity
+each source is loaded into a plain table of its own, without constraints,
+indexes or summary triggers, then the indexes are built in parallel and the
+table swapped in for the source's partition in a single transaction, which
+validates the foreign keys in one pass and is far cheaper than checking
+every constraint on every row
+"""
+
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import exc, text
+from modules import database
+
+LOGGER = logging.getLogger(__name__)
+
+SCHEMA = 'ethnicity_store'
+TABLE = f'{SCHEMA}.reported_ethnicity'
+
+# indexes the view, refresh and lookups rely on, created if missing before
+# a reload so the new partitions are built with them
+REQUIRED_INDEXES = [
+    f'create index if not exists reported_ethnicity_source_idx on {TABLE} '
+    f'(source_cid, source_date);',
+]
+
+PARTITION_NAME_SQL = """
+select ethnicity_store.source_partition_name(:source);
+"""
+
+SOURCE_CID_SQL = f"""
+select uid::text
+from {SCHEMA}.concept
+where codesystem = 'source'
+    and concept_code = :source
+;
+"""
+
+# the partition currently holding a source, if it has one of its own
+PARTITION_SQL = f"""
+select p.relname
+from pg_inherits i
+join pg_class p
+    on p.oid = i.inhrelid
+where i.inhparent = '{TABLE}'::regclass
+    and p.relname = {SCHEMA}.source_partition_name(:source)
+;
+"""
+
+# the columns of each index on the parent table, which every partition has
+# to have a matching index for
+INDEXES_SQL = f"""
+select i.indisunique as is_unique
+    ,i.indisprimary as is_primary
+    ,(select string_agg(pg_get_indexdef(i.indexrelid, k, true), ', '
+                        order by k)
+      from generate_series(1, i.indnkeyatts) k) as columns
+from pg_index i
+where i.indrelid = '{TABLE}'::regclass
+order by i.indexrelid
+;
+"""
+
+DEDUPE_SQL = """
+delete from {table} re
+using (
+    select ctid
+        ,row_number() over (partition by participant_id, ethnicity_cid,
+                            source_cid, source_date) as n
+    from {table}
+) d
+where re.ctid = d.ctid
+    and d.n > 1
+;
+"""
+
+REBUILD_SUMMARY_SQL = f"""
+delete from {SCHEMA}.reported_ethnicity_summary
+where source_cid = cast(:source_cid as uuid);
+insert into {SCHEMA}.reported_ethnicity_summary
+(participant_id, ethnicity_cid, source_cid, eth_count, max_source_date)
+select participant_id
+    ,ethnicity_cid
+    ,source_cid
+    ,count(*)
+    ,max(source_date)
+from {TABLE}
+where source_cid = cast(:source_cid as uuid)
+group by participant_id, ethnicity_cid, source_cid;
+"""
+
+
+def create_load_tables(s, sources):
+    """
+    create an empty table, shaped like reported_ethnicity but with no
+    constraints or indexes, for each source being reloaded, in the session's
+    transaction so a failed load rolls them back
+    :params s: SQLAlchemy session bound to required engines
+    :params sources: list of the codes of the sources being reloaded
+    :returns: dictionary of source code: load table name
+    """
+
+    con = database.get_div_db_connection(s)
+
+    for x in REQUIRED_INDEXES:
+
+        con.execute(x)
+
+    tables = {}
+
+    for x in sources:
+
+        partition = con.execute(text(PARTITION_NAME_SQL),
+                                {'source': x}).scalar()
+        table = f'{SCHEMA}.{partition}_load'
+
+        con.execute(f'drop table if exists {table};')
+        con.execute(f'create table {table} (like {TABLE} including defaults);')
+        tables[x] = table
+
+    return tables
+
+
+def swap_source_partitions(c, tables):
+    """
+    index the loaded tables and swap each one in as its source's partition,
+    once the load has been committed
+    :params c: a Config class instance
+    :params tables: dictionary of source code: load table name, as returned
+    by create_load_tables
+    """
+
+    e = database.get_engine(c.div_db_conn_str, c)
+    start = time.perf_counter()
+
+    with e.connect() as con:
+
+        indexes = con.execute(INDEXES_SQL).mappings().all()
+
+    # partitions are matched up with the parent's indexes when attached, so
+    # building the same indexes first leaves nothing to build while the
+    # parent is locked
+    definitions = [f'create {"unique " if x["is_unique"] else ""}index if '
+                   f'not exists {t.split(".")[-1]}_idx{i} on {t} '
+                   f'({x["columns"]});'
+                   for t in tables.values()
+                   for i, x in enumerate(indexes)]
+
+    try:
+
+        build_indexes(c, e, definitions)
+
+    except exc.IntegrityError:
+
+        # a failed build leaves no index behind, and any that succeeded are
+        # skipped on the retry
+        with e.begin() as con:
+
+            for x in tables.values():
+
+                n = con.execute(DEDUPE_SQL.format(table=x)).rowcount
+                LOGGER.warning(f'removed {n} duplicate rows from {x}')
+
+        build_indexes(c, e, definitions)
+
+    # a partition's index is only matched up with the parent's primary key
+    # if it backs a primary key too
+    with e.begin() as con:
+
+        for t in tables.values():
+
+            for i, x in enumerate(indexes):
+
+                if x['is_primary']:
+
+                    name = f'{t.split(".")[-1]}_idx{i}'
+                    con.execute(f'alter table {t} add constraint {name} '
+                                f'primary key using index {name};')
+
+    # all sources are swapped in one transaction, so readers see either the
+    # old data or the new
+    with e.begin() as con:
+
+        swapped = [swap_source_partition(con, source, table)
+                   for source, table in tables.items()]
+
+    # the old partitions are dropped once the swap is committed, as dropping
+    # them locks the tables their foreign keys reference, and the new
+    # partitions' indexes can then take their names
+    for partition, old in swapped:
+
+        with e.begin() as con:
+
+            if old:
+
+                con.execute(f'drop table {SCHEMA}.{old};')
+
+            for i in range(len(indexes)):
+
+                con.execute(f'alter index {SCHEMA}.{partition}_load_idx{i} '
+                            f'rename to {partition}_idx{i};')
+
+            con.execute(f'analyze {SCHEMA}.{partition};')
+
+    with e.begin() as con:
+
+        con.execute(f'analyze {SCHEMA}.reported_ethnicity_summary;')
+        con.execute(f'analyze {SCHEMA}.participant;')
+
+    LOGGER.info(f'swapped in {len(tables)} reloaded sources in '
+                f'{time.perf_counter() - start:.1f}s')
+
+
+def swap_source_partition(con, source, table):
+    """
+    replace a source's partition with a loaded and indexed table
+    :params con: SQLAlchemy connection in the swap transaction
+    :params source: the source code
+    :params table: the load table name
+    :returns: tuple of the partition name and the name the detached old
+    partition was moved to, None if there wasn't one
+    """
+
+    partition = con.execute(text(PARTITION_NAME_SQL),
+                            {'source': source}).scalar()
+    source_cid = con.execute(text(SOURCE_CID_SQL), {'source': source}).\
+        scalar()
+    old = con.execute(text(PARTITION_SQL), {'source': source}).scalar()
+
+    # proves the rows belong in the partition, so attaching doesn't scan
+    # the table to check
+    con.execute(f"alter table {table} add constraint {partition}_load_check "
+                f"check (source_cid = '{source_cid}');")
+
+    if old:
+
+        con.execute(f'alter table {TABLE} detach partition {SCHEMA}.{old};')
+        con.execute(f'alter table {SCHEMA}.{old} rename to {partition}_old;')
+        old = f'{partition}_old'
+
+    else:
+
+        # the source's rows are in the default partition
+        con.execute(text(f'delete from {TABLE} '
+                         f'where source_cid = cast(:source_cid as uuid);'),
+                    {'source_cid': source_cid})
+
+    # the foreign keys are added and validated as the table is attached
+    con.execute(f"alter table {TABLE} attach partition {table} "
+                f"for values in ('{source_cid}');")
+    con.execute(f'alter table {table} drop constraint {partition}_load_check;')
+    con.execute(f'alter table {table} rename to {partition};')
+
+    # the load table had no triggers, so the source's summary is rebuilt
+    con.execute(text(REBUILD_SUMMARY_SQL), {'source_cid': source_cid})
+
+    LOGGER.info(f'swapped in new {source} partition {partition}')
+
+    return partition, old
+
+
+def build_indexes(c, e, definitions):
+    """
+    run index definitions in parallel, each on its own connection
+    :params c: a Config class instance
+    :params e: the diversity db's engine
+    :params definitions: list of create index if not exists statements
+    """
+
+    def build(sql):
+
+        start = time.perf_counter()
+
+        with e.begin() as con:
+
+            con.execute(sql)
+
+        LOGGER.info(f'built index in {time.perf_counter() - start:.1f}s: '
+                    f'{sql}')
+
+    with ThreadPoolExecutor(max_workers=c.index_build_workers) as ex:
+
+        # raise the first error once all the builds have finished
+        for f in [ex.submit(build, x) for x in definitions]:
+
+            f.result()
@@ -0,0 +1,77 @@
+"""
+functions for reading the feed of changes to participants' best ethnicities
+that each ETL run logs in best_ethnicity_change
+the feed is in the order the runs committed, given by their finish_seq, as
+a run that started earlier can finish later, and is paged by (finish_seq,
+participant_id), so each page starts where the last one ended with index
+range scans, however far into the feed it is, and consumers keep the latest
+finish_seq they have read to ask for only the changes since
+"""
+
+import logging
+from sqlalchemy import text
+from modules import database
+
+LOGGER = logging.getLogger(__name__)
+
+# number of changes read per page
+CHANGES_PAGE_SIZE = 10000
+
+CHANGES_COLUMNS = ['finish_seq', 'run_id', 'participant_id', 'change_type',
+                   'old_best_ethnicity_code', 'new_best_ethnicity_code']
+
+# only finished runs, as a run's changes are committed as it finishes, a
+# null finish_seq never compares greater
+CHANGES_SQL = f"""
+select r.finish_seq, {', '.join(f'c.{x}' for x in CHANGES_COLUMNS[1:])}
+from ethnicity_store.best_ethnicity_change c
+join ethnicity_store.etl_run r
+    on r.run_id = c.run_id
+where (r.finish_seq, c.participant_id) >
+    (cast(:after_finish_seq as bigint),
+     cast(:after_participant_id as varchar))
+order by r.finish_seq, c.participant_id
+limit :page_size
+;
+"""
+
+
+def get_changes(s, since=0, page_size=CHANGES_PAGE_SIZE):
+    """
+    read the changes logged by the runs that finished after a run, a page at
+    a time
+    :params s: SQLAlchemy session bound to required engines
+    :params since: finish_seq of the last run already read, 0 for every run
+    :params page_size: number of changes read per query
+    :returns: generator of lists of row mappings, with the CHANGES_COLUMNS
+    """
+
+    con = database.get_div_db_connection(s)
+
+    # the first page starts at the run after since, as every participant id
+    # sorts after the empty string
+    after = (since + 1, '')
+    n = 0
+
+    while True:
+
+        page = con.execute(text(CHANGES_SQL),
+                           {'after_finish_seq': after[0],
+                            'after_participant_id': after[1],
+                            'page_size': page_size}).mappings().all()
+
+        if not page:
+
+            break
+
+        n += len(page)
+        after = (page[-1]['finish_seq'], page[-1]['participant_id'])
+
+        yield page
+
+        if len(page) < page_size:
+
+            break
+
+    LOGGER.info('read %d best ethnicity changes since finish_seq %s', n,
+                since)
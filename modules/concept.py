@@ -4,12 +4,173 @@ functions for working with the concept data
 
 import csv
 import logging
-from classes.diversity_db import Concept
+from sqlalchemy import text
+from classes import diversity_db
 
 CONCEPT_DATA_FP = 'resources/concept_codes.csv'
 
 LOGGER = logging.getLogger(__name__)
 
+# fingerprint of the whole concept table, changes whenever a concept is
+# added, removed or recreated with a new uid
+VERSION_SQL = """
+select md5(coalesce(string_agg(uid::text || ':' || codesystem || ':' ||
+                               concept_code, ',' order by uid), ''))
+from ethnicity_store.concept
+"""
+
+# uids are read as text, as the ORM's uid columns are
+CONCEPT_SQL = """
+select uid::text as uid
+    ,codesystem
+    ,concept_code
+from ethnicity_store.concept
+;
+"""
+
+
+class ConceptCache:
+    """
+    holds every concept in memory so that codes can be converted to uids,
+    and back, without querying the concept table each time
+    the cache is loaded on first use and kept until invalidated, check
+    reloads it if the concept table has changed since
+    """
+
+    def __init__(self):
+        """
+        create new, empty, ConceptCache
+        """
+
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        empty the cache so it is reloaded when next used
+        """
+
+        self.version = None
+        self.uids = {}
+        self.codes = {}
+
+    def load(self, s):
+        """
+        load all codesystems from the concept table in a single query
+        :params s: SQLAlchemy session bound to required engines
+        """
+
+        # the version is read first, so a change made while the rows are
+        # read is picked up by the next check, and an empty table still has
+        # a version of its own
+        version = self.read_version(s)
+        res = s.execute(text(CONCEPT_SQL),
+                        bind_arguments={'mapper': diversity_db.Concept})
+
+        uids = {}
+        codes = {}
+
+        for x in res:
+
+            uids.setdefault(x.codesystem, {})[x.concept_code] = x.uid
+            codes[x.uid] = (x.codesystem, x.concept_code)
+
+        self.uids = uids
+        self.codes = codes
+        self.version = version
+
+        LOGGER.debug('loaded %d concepts into the concept cache', len(codes))
+
+    def get(self, s):
+        """
+        get the cache, loading it if it is empty
+        :params s: SQLAlchemy session bound to required engines
+        :returns: the ConceptCache
+        """
+
+        if self.version is None:
+
+            self.load(s)
+
+        return self
+
+    def check(self, s):
+        """
+        compare the cache with the concept table, reloading it if the table
+        has changed since it was loaded
+        :params s: SQLAlchemy session bound to required engines
+        :returns: the ConceptCache
+        """
+
+        if self.read_version(s) != self.version:
+
+            LOGGER.info('concept table has changed, reloading concept cache')
+            self.load(s)
+
+        return self
+
+    @staticmethod
+    def read_version(s):
+        """
+        read the concept table's current version
+        :params s: SQLAlchemy session bound to required engines
+        :returns: md5 fingerprint of the concept table
+        """
+
+        return s.execute(text(VERSION_SQL),
+                         bind_arguments={'mapper': diversity_db.Concept}).\
+            scalar()
+
+    def get_uids(self, codesystem):
+        """
+        get the concepts of a codesystem
+        :params codesystem: the codesystem
+        :returns: dictionary of concept_code: uid
+        """
+
+        return self.uids.get(codesystem, {})
+
+    def get_uid(self, codesystem, concept_code):
+        """
+        get the uid of a concept
+        :params codesystem: the codesystem
+        :params concept_code: the concept code
+        :returns: the uid, None if there is no such concept
+        """
+
+        return self.get_uids(codesystem).get(concept_code)
+
+    def get_codes(self, codesystem):
+        """
+        get the uids of a codesystem
+        :params codesystem: the codesystem
+        :returns: dictionary of uid: concept_code
+        """
+
+        return {v: k for k, v in self.get_uids(codesystem).items()}
+
+    def get_code(self, uid):
+        """
+        get the concept code for a uid
+        :params uid: the concept uid
+        :returns: the concept code, None if there is no such concept
+        """
+
+        return self.codes.get(uid, (None, None))[1]
+
+
+# shared by everything in the process that converts between codes and uids
+CONCEPT_CACHE = ConceptCache()
+
+
+def get_concept_cache(s):
+    """
+    get the process-wide concept cache, loading it if it is empty
+    :params s: SQLAlchemy session bound to required engines
+    """
+
+    return CONCEPT_CACHE.get(s)
+
+
 def populate_concept_table(s):
     """
     write all the concept data to the concept table
@@ -30,15 +191,30 @@ def populate_concept_table(s):
 
         s.commit()
 
+    CONCEPT_CACHE.invalidate()
+    create_source_partitions(s)
+
     LOGGER.info(f'Added {line_count} rows to concept table')
 
 
+def create_source_partitions(s):
+    """
+    create a reported_ethnicity partition for each source concept that
+    doesn't have one
+    :params s: SQLAlchemy session bound to required engine
+    """
+
+    s.execute(text('select ethnicity_store.create_source_partitions();'),
+              bind_arguments={'mapper': diversity_db.Concept})
+    s.commit()
+
+
 def create_concept_row(s, concept_code, codesystem, description=None):
     """
     create a new row in the concept table
     """
 
-    a = Concept(
+    a = diversity_db.Concept(
         concept_code=concept_code,
         codesystem=codesystem,
         description=description
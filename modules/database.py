@@ -4,15 +4,28 @@ module to provide functions for creating and accessing the databases
 
 import logging
 import os
+import threading
 from sqlalchemy.orm import sessionmaker
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event, text
 import sqlparse
 from classes import diversity_db
+from modules import concept, metrics
 
 LOGGER = logging.getLogger(__name__)
 
+# process-wide registry of engines, and their pool metrics, keyed by
+# connection string so every caller shares the same warm connection pool
+ENGINES = {}
+POOL_METRICS = {}
+
+# guards the registry, so threads asking for the same engine at once don't
+# each create one, and leave a pool that is never disposed
+ENGINES_LOCK = threading.Lock()
+
 DIVERSITY_DB_CREATION_SCRIPT_FP = [
     os.path.abspath('resources/sql_scripts/ethnicity_store.sql'),
+    os.path.abspath('resources/sql_scripts/reported_ethnicity_summary.sql'),
+    os.path.abspath('resources/sql_scripts/source_partitions.sql'),
     os.path.abspath('resources/sql_scripts/vw_participant_ethnicity.sql'),
 ]
 
@@ -25,7 +38,7 @@ def assemble_binds(config):
 
     binds = {}
 
-    binds[diversity_db.BASE] = get_engine(config.div_db_conn_str)
+    binds[diversity_db.BASE] = get_engine(config.div_db_conn_str, config)
             
     return binds
 
@@ -43,20 +56,106 @@ def make_session(config):
     return session()
 
 
-def get_engine(conn_str):
+def get_div_db_connection(s):
+    """
+    get the connection a session uses for the diversity db, so that sql run
+    outside the ORM is part of the session's transaction
+    :params s: SQLAlchemy session made by make_session
+    """
+
+    return s.connection(bind_arguments={'mapper': diversity_db.Concept})
+
+
+def get_engine(conn_str, c=None):
     """
-    Get an engine for a db
+    Get an engine for a db, engines are created once per connection string
+    and then reused along with their connection pools
     :param conn_str: the connection string for teh db
+    :param c: a Config class instance giving the pool settings, only used
+    when the engine is first created
     """
 
-    return create_engine(conn_str, echo=False)
+    with ENGINES_LOCK:
+
+        if conn_str not in ENGINES:
 
+            pool_args = {
+                'pool_size': c.db_pool_size,
+                'max_overflow': c.db_max_overflow,
+                'pool_pre_ping': c.db_pool_pre_ping,
+                'pool_recycle': c.db_pool_recycle,
+            } if c else {}
+
+            e = create_engine(conn_str, echo=False, **pool_args)
+            POOL_METRICS[conn_str] = add_pool_listeners(e)
+            metrics.add_round_trip_listener(e)
+            ENGINES[conn_str] = e
+
+            LOGGER.debug('created engine for %r', e.url)
+
+        return ENGINES[conn_str]
+
+
+def add_pool_listeners(e):
+    """
+    count connections made and checked in and out of an engine's pool
+    :params e: the db's engine
+    :returns: dictionary of counts, updated as the pool is used
+    """
 
-def run_sql_query(e, sql):
+    m = {'connects': 0, 'checkouts': 0, 'checkins': 0}
+
+    def on_event(name):
+
+        def count(*args):
+
+            m[name] += 1
+
+        return count
+
+    event.listen(e, 'connect', on_event('connects'))
+    event.listen(e, 'checkout', on_event('checkouts'))
+    event.listen(e, 'checkin', on_event('checkins'))
+
+    return m
+
+
+def pool_metrics():
+    """
+    get the pool metrics of every engine in the registry
+    :returns: dictionary of metrics keyed by the engine's url, with the
+    password masked
+    """
+
+    with ENGINES_LOCK:
+
+        return {repr(e.url): {**POOL_METRICS[k],
+                              'checked_out': e.pool.checkedout(),
+                              'size': e.pool.size()}
+                for k, e in ENGINES.items()}
+
+
+def dispose_engines():
+    """
+    close the connection pools of every engine in the registry and empty it
+    """
+
+    with ENGINES_LOCK:
+
+        for e in ENGINES.values():
+
+            e.dispose()
+
+        ENGINES.clear()
+        POOL_METRICS.clear()
+
+
+def run_sql_query(e, sql, params=None):
     """
     run a sql query on an engine
     :params e: the db's engine
     :params sql: the sql query string
+    :params params: optional dictionary of values for :name bind parameters
     """
 
     clean_lines = sqlparse.format(sql, strip_comments=True)
@@ -65,12 +164,53 @@ def run_sql_query(e, sql):
     with e.connect() as db_con:
 
         # execute then close down
-        res = db_con.execute(clean_lines)
+        res = _execute(db_con, clean_lines, params)
         db_con.close()
 
     return res
 
 
+def stream_sql_query(e, sql, chunk_size, params=None):
+    """
+    run a sql query on an engine through a server-side cursor, yielding the
+    result in chunks so the whole result is never held in memory
+    :params e: the db's engine
+    :params sql: the sql query string
+    :params chunk_size: number of rows to fetch per chunk
+    :params params: optional dictionary of values for :name bind parameters
+    :returns: generator of lists of row mappings
+    """
+
+    clean_lines = sqlparse.format(sql, strip_comments=True)
+
+    # the connection has to stay open for as long as the cursor is read
+    with e.connect() as db_con:
+
+        res = _execute(db_con.execution_options(stream_results=True,
+                                                max_row_buffer=chunk_size),
+                       clean_lines, params)
+
+        for chunk in res.mappings().partitions(chunk_size):
+
+            yield chunk
+
+
+def _execute(db_con, sql, params):
+    """
+    execute sql on a connection, only binding parameters when there are some
+    so plain scripts are passed through untouched
+    :params db_con: the db connection
+    :params sql: the sql query string
+    :params params: dictionary of values for :name bind parameters, or None
+    """
+
+    if params:
+
+        return db_con.execute(text(sql), params)
+
+    return db_con.execute(sql)
+
+
 def run_sql_file(e, fp):
     """
     run a sql file on an engine
@@ -93,11 +233,14 @@ def create_diversity_db(c):
 
     LOGGER.info("creating diversity db")
 
-    e = get_engine(c.div_db_conn_str)
+    e = get_engine(c.div_db_conn_str, c)
 
     for q in DIVERSITY_DB_CREATION_SCRIPT_FP:
         run_sql_file(e, q)
 
+    # any concepts cached from a previous diversity db are no longer valid
+    concept.CONCEPT_CACHE.invalidate()
+
 
 def drop_diversity_db(c):
     """
@@ -107,8 +250,10 @@ def drop_diversity_db(c):
 
     LOGGER.info("dropping the diversity db")
 
-    e = get_engine(c.div_db_conn_str)
+    e = get_engine(c.div_db_conn_str, c)
 
     sql = """drop schema ethnicity_store cascade;"""
     run_sql_query(e, sql)
 
+    concept.CONCEPT_CACHE.invalidate()
+
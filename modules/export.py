@@ -0,0 +1,209 @@
+"""
+functions for exporting the best ethnicities and reported ethnicities to
+files
+rows are streamed, with COPY TO STDOUT for csv and through a server-side
+cursor a row group at a time for parquet, so memory use doesn't grow with
+the size of the export, and every file in an export is read from the same
+snapshot of the db
+"""
+
+import contextlib
+import gzip
+import logging
+import os
+import time
+from modules import database
+
+LOGGER = logging.getLogger(__name__)
+
+# the queries each export reads, with the parquet type of each column
+EXPORTS = {
+    'best_ethnicity': {
+        'sql': """
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.participant_best_ethnicity
+order by participant_id
+""",
+        # computed from the reported ethnicities as they are now
+        'live_sql': """
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.vw_participant_ethnicity
+order by participant_id
+""",
+        'columns': {'participant_id': 'string',
+                    'best_ethnicity_code': 'string'},
+    },
+    'reported_ethnicity': {
+        'sql': """
+select re.participant_id
+    ,ec.concept_code as ethnicity_code
+    ,sc.concept_code as source
+    ,re.source_date
+from ethnicity_store.reported_ethnicity re
+join ethnicity_store.concept ec
+    on ec.uid = re.ethnicity_cid
+join ethnicity_store.concept sc
+    on sc.uid = re.source_cid
+order by re.participant_id, re.source_date
+""",
+        'columns': {'participant_id': 'string', 'ethnicity_code': 'string',
+                    'source': 'string', 'source_date': 'date32'},
+    },
+}
+
+FORMATS = ['csv', 'parquet']
+
+# rows per parquet row group
+ROW_GROUP_SIZE = 100000
+
+
+def export(c, names=None, out_dir='.', fmt='csv', compress=False,
+           live=False):
+    """
+    export to files from a single repeatable read, read only, transaction
+    :params c: a Config class instance
+    :params names: list of the exports to run, all if None
+    :params out_dir: directory the files are written to
+    :params fmt: 'csv' or 'parquet'
+    :params compress: gzip csv files, zstd compress parquet files
+    :params live: export the best ethnicities from vw_participant_ethnicity
+    rather than the materialised participant_best_ethnicity table
+    :returns: list of the filepaths written
+    """
+
+    names = list(EXPORTS) if names is None else names
+    unknown = set(names) - set(EXPORTS)
+
+    if unknown:
+
+        raise ValueError(f'unrecognised exports: '
+                         f'{", ".join(sorted(unknown))}')
+
+    if fmt not in FORMATS:
+
+        raise ValueError(f'unrecognised format: {fmt}')
+
+    fps = []
+
+    with read_snapshot(c) as con:
+
+        for x in names:
+
+            start = time.perf_counter()
+            sql = EXPORTS[x].get('live_sql' if live else 'sql',
+                                 EXPORTS[x]['sql'])
+            fp = os.path.join(out_dir, get_filename(x, fmt, compress))
+
+            if fmt == 'csv':
+
+                copy_csv(con.connection, sql, fp, compress)
+
+            else:
+
+                write_parquet(con.connection, sql, EXPORTS[x]['columns'], fp,
+                              compress)
+
+            LOGGER.info('exported %s to %s in %.1fs', x, fp,
+                        time.perf_counter() - start)
+            fps.append(fp)
+
+    return fps
+
+
+@contextlib.contextmanager
+def read_snapshot(c):
+    """
+    open a repeatable read, read only, transaction on the diversity db, so
+    everything read in it comes from the same snapshot
+    :params c: a Config class instance
+    :returns: context manager giving the SQLAlchemy connection
+    """
+
+    e = database.get_engine(c.div_db_conn_str, c)
+
+    with e.connect().execution_options(isolation_level='REPEATABLE READ') \
+            as con:
+
+        with con.begin():
+
+            # the snapshot is taken by the first query after this
+            con.execute('set transaction read only;')
+
+            yield con
+
+
+def get_filename(name, fmt, compress):
+    """
+    get the filename of an export
+    :params name: the export
+    :params fmt: 'csv' or 'parquet'
+    :params compress: is the file compressed?
+    :returns: the filename
+    """
+
+    # parquet is compressed inside the file
+    return f'{name}.{fmt}{".gz" if compress and fmt == "csv" else ""}'
+
+
+def copy_csv(dbapi_con, sql, fp, compress):
+    """
+    stream a query's result into a csv file with a header, through COPY
+    :params dbapi_con: psycopg2 connection in the export transaction
+    :params sql: the query
+    :params fp: the filepath written to
+    :params compress: gzip the file
+    """
+
+    with (gzip.open(fp, 'wb') if compress else open(fp, 'wb')) as f:
+
+        cur = dbapi_con.cursor()
+        cur.copy_expert(f'copy ({sql}) to stdout with (format csv, header)',
+                        f)
+        cur.close()
+
+
+def write_parquet(dbapi_con, sql, columns, fp, compress):
+    """
+    stream a query's result into a parquet file, a row group at a time,
+    through a server-side cursor
+    :params dbapi_con: psycopg2 connection in the export transaction
+    :params sql: the query
+    :params columns: dictionary of column name: pyarrow type name
+    :params fp: the filepath written to
+    :params compress: zstd compress the file
+    :returns: the number of rows written
+    """
+
+    # only parquet exports need pyarrow
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    schema = pa.schema([(k, getattr(pa, v)()) for k, v in columns.items()])
+
+    # named cursors are server-side
+    cur = dbapi_con.cursor(name='export')
+    cur.itersize = ROW_GROUP_SIZE
+    cur.execute(sql)
+    n = 0
+
+    with pq.ParquetWriter(fp, schema,
+                          compression='zstd' if compress else 'none') as w:
+
+        while True:
+
+            rows = cur.fetchmany(ROW_GROUP_SIZE)
+
+            if not rows:
+
+                break
+
+            n += len(rows)
+            w.write_table(pa.Table.from_arrays(
+                [pa.array(x, type=schema.field(i).type)
+                 for i, x in enumerate(zip(*rows))], schema=schema))
+
+    cur.close()
+
+    return n
@@ -0,0 +1,157 @@
+"""
+functions for the fingerprint of each participant's rows from each source,
+a hash of the participant's distinct (ethnicity code, source date) pairs,
+leaving out codes that aren't in the concept table, as their rows are
+skipped by the load, so adding the concept changes the fingerprint and the
+rows are loaded by the next full run
+a full run compares the fingerprints of the rows it extracts with those
+stored by the last run, and skips the participants that match, as their rows
+are already loaded, so only participants that have changed are written and
+refreshed
+fingerprints are only stored by runs that see all of a participant's rows,
+and a source's are cleared whenever its rows are replaced, so a stored
+fingerprint only ever describes rows that are in reported_ethnicity
+"""
+
+import hashlib
+import logging
+from sqlalchemy import text
+from modules import database, run_state
+
+LOGGER = logging.getLogger(__name__)
+
+# number of participant ids bound per statement
+FINGERPRINT_BATCH_SIZE = 10000
+
+READ_FINGERPRINTS_SQL = """
+select participant_id
+    ,fingerprint
+from ethnicity_store.participant_source_fingerprint
+where source_cid = cast(:source_cid as uuid)
+    and participant_id = any(:pids)
+;
+"""
+
+SAVE_FINGERPRINTS_SQL = """
+insert into ethnicity_store.participant_source_fingerprint
+(participant_id, source_cid, fingerprint)
+select unnest(cast(:pids as varchar[]))
+    ,cast(:source_cid as uuid)
+    ,unnest(cast(:fingerprints as varchar[]))
+on conflict (participant_id, source_cid) do update
+set fingerprint = excluded.fingerprint
+    ,updated_at = now()
+;
+"""
+
+CLEAR_FINGERPRINTS_SQL = """
+delete from ethnicity_store.participant_source_fingerprint
+where source_cid = cast(:source_cid as uuid)
+;
+"""
+
+
+def get_fingerprint(rows, codes=None):
+    """
+    hash a participant's rows, ignoring their order and any duplicates
+    :params rows: list of the participant's row mappings with ethnicity_code
+    and source_date
+    :params codes: set of the ethnicity codes that can be loaded, rows with
+    any other code are left out, all rows are hashed if None
+    :returns: the fingerprint, as a hex string
+    """
+
+    h = hashlib.blake2b(digest_size=16)
+
+    for code, date in sorted({(str(x['ethnicity_code']),
+                               str(x['source_date'])) for x in rows
+                              if codes is None or
+                              x['ethnicity_code'] in codes}):
+
+        h.update(f'{code}\t{date}\n'.encode())
+
+    return h.hexdigest()
+
+
+def get_fingerprints(rows, codes=None):
+    """
+    fingerprint each participant's rows
+    :params rows: list of row mappings with id, ethnicity_code and
+    source_date, holding all of each participant's rows
+    :params codes: set of the ethnicity codes that can be loaded, all rows
+    are hashed if None
+    :returns: dictionary of participant id: fingerprint
+    """
+
+    by_participant = {}
+
+    for x in rows:
+
+        by_participant.setdefault(x['id'], []).append(x)
+
+    return {k: get_fingerprint(v, codes) for k, v in by_participant.items()}
+
+
+def read_fingerprints(s, source, pids):
+    """
+    get the fingerprints stored for participants' rows from a source
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the code for the data source
+    :params pids: list of participant ids
+    :returns: dictionary of participant id: fingerprint, for the
+    participants that have one
+    """
+
+    con = database.get_div_db_connection(s)
+    source_cid = run_state.get_source_cid(s, source)
+    d = {}
+
+    for i in range(0, len(pids), FINGERPRINT_BATCH_SIZE):
+
+        d.update(con.execute(text(READ_FINGERPRINTS_SQL),
+                             {'source_cid': source_cid,
+                              'pids': pids[i:i + FINGERPRINT_BATCH_SIZE]}).
+                 all())
+
+    return d
+
+
+def save_fingerprints(s, source, fingerprints):
+    """
+    store the fingerprints of participants' loaded rows from a source, in
+    the session's transaction so they are committed with the rows
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the code for the data source
+    :params fingerprints: dictionary of participant id: fingerprint
+    """
+
+    con = database.get_div_db_connection(s)
+    source_cid = run_state.get_source_cid(s, source)
+    items = list(fingerprints.items())
+
+    for i in range(0, len(items), FINGERPRINT_BATCH_SIZE):
+
+        batch = items[i:i + FINGERPRINT_BATCH_SIZE]
+        con.execute(text(SAVE_FINGERPRINTS_SQL),
+                    {'source_cid': source_cid,
+                     'pids': [x[0] for x in batch],
+                     'fingerprints': [x[1] for x in batch]})
+
+
+def clear_fingerprints(s, sources):
+    """
+    remove the stored fingerprints of sources, so their next full run loads
+    every participant
+    :params s: SQLAlchemy session bound to required engines
+    :params sources: list of the codes of the sources
+    """
+
+    con = database.get_div_db_connection(s)
+
+    for x in sources:
+
+        n = con.execute(text(CLEAR_FINGERPRINTS_SQL),
+                        {'source_cid': run_state.get_source_cid(s, x)}).\
+            rowcount
+
+        LOGGER.info('cleared %d %s fingerprints', n, x)
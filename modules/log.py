@@ -4,62 +4,164 @@ file handler is a timed rotating handler (rotating each day) and
 keeping backups for a week
 alternative would be rotatingfilehandler with some maxBytes so that we only
 keep a certain size of log, not certain time
+the handlers are run by a QueueListener on a background thread, so logging
+calls only merge the message and put the record on a queue, and the
+formatting and disk writes are kept off the ETL's hot loop
 """
+import atexit
+import copy
 import os
 import logging
-from logging.config import dictConfig
+import queue
+from logging.handlers import QueueHandler, QueueListener, \
+    TimedRotatingFileHandler
+
+FILE_FORMAT = '%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+FILE_DATEFMT = '%Y-%m-%d %H:%M:%S'
+CONSOLE_FORMAT = '%(name)s - %(levelname)s - %(message)s'
+
+# the listener running the handlers, stopped when logging is set up again
+LISTENER = None
+
+
+class LazyQueueHandler(QueueHandler):
+    """
+    queue handler that merges the message with its args as the record is
+    queued, so an arg changed after the call is logged as it was, but leaves
+    the rest of the formatting to the listener's handlers, QueueHandler
+    formats all of it in the logging thread so that it can be pickled, which
+    a queue between threads doesn't need
+    its level is set to the lowest of the handlers', so records none of them
+    would write are dropped before their message is merged
+    """
+
+    def prepare(self, record):
+
+        # copied, as any other handler of the record still needs its args
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+
+        return record
+
+
+class DebugRateFilter(logging.Filter):
+    """
+    drops debug records from a logger once it has logged more than rate of
+    them in the current second, so per-record debug logging on a hot path
+    is cut down to a sample, other levels always pass
+    """
+
+    def __init__(self, rate):
+        """
+        create new DebugRateFilter
+        :params rate: debug records allowed per logger per second, 0 for no
+        limit
+        """
+
+        super().__init__()
+        self.rate = rate
+        self.windows = {}
+        self.dropped = 0
+
+    def filter(self, record):
+
+        if record.levelno > logging.DEBUG or not self.rate:
+
+            return True
+
+        second = int(record.created)
+        window = self.windows.get(record.name)
+
+        if window is None or window[0] != second:
+
+            window = self.windows[record.name] = [second, 0]
+
+        window[1] += 1
+
+        if window[1] > self.rate:
+
+            self.dropped += 1
+
+            return False
+
+        return True
+
 
 def setup_logger(c):
     """
     set up logging handlers and formatters
     :params c: a config object that contains something to say whether we are
     in debug mode (consoldHandler level will be set to debug), and log_dir and
-    log_filenames
+    log_filenames, the root log level and the debug records allowed per
+    logger per second
     """
 
+    global LISTENER
+
     # set up log directory if it doesn't exist
     log_dir = c.log_folder
     if not os.path.exists(log_dir):
         os.mkdir(log_dir)
 
-    # log config
-    log_config = {
-        'version': 1,
-        'disable_existing_loggers': False,
-        'formatters': {
-            'fFormatter': {
-                'class': 'logging.Formatter',
-                'format': '%(asctime)s - %(name)s - %(levelname)s - %(message)s',
-                'datefmt': '%Y-%m-%d %H:%M:%S'
-            },
-            'cFormatter': {
-                'class': 'logging.Formatter',
-                'format': '%(name)s - %(levelname)s - %(message)s'
-            }
-        },
-        'handlers': {
-            'consoleHandler': {
-                'class': 'logging.StreamHandler',
-                'level': 'DEBUG' if c.debug else 'INFO',
-                'formatter': 'cFormatter'
-            },
-            'fileHandler': {
-                'class': 'logging.handlers.TimedRotatingFileHandler',
-                'filename': os.path.join(log_dir, c.log_filename),
-                'formatter': 'fFormatter',
-                'when': 'd',
-                'interval': 1,
-                'backupCount': 7
-            }
-        },
-        'root': {
-            'level': 'DEBUG',
-            'handlers': list(h for (h, b) in zip(
-                ['consoleHandler', 'fileHandler'],
-                [c.console_logging, c.file_logging]
-            ) if b)
-        }
-    }
-
-    # configure logging
-    dictConfig(log_config)
+    handlers = []
+
+    if c.console_logging:
+
+        h = logging.StreamHandler()
+        h.setLevel(logging.DEBUG if c.debug else logging.INFO)
+        h.setFormatter(logging.Formatter(CONSOLE_FORMAT))
+        handlers.append(h)
+
+    if c.file_logging:
+
+        h = TimedRotatingFileHandler(os.path.join(log_dir, c.log_filename),
+                                     when='d', interval=1, backupCount=7)
+        h.setFormatter(logging.Formatter(FILE_FORMAT, FILE_DATEFMT))
+        handlers.append(h)
+
+    # a logger set up earlier is flushed and replaced
+    stop_logger()
+
+    root = logging.getLogger()
+
+    for h in list(root.handlers):
+
+        root.removeHandler(h)
+        h.close()
+
+    # unbounded, so a logging call never waits on the listener
+    q = queue.SimpleQueue()
+    qh = LazyQueueHandler(q)
+    qh.setLevel(min((h.level for h in handlers),
+                    default=logging.CRITICAL + 1))
+    qh.addFilter(DebugRateFilter(c.log_debug_rate))
+
+    root.addHandler(qh)
+    root.setLevel(c.log_level)
+
+    LISTENER = QueueListener(q, *handlers, respect_handler_level=True)
+    LISTENER.start()
+
+
+def stop_logger():
+    """
+    write out any queued records, then stop the listener and close its
+    handlers
+    """
+
+    global LISTENER
+
+    if LISTENER:
+
+        LISTENER.stop()
+
+        for h in LISTENER.handlers:
+
+            h.close()
+
+        LISTENER = None
+
+
+# queued records are written before the interpreter exits
+atexit.register(stop_logger)
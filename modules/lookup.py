@@ -0,0 +1,193 @@
+"""
+functions for looking up the best ethnicity of a cohort of participants
+the ids are bound as a single array parameter, so thousands of participants
+are read from the materialised participant_best_ethnicity table in one
+round trip per batch, and the results are kept in a bounded LRU cache that
+is emptied whenever an ETL run completes
+"""
+
+import logging
+from collections import OrderedDict
+from sqlalchemy import text
+from modules import database
+
+LOGGER = logging.getLogger(__name__)
+
+# number of participant ids bound per statement
+LOOKUP_BATCH_SIZE = 10000
+
+# number of participants held in the cache
+LOOKUP_CACHE_SIZE = 100000
+
+LOOKUP_SQL = """
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.participant_best_ethnicity
+where participant_id = any(:pids)
+;
+"""
+
+# computes the best ethnicity from the reported ethnicities as they are now,
+# for participants whose materialised best ethnicity may be out of date
+LIVE_LOOKUP_SQL = """
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.participant_ethnicity(:pids)
+;
+"""
+
+# changes whenever an ETL run, or refresh, finishes
+RUN_VERSION_SQL = """
+select max(finish_seq)
+from ethnicity_store.etl_run
+;
+"""
+
+
+class LookupCache:
+    """
+    least recently used cache of participants' best ethnicities, tied to
+    the ETL run that was last completed when the results were read
+    """
+
+    def __init__(self, maxsize=LOOKUP_CACHE_SIZE):
+        """
+        create new, empty, LookupCache
+        :params maxsize: number of participants held before the least
+        recently used are dropped
+        """
+
+        self.maxsize = maxsize
+        self.invalidate()
+
+    def invalidate(self):
+        """
+        empty the cache
+        """
+
+        self.codes = OrderedDict()
+        self.version = None
+
+    def check(self, version):
+        """
+        empty the cache if an ETL run has completed since it was filled
+        :params version: the current ETL run version
+        """
+
+        if version != self.version:
+
+            self.invalidate()
+            self.version = version
+
+    def get(self, pids):
+        """
+        get the cached participants
+        :params pids: list of participant ids
+        :returns: tuple of dictionary of participant id: best ethnicity code
+        for the participants in the cache, and list of those that aren't
+        """
+
+        found = {}
+        missing = []
+
+        for x in pids:
+
+            if x in self.codes:
+
+                self.codes.move_to_end(x)
+                found[x] = self.codes[x]
+
+            else:
+
+                missing.append(x)
+
+        return found, missing
+
+    def put(self, codes):
+        """
+        add participants to the cache, dropping the least recently used
+        :params codes: dictionary of participant id: best ethnicity code
+        """
+
+        for k, v in codes.items():
+
+            self.codes[k] = v
+            self.codes.move_to_end(k)
+
+        while len(self.codes) > self.maxsize:
+
+            self.codes.popitem(last=False)
+
+
+LOOKUP_CACHE = LookupCache()
+
+
+def lookup(s, pids, live=False, cache=LOOKUP_CACHE):
+    """
+    get the best ethnicity of a cohort of participants
+    :params s: SQLAlchemy session bound to required engines
+    :params pids: iterable of participant ids
+    :params live: compute the best ethnicity from the reported ethnicities
+    rather than reading the materialised table, bypassing the cache
+    :params cache: the LookupCache to use, None to not cache
+    :returns: dictionary of participant id: best ethnicity code, None for
+    participants with no best ethnicity
+    """
+
+    con = database.get_div_db_connection(s)
+    pids = list(dict.fromkeys(pids))
+
+    if live:
+
+        return {x: None for x in pids} | read(con, LIVE_LOOKUP_SQL, pids)
+
+    if cache is None:
+
+        return {x: None for x in pids} | read(con, LOOKUP_SQL, pids)
+
+    cache.check(con.execute(RUN_VERSION_SQL).scalar())
+    found, missing = cache.get(pids)
+
+    if missing:
+
+        codes = {x: None for x in missing} | read(con, LOOKUP_SQL, missing)
+        cache.put(codes)
+        found.update(codes)
+
+    LOGGER.debug('looked up %d participants, %d from the cache', len(pids),
+                 len(pids) - len(missing))
+
+    return {x: found[x] for x in pids}
+
+
+def read(con, sql, pids):
+    """
+    run a lookup query in batches of ids
+    :params con: SQLAlchemy connection to the diversity db
+    :params sql: query with a :pids array parameter
+    :params pids: list of participant ids
+    :returns: dictionary of participant id: best ethnicity code for the
+    participants found
+    """
+
+    codes = {}
+
+    for i in range(0, len(pids), LOOKUP_BATCH_SIZE):
+
+        codes.update(con.execute(text(sql),
+                                 {'pids': pids[i:i + LOOKUP_BATCH_SIZE]}).
+                     all())
+
+    return codes
+
+
+def read_ids(fp):
+    """
+    read participant ids from a file, one per line, ignoring blank lines
+    :params fp: filepath of the id file
+    :returns: list of participant ids
+    """
+
+    with open(fp, 'r') as f:
+
+        return [x.strip() for x in f if x.strip()]
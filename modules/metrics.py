@@ -0,0 +1,311 @@
+"""
+stage timers and counters for ETL runs
+each run records the time spent in, and rows through, its extract,
+transform, load and commit stages, the statements sent to the db and the
+peak memory used, which are logged at the end of the run and appended to a
+metrics file as a line of JSON
+statements run in partitioned extraction's worker processes aren't counted
+statements are counted for the run and for the thread that sent them, and
+a stage only counts its own thread's, as stages on other threads overlap it
+"""
+
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import logging
+import pstats
+import resource
+import threading
+import time
+from sqlalchemy import event
+
+LOGGER = logging.getLogger(__name__)
+
+
+class RunMetrics:
+    """
+    the timings and counts of a single run
+    """
+
+    def __init__(self):
+        """
+        create new, empty, RunMetrics starting now
+        """
+
+        self.started_at = datetime.datetime.now()
+        self.start = time.perf_counter()
+        self.stages = {}
+        self.counters = {}
+        self.round_trips = 0
+
+        # extraction threads record into the same metrics as the load
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def add_round_trips(self, n=1):
+        """
+        count statements sent to a db
+        :params n: number of statements
+        """
+
+        with self.lock:
+
+            self.round_trips += n
+
+        self.local.round_trips = self.thread_round_trips() + n
+
+    def thread_round_trips(self):
+        """
+        get the number of statements the current thread has sent to a db
+        :returns: the number of statements
+        """
+
+        return getattr(self.local, 'round_trips', 0)
+
+    def count(self, name, n=1):
+        """
+        add to a counter
+        :params name: the counter
+        :params n: amount to add
+        """
+
+        with self.lock:
+
+            self.counters[name] = self.counters.get(name, 0) + n
+
+    def record(self, name, seconds, rows_in=0, rows_out=0, round_trips=0):
+        """
+        add a call of a stage to its totals
+        :params name: the stage
+        :params seconds: time spent in the call
+        :params rows_in: rows passed into the call
+        :params rows_out: rows produced by the call
+        :params round_trips: statements sent to a db during the call
+        """
+
+        with self.lock:
+
+            d = self.stages.setdefault(name, {'calls': 0, 'seconds': 0.0,
+                                              'rows_in': 0, 'rows_out': 0,
+                                              'round_trips': 0})
+            d['calls'] += 1
+            d['seconds'] += seconds
+            d['rows_in'] += rows_in
+            d['rows_out'] += rows_out
+            d['round_trips'] += round_trips
+
+    @contextlib.contextmanager
+    def stage(self, name, rows_in=0):
+        """
+        time a call of a stage
+        :params name: the stage
+        :params rows_in: rows passed into the call
+        :returns: context manager giving a dictionary, its rows_out can be
+        set to the rows produced, otherwise it is taken to be rows_in
+        """
+
+        d = {'rows_out': rows_in}
+        round_trips = self.thread_round_trips()
+        start = time.perf_counter()
+
+        try:
+
+            yield d
+
+        finally:
+
+            self.record(name, time.perf_counter() - start, rows_in,
+                        d['rows_out'],
+                        self.thread_round_trips() - round_trips)
+
+    def timed(self, name, chunks):
+        """
+        time the production of each chunk of an iterable as a call of a
+        stage
+        :params name: the stage
+        :params chunks: iterable of lists of rows
+        :returns: generator of the same chunks
+        """
+
+        it = iter(chunks)
+
+        while True:
+
+            round_trips = self.thread_round_trips()
+            start = time.perf_counter()
+
+            try:
+
+                chunk = next(it)
+
+            except StopIteration:
+
+                self.record(name, time.perf_counter() - start,
+                            round_trips=(self.thread_round_trips() -
+                                         round_trips))
+
+                return
+
+            self.record(name, time.perf_counter() - start,
+                        rows_out=len(chunk),
+                        round_trips=self.thread_round_trips() - round_trips)
+
+            yield chunk
+
+    def summary(self):
+        """
+        get the run's metrics
+        :returns: dictionary of the run's metrics
+        """
+
+        with self.lock:
+
+            stages = {k: {**v, 'rows_per_s':
+                          max(v['rows_in'], v['rows_out']) / v['seconds']
+                          if v['seconds'] else 0}
+                      for k, v in self.stages.items()}
+
+        return {'started_at': self.started_at.isoformat(timespec='seconds'),
+                'seconds': time.perf_counter() - self.start,
+                'round_trips': self.round_trips,
+                'peak_rss_mb': get_peak_rss_mb(),
+                'stages': stages,
+                'counters': dict(self.counters)}
+
+    def log(self):
+        """
+        log the run's metrics
+        :returns: dictionary of the run's metrics
+        """
+
+        d = self.summary()
+
+        for k, v in d['stages'].items():
+
+            LOGGER.info(f'{k}: {v["calls"]} calls, {v["seconds"]:.1f}s, '
+                        f'{v["rows_in"]} rows in, {v["rows_out"]} rows out, '
+                        f'{v["rows_per_s"]:.0f} rows/s, '
+                        f'{v["round_trips"]} round trips')
+
+        LOGGER.info(f'run took {d["seconds"]:.1f}s, {d["round_trips"]} round '
+                    f'trips, peak rss {d["peak_rss_mb"]:.0f}MB')
+
+        return d
+
+    def write(self, fp, **kwargs):
+        """
+        append the run's metrics to a file as a line of JSON
+        :params fp: filepath of the metrics file
+        :params kwargs: anything else to record with the metrics, such as
+        the run's arguments
+        """
+
+        with open(fp, 'a') as f:
+
+            f.write(json.dumps({**kwargs, **self.summary()}, default=str) +
+                    '\n')
+
+
+# the metrics of the current run
+METRICS = RunMetrics()
+
+
+def start_run():
+    """
+    start recording a new run's metrics
+    :returns: the new RunMetrics
+    """
+
+    global METRICS
+    METRICS = RunMetrics()
+
+    return METRICS
+
+
+def stage(name, rows_in=0):
+    """
+    time a call of a stage of the current run, see RunMetrics.stage
+    """
+
+    return METRICS.stage(name, rows_in)
+
+
+def timed(name, chunks):
+    """
+    time the production of each chunk as a call of a stage of the current
+    run, see RunMetrics.timed
+    """
+
+    return METRICS.timed(name, chunks)
+
+
+def count(name, n=1):
+    """
+    add to a counter of the current run
+    """
+
+    METRICS.count(name, n)
+
+
+def add_round_trips(n=1):
+    """
+    count statements sent to a db outside SQLAlchemy's execution, such as a
+    COPY on the raw connection
+    """
+
+    METRICS.add_round_trips(n)
+
+
+def add_round_trip_listener(e):
+    """
+    count every statement an engine executes in the current run's metrics
+    :params e: the db's engine
+    """
+
+    def before_cursor_execute(*args):
+
+        METRICS.add_round_trips()
+
+    event.listen(e, 'before_cursor_execute', before_cursor_execute)
+
+
+def get_peak_rss_mb():
+    """
+    get the peak resident set size of this process and of its finished
+    child processes
+    :returns: the larger of the two, in MB
+    """
+
+    # ru_maxrss is in KB on linux
+    return max(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss,
+               resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss) / 1024
+
+
+@contextlib.contextmanager
+def profile(fp, n_lines=20):
+    """
+    profile the code run in the context with cProfile, dumping the stats to
+    a file and logging the most expensive calls
+    :params fp: filepath the stats are dumped to, they can be read with
+    pstats or snakeviz
+    :params n_lines: number of calls logged
+    """
+
+    p = cProfile.Profile()
+    p.enable()
+
+    try:
+
+        yield p
+
+    finally:
+
+        p.disable()
+        p.dump_stats(fp)
+
+        buf = io.StringIO()
+        pstats.Stats(p, stream=buf).sort_stats('cumulative').\
+            print_stats(n_lines)
+        LOGGER.info(f'profile stats dumped to {fp}\n{buf.getvalue()}')
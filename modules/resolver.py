@@ -0,0 +1,223 @@
+"""
+in-process implementation of the CHIME best ethnicity method used by
+vw_participant_ethnicity, working on whole columns at once so a full cohort
+can be resolved or validated without running the view
+the precedence tables below have to be kept in step with the view, which
+cross_check will show up if they are not
+"""
+
+import logging
+import numpy as np
+import pandas as pd
+from modules import database, concept
+
+LOGGER = logging.getLogger(__name__)
+
+# unknown ethnic groups
+UNKNOWN_CODES = ('99', 'X', 'Z')
+# other ethnic group
+OTHER_CODE = 'S'
+UNKNOWN_BEST_ETHNICITY_CODE = '99'
+
+# bits used to pack dates and ranks into single integers for sorting
+DATE_BITS = 18
+RANK_BITS = 5
+RANK_MAX = (1 << RANK_BITS) - 1
+
+# rank of each source where ethnicities are equally frequent and recent
+SOURCE_PRIORITY = {
+    'hes_apc': 1,
+    'hes_ae': 2,
+    'hes_op': 3,
+    'dams': 4,
+    'dams_rd': 5,
+}
+
+# rank of each ethnic group in the population of England and Wales,
+# according to the 2011 Census
+POPULATION_RANK = {
+    'A': 1,
+    'C': 2,
+    'H': 3,
+    'J': 4,
+    'N': 5,
+    'L': 6,
+    'M': 7,
+    'B': 8,
+    'K': 9,
+    'D': 10,
+    'R': 11,
+    'F': 12,
+    'G': 13,
+    'P': 14,
+    'E': 15,
+    'S': 16,
+}
+
+REPORTED_ETHNICITY_SQL = """
+select participant_id
+    ,ethnicity_cid::text as ethnicity_cid
+    ,source_cid::text as source_cid
+    ,source_date
+from ethnicity_store.reported_ethnicity
+;
+"""
+
+VIEW_SQL = """
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.vw_participant_ethnicity
+;
+"""
+
+
+def resolve(d):
+    """
+    find the best ethnicity for every participant in a set of reported
+    ethnicities
+    :params d: DataFrame with participant_id, ethnicity_code, source and
+    source_date columns, one row per reported ethnicity
+    :returns: DataFrame with participant_id and best_ethnicity_code columns,
+    one row per participant
+    """
+
+    # work on integer codes, with small lookup arrays for each distinct
+    # ethnicity and source
+    pid, pids = pd.factorize(d['participant_id'])
+    eth, eths = pd.factorize(d['ethnicity_code'])
+    src, srcs = pd.factorize(d['source'])
+    date = pd.to_datetime(d['source_date']).to_numpy().\
+        astype('datetime64[D]').astype('int64')
+
+    eths = np.asarray(eths, dtype=object)
+    eth_rank = np.array([POPULATION_RANK.get(x, 0) for x in eths],
+                        dtype='int64')
+    src_rank = np.array([SOURCE_PRIORITY.get(x, 0) for x in srcs],
+                        dtype='int64')
+
+    # participants with an Other ethnic group fall back to it rather than
+    # unknown
+    got_other = np.zeros(len(pids), dtype=bool)
+    got_other[pid[(eths == OTHER_CODE)[eth]]] = True
+
+    # only known, non-Other ethnic groups from ranked sources are usable
+    eth_usable = np.array([x in POPULATION_RANK and
+                           x not in UNKNOWN_CODES + (OTHER_CODE,)
+                           for x in eths], dtype=bool)
+    usable = eth_usable[eth] & (src_rank > 0)[src]
+
+    # one key per (participant, ethnicity, source) with the date packed in
+    # underneath, sorted so repeats of the reported_ethnicity primary key can
+    # be dropped and each key's rows sit together in participant order
+    date = date[usable]
+    date_offset = date - (date.min() if len(date) else 0)
+
+    if len(date) and date_offset.max() >= 1 << DATE_BITS:
+
+        raise ValueError('source dates span too long a period to resolve')
+
+    key = ((pid[usable].astype('int64') * len(eths) + eth[usable]) *
+           len(srcs) + src[usable]) << DATE_BITS | date_offset
+    key.sort()
+    key = key[_run_starts(key)]
+    date_offset = key & ((1 << DATE_BITS) - 1)
+    key = key >> DATE_BITS
+
+    # the count and latest date of each key come from the end of its run
+    run_end = np.flatnonzero(_run_ends(key))
+    eth_count = np.diff(np.append(-1, run_end))
+    date_offset = date_offset[run_end]
+    key = key[run_end]
+    src = key % len(srcs)
+    eth = (key // len(srcs)) % len(eths)
+    pid = key // (len(srcs) * len(eths))
+
+    # rank within each participant by frequency, then latest date, then
+    # source, then census population, packed into a single score where
+    # higher is better
+    score = ((eth_count << DATE_BITS | date_offset) << RANK_BITS |
+             (RANK_MAX - src_rank[src])) << RANK_BITS | \
+        (RANK_MAX - eth_rank[eth])
+    starts = np.flatnonzero(_run_starts(pid))
+    best_score = np.maximum.reduceat(score, starts) if len(starts) else score
+    is_best = score == np.repeat(best_score, np.diff(np.append(starts,
+                                                               len(pid))))
+
+    best = np.where(got_other, OTHER_CODE, UNKNOWN_BEST_ETHNICITY_CODE).\
+        astype(object)
+    best[pid[is_best]] = eths[eth[is_best]]
+
+    return pd.DataFrame({'participant_id': np.asarray(pids, dtype=object),
+                         'best_ethnicity_code': best})
+
+
+def _run_starts(a):
+    """
+    flag the elements of a sorted array that differ from the one before
+    """
+
+    return np.diff(a, prepend=a[:1] - 1) != 0
+
+
+def _run_ends(a):
+    """
+    flag the elements of a sorted array that differ from the one after
+    """
+
+    return np.diff(a, append=a[-1:] + 1) != 0
+
+
+def read_reported_ethnicity(s):
+    """
+    read all reported ethnicities from the diversity db
+    :params s: SQLAlchemy session bound to required engines
+    :returns: DataFrame in the form taken by resolve
+    """
+
+    d = read_sql(s, REPORTED_ETHNICITY_SQL)
+
+    # cids are converted to codes in memory rather than joining to the
+    # concept table twice
+    concepts = concept.CONCEPT_CACHE.check(s)
+
+    d['ethnicity_code'] = d.pop('ethnicity_cid').map(
+        concepts.get_codes('reported_ethnicity_code'))
+    d['source'] = d.pop('source_cid').map(concepts.get_codes('source'))
+
+    return d
+
+
+def read_sql(s, sql):
+    """
+    read the result of a query on the diversity db into a DataFrame
+    :params s: SQLAlchemy session bound to required engines
+    :params sql: the sql query string
+    """
+
+    res = database.get_div_db_connection(s).execute(sql)
+
+    return pd.DataFrame(res.fetchall(), columns=list(res.keys()))
+
+
+def cross_check(s):
+    """
+    resolve the best ethnicity of every participant in the diversity db and
+    compare it with vw_participant_ethnicity
+    :params s: SQLAlchemy session bound to required engines
+    :returns: DataFrame of participant_id, resolved and view codes for
+    every participant where the two differ
+    """
+
+    resolved = resolve(read_reported_ethnicity(s))
+    view = read_sql(s, VIEW_SQL)
+
+    d = resolved.merge(view, on='participant_id', how='outer',
+                       suffixes=('_resolved', '_view'))
+    d = d[d['best_ethnicity_code_resolved'] != d['best_ethnicity_code_view']]
+
+    LOGGER.info(f'resolved {len(resolved)} participants, '
+                f'{len(d)} differ from the view')
+
+    return d.rename(columns={'best_ethnicity_code_resolved': 'resolved',
+                             'best_ethnicity_code_view': 'view'}).\
+        reset_index(drop=True)
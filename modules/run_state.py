@@ -0,0 +1,154 @@
+"""
+functions for reading and recording how far each source's ETL has got, and
+the ETL runs themselves
+"""
+
+import datetime
+import logging
+from sqlalchemy import text
+from modules import database, concept
+from classes.diversity_db import EtlRun, EtlRunState
+
+LOGGER = logging.getLogger(__name__)
+
+# held by a finishing run until it commits, so runs are numbered in the
+# order they commit
+FINISH_RUN_LOCK_KEY = 2046201
+
+FINISH_RUN_LOCK_SQL = """
+select pg_advisory_xact_lock(cast(:key as bigint))
+;
+"""
+
+# the last run to finish has committed, as it held the lock until it did
+FINISH_RUN_SQL = """
+update ethnicity_store.etl_run
+set finished_at = cast(:finished_at as timestamp)
+    ,finish_seq = (select coalesce(max(finish_seq), 0) + 1
+                   from ethnicity_store.etl_run)
+where run_id = cast(:run_id as bigint)
+returning finish_seq
+;
+"""
+
+
+def get_source_cid(s, source):
+    """
+    get the concept uid for a source
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the code for the data source
+    """
+
+    return concept.get_concept_cache(s).get_uid('source', source)
+
+
+def get_high_water_mark(s, source):
+    """
+    get the high-water mark recorded for a source
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the code for the data source
+    :returns: the high-water mark date, None if the source has never been run
+    """
+
+    return s.query(EtlRunState.high_water_mark).\
+        filter(EtlRunState.source_cid == get_source_cid(s, source)).\
+        scalar()
+
+
+def set_high_water_mark(s, source, high_water_mark):
+    """
+    record the high-water mark for a source, this is only added to the
+    session so it is committed in the same transaction as the loaded data
+    :params s: SQLAlchemy session bound to required engines
+    :params source: the code for the data source
+    :params high_water_mark: the date the source has been loaded up to
+    """
+
+    LOGGER.info(f'setting high-water mark for {source} to {high_water_mark}')
+
+    s.merge(EtlRunState(source_cid=get_source_cid(s, source),
+                        high_water_mark=high_water_mark,
+                        updated_at=datetime.datetime.now()))
+    s.flush()
+
+
+def restore_high_water_marks(s, marks):
+    """
+    put sources' high-water marks back to earlier values, removing any that
+    didn't exist before
+    :params s: SQLAlchemy session bound to required engines
+    :params marks: dictionary of source code: high-water mark date, None
+    if the source had never been run
+    """
+
+    for source, mark in marks.items():
+
+        if mark:
+
+            set_high_water_mark(s, source, mark)
+
+        else:
+
+            s.query(EtlRunState).\
+                filter(EtlRunState.source_cid == get_source_cid(s, source)).\
+                delete(synchronize_session=False)
+
+    s.flush()
+
+
+def start_run(s, sources=None, incremental=False):
+    """
+    record the start of an ETL run, in the session's transaction
+    :params s: SQLAlchemy session bound to required engines
+    :params sources: list of the codes of the sources being run, None for a
+    refresh that doesn't run any
+    :params incremental: is the run incremental?
+    :returns: the run's id
+    """
+
+    run = EtlRun(sources=','.join(sources) if sources is not None else None,
+                 incremental=incremental)
+    s.add(run)
+    s.flush()
+
+    LOGGER.info(f'started run {run.run_id}')
+
+    return run.run_id
+
+
+def finish_run(s, run_id):
+    """
+    mark an ETL run as finished, numbering it after every run that finished
+    before it, this is only added to the session so it is committed in the
+    same transaction as the run's changes
+    the numbering takes a lock that is held until the session commits, so
+    finish it just before committing
+    :params s: SQLAlchemy session bound to required engines
+    :params run_id: the run's id
+    :returns: the run's finish_seq
+    """
+
+    con = database.get_div_db_connection(s)
+
+    # taken before the update, so its snapshot includes the last finish
+    con.execute(text(FINISH_RUN_LOCK_SQL), {'key': FINISH_RUN_LOCK_KEY})
+    finish_seq = con.execute(text(FINISH_RUN_SQL),
+                             {'run_id': run_id,
+                              'finished_at': datetime.datetime.now()}).\
+        scalar()
+
+    LOGGER.info(f'finished run {run_id} as {finish_seq}')
+
+    return finish_seq
+
+
+def get_latest_run_id(s):
+    """
+    get the id of the last ETL run to finish
+    :params s: SQLAlchemy session bound to required engines
+    :returns: the run's id, None if no run has finished
+    """
+
+    return s.query(EtlRun.run_id).\
+        filter(EtlRun.finish_seq.isnot(None)).\
+        order_by(EtlRun.finish_seq.desc()).limit(1).scalar()
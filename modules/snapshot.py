@@ -0,0 +1,304 @@
+"""
+functions for snapshotting the ethnicity store to parquet files, and
+restoring it from them without going back to the source systems
+a snapshot is a directory of one parquet file per table, with each source's
+reported ethnicities in a file of their own, and a manifest of the files and
+their row counts, all read from the same snapshot of the db
+a restore creates the diversity db, keeping the snapshot's concept uids,
+and COPYs the files back in, with each source's reported ethnicities loaded
+into a table without indexes or constraints and swapped in as its partition
+once the indexes have been built, as a rebuild run does
+"""
+
+import datetime
+import io
+import json
+import logging
+import os
+import time
+from modules import database, concept, bulk_reload, export, metrics
+
+LOGGER = logging.getLogger(__name__)
+
+# the version of the snapshot layout, restore refuses any other
+SNAPSHOT_FORMAT_VERSION = 2
+
+MANIFEST_FILENAME = 'manifest.json'
+
+# the tables in a snapshot, in the order they are restored, with the
+# pyarrow type name of each column
+# uids are written as text and numerics as text so nothing is lost
+SNAPSHOT_TABLES = {
+    'concept': {
+        'uid': 'string', 'concept_code': 'string', 'codesystem': 'string',
+        'description': 'string'},
+    'participant': {
+        'id': 'string', 'group_cid': 'string', 'in_ngrl': 'bool_',
+        'programme_cid': 'string'},
+    'etl_run_state': {
+        'source_cid': 'string', 'high_water_mark': 'date32',
+        'updated_at': 'string'},
+    'predicted_ancestry': {
+        'participant_id': 'string', 'ancestry_cid': 'string',
+        'prop': 'string'},
+    'participant_best_ethnicity': {
+        'participant_id': 'string', 'best_ethnicity_code': 'string',
+        'refreshed_at': 'string'},
+    'participant_source_fingerprint': {
+        'participant_id': 'string', 'source_cid': 'string',
+        'fingerprint': 'string', 'updated_at': 'string'},
+    'etl_run': {
+        'run_id': 'int64', 'started_at': 'string', 'finished_at': 'string',
+        'finish_seq': 'int64', 'sources': 'string', 'incremental': 'bool_'},
+    'best_ethnicity_change': {
+        'run_id': 'int64', 'participant_id': 'string',
+        'change_type': 'string', 'old_best_ethnicity_code': 'string',
+        'new_best_ethnicity_code': 'string'},
+}
+
+# run ids carry on from the snapshot's
+RESET_RUN_ID_SQL = """
+select setval(pg_get_serial_sequence('ethnicity_store.etl_run', 'run_id'),
+              coalesce(max(run_id), 0) + 1, false)
+from ethnicity_store.etl_run
+;
+"""
+
+REPORTED_ETHNICITY_COLUMNS = {
+    'participant_id': 'string', 'ethnicity_cid': 'string',
+    'source_cid': 'string', 'source_date': 'date32'}
+
+# the partitions of reported_ethnicity, with the source each one holds,
+# None for the default partition
+PARTITIONS_SQL = """
+select p.relname as partition
+    ,c.concept_code as source
+from pg_inherits i
+join pg_class p
+    on p.oid = i.inhrelid
+left join ethnicity_store.concept c
+    on c.codesystem = 'source'
+    and ethnicity_store.source_partition_name(c.concept_code) = p.relname
+where i.inhparent = 'ethnicity_store.reported_ethnicity'::regclass
+order by p.relname
+;
+"""
+
+
+def snapshot(c, out_dir='.', compress=True):
+    """
+    write a snapshot of the ethnicity store to a new directory
+    :params c: a Config class instance
+    :params out_dir: directory the snapshot's directory is made in
+    :params compress: zstd compress the parquet files
+    :returns: the snapshot's directory
+    """
+
+    start = time.perf_counter()
+    created_at = datetime.datetime.now()
+    snapshot_dir = os.path.join(out_dir,
+                                f'snapshot_{created_at:%Y%m%d%H%M%S}')
+    os.makedirs(snapshot_dir)
+
+    manifest = {'format_version': SNAPSHOT_FORMAT_VERSION,
+                'created_at': created_at.isoformat(timespec='seconds'),
+                'tables': {},
+                'reported_ethnicity': []}
+
+    with export.read_snapshot(c) as con:
+
+        manifest['concept_version'] = con.execute(concept.VERSION_SQL).\
+            scalar()
+
+        for table, columns in SNAPSHOT_TABLES.items():
+
+            fp = f'{table}.parquet'
+            n = export.write_parquet(con.connection,
+                                     get_select_sql(table, columns), columns,
+                                     os.path.join(snapshot_dir, fp), compress)
+            manifest['tables'][table] = {'file': fp, 'rows': n}
+
+        for x in con.execute(PARTITIONS_SQL).mappings().all():
+
+            fp = f'{x["partition"]}.parquet'
+            sql = get_select_sql(x['partition'], REPORTED_ETHNICITY_COLUMNS)
+            n = export.write_parquet(con.connection, sql,
+                                     REPORTED_ETHNICITY_COLUMNS,
+                                     os.path.join(snapshot_dir, fp), compress)
+            manifest['reported_ethnicity'].append(
+                {'source': x['source'], 'file': fp, 'rows': n})
+
+    # the manifest is written last, so a snapshot without one is incomplete
+    with open(os.path.join(snapshot_dir, MANIFEST_FILENAME), 'w') as f:
+
+        json.dump(manifest, f, indent=2)
+
+    LOGGER.info('wrote snapshot %s in %.1fs', snapshot_dir,
+                time.perf_counter() - start)
+
+    return snapshot_dir
+
+
+def restore(c, snapshot_dir):
+    """
+    create the diversity db and load a snapshot into it, checking each
+    table's row count, and the concepts' version, against the manifest, the
+    diversity db must not already exist
+    :params c: a Config class instance
+    :params snapshot_dir: the snapshot's directory
+    """
+
+    start = time.perf_counter()
+    manifest = read_manifest(snapshot_dir)
+
+    database.create_diversity_db(c)
+    s = database.make_session(c)
+
+    try:
+
+        for table, columns in SNAPSHOT_TABLES.items():
+
+            # tables added since the snapshot was written are left empty
+            if table not in manifest['tables']:
+
+                continue
+
+            # the concepts are restored with their uids, so the snapshot's
+            # other tables still point at them
+            copy_parquet(s, os.path.join(snapshot_dir,
+                                           manifest['tables'][table]['file']),
+                         f'ethnicity_store.{table}', columns,
+                         manifest['tables'][table]['rows'])
+
+            if table == 'concept':
+
+                # the row count can match with different concepts
+                version = concept.ConceptCache.read_version(s)
+
+                if version != manifest['concept_version']:
+
+                    raise ValueError(f'restored concepts have version '
+                                     f'{version}, the manifest gives '
+                                     f'{manifest["concept_version"]}')
+
+                # commits the concepts, so the partitions can be made for
+                # them
+                concept.create_source_partitions(s)
+
+        sources = [x for x in manifest['reported_ethnicity'] if x['source']]
+        tables = bulk_reload.create_load_tables(s, [x['source']
+                                                    for x in sources])
+
+        for x in manifest['reported_ethnicity']:
+
+            # rows in the default partition go through the parent, which
+            # routes them and keeps their summary up to date
+            copy_parquet(s, os.path.join(snapshot_dir, x['file']),
+                         tables.get(x['source'],
+                                    'ethnicity_store.reported_ethnicity'),
+                         REPORTED_ETHNICITY_COLUMNS, x['rows'])
+
+        database.get_div_db_connection(s).execute(RESET_RUN_ID_SQL)
+        s.commit()
+
+    finally:
+
+        s.close()
+
+    # indexes are built on the loaded tables, then they are swapped in
+    bulk_reload.swap_source_partitions(c, tables)
+
+    with database.get_engine(c.div_db_conn_str, c).begin() as e_con:
+
+        for table in SNAPSHOT_TABLES:
+
+            e_con.execute(f'analyze ethnicity_store.{table};')
+
+    concept.CONCEPT_CACHE.invalidate()
+
+    LOGGER.info('restored snapshot %s in %.1fs', snapshot_dir,
+                time.perf_counter() - start)
+
+
+def read_manifest(snapshot_dir):
+    """
+    read a snapshot's manifest, checking it can be restored
+    :params snapshot_dir: the snapshot's directory
+    :returns: dictionary of the manifest
+    """
+
+    fp = os.path.join(snapshot_dir, MANIFEST_FILENAME)
+
+    if not os.path.exists(fp):
+
+        raise ValueError(f'{snapshot_dir} has no manifest, so is not a '
+                         f'complete snapshot')
+
+    with open(fp, 'r') as f:
+
+        manifest = json.load(f)
+
+    if manifest['format_version'] != SNAPSHOT_FORMAT_VERSION:
+
+        raise ValueError(f'snapshot format version '
+                         f'{manifest["format_version"]} can not be restored, '
+                         f'only version {SNAPSHOT_FORMAT_VERSION}')
+
+    return manifest
+
+
+def get_select_sql(table, columns):
+    """
+    get the query for a table's rows, with every column the snapshot stores
+    as text cast to text
+    :params table: the table, in the ethnicity_store schema
+    :params columns: dictionary of column name: pyarrow type name
+    :returns: the query string
+    """
+
+    cols = ', '.join(f'{k}::text' if v == 'string' else k
+                     for k, v in columns.items())
+
+    return f'select {cols} from ethnicity_store.{table}'
+
+
+def copy_parquet(s, fp, table, columns, n_expected):
+    """
+    COPY a parquet file into a table a row group at a time, in the session's
+    transaction
+    :params s: SQLAlchemy session bound to required engines
+    :params fp: the parquet file's filepath
+    :params table: the table loaded into
+    :params columns: dictionary of column name: pyarrow type name
+    :params n_expected: the number of rows the manifest gives for the file
+    """
+
+    import pyarrow.csv as pa_csv
+    import pyarrow.parquet as pq
+
+    sql = (f'copy {table} ({", ".join(columns)}) from stdin '
+           f'with (format csv);')
+    options = pa_csv.WriteOptions(include_header=False)
+    cur = database.get_div_db_connection(s).connection.cursor()
+    n = 0
+
+    for batch in pq.ParquetFile(fp).iter_batches(
+            batch_size=export.ROW_GROUP_SIZE, columns=list(columns)):
+
+        # strings are quoted, so only nulls are written as empty fields
+        buf = io.BytesIO()
+        pa_csv.write_csv(batch, buf, options)
+        buf.seek(0)
+
+        cur.copy_expert(sql, buf)
+        metrics.add_round_trips()
+        n += batch.num_rows
+
+    cur.close()
+
+    if n != n_expected:
+
+        raise ValueError(f'{fp} has {n} rows, the manifest gives '
+                         f'{n_expected}')
+
+    LOGGER.info('restored %d rows into %s', n, table)
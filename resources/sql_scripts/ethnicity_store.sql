@@ -30,6 +30,28 @@ create table ethnicity_store.reported_ethnicity (
     constraint ethnicity_cid_foreign_key foreign key (ethnicity_cid) references ethnicity_store.concept(uid),
     constraint source_cid_foreign_key foreign key (source_cid) references ethnicity_store.concept(uid),
     primary key (participant_id, ethnicity_cid, source_cid, source_date)
+) partition by list (source_cid);
+
+-- each source gets its own partition, made by create_source_partitions once the concepts are in place, anything
+-- else lands in the default partition
+create table ethnicity_store.reported_ethnicity_default partition of ethnicity_store.reported_ethnicity default;
+
+create index reported_ethnicity_source_idx on ethnicity_store.reported_ethnicity (source_cid, source_date);
+
+-- unlogged, as rows only pass through on their way into reported_ethnicity within a single transaction
+create unlogged table ethnicity_store.reported_ethnicity_staging (
+    participant_id varchar not null,
+    ethnicity_code varchar not null,
+    source_date date not null
+);
+
+create table ethnicity_store.reported_ethnicity_summary (
+    participant_id varchar not null,
+    ethnicity_cid uuid not null,
+    source_cid uuid not null,
+    eth_count bigint not null,
+    max_source_date date not null,
+    constraint reported_ethnicity_summary_pkey primary key (participant_id, ethnicity_cid, source_cid)
 );
 
 create table ethnicity_store.predicted_ancestry (
@@ -40,7 +62,66 @@ create table ethnicity_store.predicted_ancestry (
     constraint ancestry_cid_foreign_key foreign key (ancestry_cid) references ethnicity_store.concept(uid)
 );
 
+create table ethnicity_store.participant_best_ethnicity (
+    participant_id varchar not null,
+    best_ethnicity_code varchar not null,
+    refreshed_at timestamp not null default now(),
+    constraint participant_best_ethnicity_pkey primary key (participant_id),
+    constraint participant_best_ethnicity_participant_id_foreign_key foreign key (participant_id) references ethnicity_store.participant(id)
+);
+
+create table ethnicity_store.etl_run_state (
+    source_cid uuid not null,
+    high_water_mark date not null,
+    updated_at timestamp not null default now(),
+    constraint etl_run_state_pkey primary key (source_cid),
+    constraint etl_run_state_source_cid_foreign_key foreign key (source_cid) references ethnicity_store.concept(uid)
+);
+
+-- a hash of each participant's (ethnicity code, source date) pairs from each source, as of the last full run that saw
+-- all of them, so unchanged participants can be skipped
+create table ethnicity_store.participant_source_fingerprint (
+    participant_id varchar not null,
+    source_cid uuid not null,
+    fingerprint varchar not null,
+    updated_at timestamp not null default now(),
+    constraint participant_source_fingerprint_pkey primary key (source_cid, participant_id),
+    constraint participant_source_fingerprint_participant_id_foreign_key foreign key (participant_id) references ethnicity_store.participant(id),
+    constraint participant_source_fingerprint_source_cid_foreign_key foreign key (source_cid) references ethnicity_store.concept(uid)
+);
+
+-- a row per ETL run, finished_at and finish_seq are only set when the run commits, finish_seq numbering runs in the order they commit
+create table ethnicity_store.etl_run (
+    run_id bigint generated by default as identity,
+    started_at timestamp not null default now(),
+    finished_at timestamp null,
+    finish_seq bigint null,
+    sources varchar null,
+    incremental bool not null default false,
+    constraint etl_run_pkey primary key (run_id),
+    constraint etl_run_finish_seq_uq unique (finish_seq)
+);
+
+-- the participants whose best ethnicity each run added, changed or removed, read in (finish_seq, participant_id) order
+create table ethnicity_store.best_ethnicity_change (
+    run_id bigint not null,
+    participant_id varchar not null,
+    change_type varchar not null,
+    old_best_ethnicity_code varchar null,
+    new_best_ethnicity_code varchar null,
+    constraint best_ethnicity_change_pkey primary key (run_id, participant_id),
+    constraint best_ethnicity_change_run_id_foreign_key foreign key (run_id) references ethnicity_store.etl_run(run_id)
+);
+
 alter table ethnicity_store.participant owner to cdt_user;
 alter table ethnicity_store.concept owner to cdt_user;
 alter table ethnicity_store.reported_ethnicity owner to cdt_user;
+alter table ethnicity_store.reported_ethnicity_default owner to cdt_user;
+alter table ethnicity_store.reported_ethnicity_staging owner to cdt_user;
+alter table ethnicity_store.reported_ethnicity_summary owner to cdt_user;
 alter table ethnicity_store.predicted_ancestry owner to cdt_user;
+alter table ethnicity_store.participant_best_ethnicity owner to cdt_user;
+alter table ethnicity_store.etl_run_state owner to cdt_user;
+alter table ethnicity_store.participant_source_fingerprint owner to cdt_user;
+alter table ethnicity_store.etl_run owner to cdt_user;
+alter table ethnicity_store.best_ethnicity_change owner to cdt_user;
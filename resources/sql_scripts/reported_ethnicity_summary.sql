@@ -0,0 +1,160 @@
+/*
+Keeps reported_ethnicity_summary in step with reported_ethnicity, so the best ethnicity method reads one row per
+(participant, ethnicity, source) rather than aggregating every reported ethnicity each time it is run.
+The triggers are statement level and read the changed rows from transition tables, so a COPY merge or multi-row insert
+updates the summary with a single aggregated upsert.
+Counts can be adjusted on delete, but a max can't be, so the max_source_date of any triple that loses rows is recomputed
+from reported_ethnicity.
+*/
+create function ethnicity_store.reported_ethnicity_summary_insert()
+returns trigger
+language plpgsql
+as $$
+begin
+    insert into ethnicity_store.reported_ethnicity_summary as s
+    (participant_id, ethnicity_cid, source_cid, eth_count, max_source_date)
+    select participant_id
+        ,ethnicity_cid
+        ,source_cid
+        ,count(*)
+        ,max(source_date)
+    from new_rows
+    group by participant_id, ethnicity_cid, source_cid
+    on conflict (participant_id, ethnicity_cid, source_cid) do update
+    set eth_count = s.eth_count + excluded.eth_count
+        ,max_source_date = greatest(s.max_source_date, excluded.max_source_date);
+
+    return null;
+end;
+$$;
+
+create function ethnicity_store.reported_ethnicity_summary_delete()
+returns trigger
+language plpgsql
+as $$
+begin
+    with removed as (
+        select participant_id
+            ,ethnicity_cid
+            ,source_cid
+            ,count(*) as eth_count
+        from old_rows
+        group by participant_id, ethnicity_cid, source_cid
+    )
+    update ethnicity_store.reported_ethnicity_summary s
+    set eth_count = s.eth_count - r.eth_count
+        ,max_source_date = coalesce((
+            select max(re.source_date)
+            from ethnicity_store.reported_ethnicity re
+            where re.participant_id = s.participant_id
+                and re.ethnicity_cid = s.ethnicity_cid
+                and re.source_cid = s.source_cid
+            ), s.max_source_date)
+    from removed r
+    where s.participant_id = r.participant_id
+        and s.ethnicity_cid = r.ethnicity_cid
+        and s.source_cid = r.source_cid;
+
+    delete from ethnicity_store.reported_ethnicity_summary
+    where eth_count <= 0
+        and (participant_id, ethnicity_cid, source_cid) in (
+            select participant_id, ethnicity_cid, source_cid from old_rows
+        );
+
+    return null;
+end;
+$$;
+
+create function ethnicity_store.reported_ethnicity_summary_update()
+returns trigger
+language plpgsql
+as $$
+begin
+    -- an update is the removal of the old rows followed by the insertion of the new
+    with removed as (
+        select participant_id
+            ,ethnicity_cid
+            ,source_cid
+            ,count(*) as eth_count
+        from old_rows
+        group by participant_id, ethnicity_cid, source_cid
+    )
+    update ethnicity_store.reported_ethnicity_summary s
+    set eth_count = s.eth_count - r.eth_count
+    from removed r
+    where s.participant_id = r.participant_id
+        and s.ethnicity_cid = r.ethnicity_cid
+        and s.source_cid = r.source_cid;
+
+    insert into ethnicity_store.reported_ethnicity_summary as s
+    (participant_id, ethnicity_cid, source_cid, eth_count, max_source_date)
+    select participant_id
+        ,ethnicity_cid
+        ,source_cid
+        ,count(*)
+        ,max(source_date)
+    from new_rows
+    group by participant_id, ethnicity_cid, source_cid
+    on conflict (participant_id, ethnicity_cid, source_cid) do update
+    set eth_count = s.eth_count + excluded.eth_count;
+
+    -- the old and new triples are both recomputed as dates may have moved either way
+    update ethnicity_store.reported_ethnicity_summary s
+    set max_source_date = (
+            select max(re.source_date)
+            from ethnicity_store.reported_ethnicity re
+            where re.participant_id = s.participant_id
+                and re.ethnicity_cid = s.ethnicity_cid
+                and re.source_cid = s.source_cid
+            )
+    where s.eth_count > 0
+        and (s.participant_id, s.ethnicity_cid, s.source_cid) in (
+            select participant_id, ethnicity_cid, source_cid from old_rows
+            union
+            select participant_id, ethnicity_cid, source_cid from new_rows
+        );
+
+    delete from ethnicity_store.reported_ethnicity_summary
+    where eth_count <= 0
+        and (participant_id, ethnicity_cid, source_cid) in (
+            select participant_id, ethnicity_cid, source_cid from old_rows
+        );
+
+    return null;
+end;
+$$;
+
+create function ethnicity_store.reported_ethnicity_summary_truncate()
+returns trigger
+language plpgsql
+as $$
+begin
+    truncate ethnicity_store.reported_ethnicity_summary;
+
+    return null;
+end;
+$$;
+
+create trigger reported_ethnicity_summary_insert
+after insert on ethnicity_store.reported_ethnicity
+referencing new table as new_rows
+for each statement execute function ethnicity_store.reported_ethnicity_summary_insert();
+
+create trigger reported_ethnicity_summary_delete
+after delete on ethnicity_store.reported_ethnicity
+referencing old table as old_rows
+for each statement execute function ethnicity_store.reported_ethnicity_summary_delete();
+
+create trigger reported_ethnicity_summary_update
+after update on ethnicity_store.reported_ethnicity
+referencing old table as old_rows new table as new_rows
+for each statement execute function ethnicity_store.reported_ethnicity_summary_update();
+
+create trigger reported_ethnicity_summary_truncate
+after truncate on ethnicity_store.reported_ethnicity
+for each statement execute function ethnicity_store.reported_ethnicity_summary_truncate();
+
+alter function ethnicity_store.reported_ethnicity_summary_insert() owner to cdt_user;
+alter function ethnicity_store.reported_ethnicity_summary_delete() owner to cdt_user;
+alter function ethnicity_store.reported_ethnicity_summary_update() owner to cdt_user;
+alter function ethnicity_store.reported_ethnicity_summary_truncate() owner to cdt_user;
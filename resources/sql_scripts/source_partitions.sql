@@ -0,0 +1,58 @@
+/*
+Functions for managing the partitions of reported_ethnicity, which is list partitioned by source_cid so that a source
+can be reloaded by swapping in a whole new partition, and source-specific queries only read their own source.
+*/
+create function ethnicity_store.source_partition_name(source_code varchar)
+returns varchar
+language sql immutable
+as $$
+select 'reported_ethnicity_' || regexp_replace(lower(source_code), '[^a-z0-9_]', '_', 'g')
+$$;
+
+/*
+Create a partition for every source concept that doesn't have one yet. Any of a new source's rows already in the
+default partition are moved out first, through the parent so that reported_ethnicity_summary stays in step.
+*/
+create function ethnicity_store.create_source_partitions()
+returns void
+language plpgsql
+as $$
+declare
+    src record;
+begin
+    for src in
+        select c.uid
+            ,ethnicity_store.source_partition_name(c.concept_code) as partition_name
+        from ethnicity_store.concept c
+        where c.codesystem = 'source'
+            and not exists (
+                select 1
+                from pg_inherits i
+                join pg_class p
+                    on p.oid = i.inhrelid
+                where i.inhparent = 'ethnicity_store.reported_ethnicity'::regclass
+                    and p.relname = ethnicity_store.source_partition_name(c.concept_code)
+            )
+    loop
+        create temp table moving_reported_ethnicity on commit drop as
+        select *
+        from ethnicity_store.reported_ethnicity
+        where source_cid = src.uid;
+
+        delete from ethnicity_store.reported_ethnicity
+        where source_cid = src.uid;
+
+        execute 'create table ethnicity_store.' || quote_ident(src.partition_name) ||
+            ' partition of ethnicity_store.reported_ethnicity for values in (' || quote_literal(src.uid) || ')';
+
+        insert into ethnicity_store.reported_ethnicity
+        select *
+        from moving_reported_ethnicity;
+
+        drop table moving_reported_ethnicity;
+    end loop;
+end;
+$$;
+
+alter function ethnicity_store.source_partition_name(varchar) owner to cdt_user;
+alter function ethnicity_store.create_source_partitions() owner to cdt_user;
@@ -13,18 +13,27 @@ The approach is:
   * The second most common usable ethnic group is assigned instead
   * If there are no other usable ethnic groups, the person is assigned to the Other ethnic group. A person will only be assigned to the Other ethnic group if there are no other usable ethnic groups
 
+The counts and latest dates of each participant's ethnicities by source are read from reported_ethnicity_summary, which
+is kept in step with reported_ethnicity by triggers, so the cost of ranking depends on the number of distinct
+(participant, ethnicity, source) triples rather than on the number of reported ethnicities.
+
+The query is a set-returning sql function taking an array of participant ids (null for all participants), so it can be
+inlined and recomputed for just the participants touched by an ETL run. The view gives the result for all participants.
 */
-create view ethnicity_store.vw_participant_ethnicity as
+create function ethnicity_store.participant_ethnicity(participant_ids varchar[])
+returns table (participant_id varchar, best_ethnicity_code varchar)
+language sql stable
+as $$
 with best_valid_ethnicity as (
     with all_rows as (
-        select re.participant_id
-            ,re.ethnicity_cid 
-            ,re.source_cid
-            ,count(re.ethnicity_cid) as eth_count
-            ,max(re.source_date) as max_source_date
-        from ethnicity_store.reported_ethnicity re
-        group by re.participant_id, re.ethnicity_cid , source_cid
-        having re.ethnicity_cid not in (
+        select rs.participant_id
+            ,rs.ethnicity_cid
+            ,rs.source_cid
+            ,rs.eth_count
+            ,rs.max_source_date
+        from ethnicity_store.reported_ethnicity_summary rs
+        where (participant_ids is null or rs.participant_id = any(participant_ids))
+        and rs.ethnicity_cid not in (
             select uid from ethnicity_store.concept c
             where concept_code in ('S', 'Z', '99', 'X') and codesystem = 'reported_ethnicity_code'
             )
@@ -33,7 +42,10 @@ with best_valid_ethnicity as (
         select *
         from (values
             ('hes_apc', 1),
-            ('dams', 2)
+            ('hes_ae', 2),
+            ('hes_op', 3),
+            ('dams', 4),
+            ('dams_rd', 5)
         ) as t("source", "rank")
     ),
     population_ethnicity as (
@@ -71,23 +83,31 @@ with best_valid_ethnicity as (
         on rec.concept_code = pe.ethnicity_code
 ),
 all_participants as (
-    select re.participant_id
+    select rs.participant_id
         ,bool_or(rec.concept_code = 'S') as got_other
         ,bool_or(rec.concept_code in ('99', 'X', 'Z')) as got_unknown
-    from ethnicity_store.reported_ethnicity re
+    from ethnicity_store.reported_ethnicity_summary rs
     join ethnicity_store.concept rec 
-        on re.ethnicity_cid = rec.uid
-    group by re.participant_id 
+        on rs.ethnicity_cid = rec.uid
+    where participant_ids is null or rs.participant_id = any(participant_ids)
+    group by rs.participant_id 
 )
 select ap.participant_id,
-    case
+    (case
         when bve.ethnicity_code is not null then bve.ethnicity_code
         when bve.ethnicity_code is null and ap.got_other = true then 'S'
         else '99'
-    end as best_ethnicity_code
+    end)::varchar as best_ethnicity_code
 from all_participants ap 
 left join (select * from best_valid_ethnicity where row_rank = 1) bve 
     on ap.participant_id = bve.participant_id
+$$;
+
+create view ethnicity_store.vw_participant_ethnicity as
+select participant_id
+    ,best_ethnicity_code
+from ethnicity_store.participant_ethnicity(null)
 ;
 
+alter function ethnicity_store.participant_ethnicity(varchar[]) owner to cdt_user;
 alter view ethnicity_store.vw_participant_ethnicity owner to cdt_user;
@@ -0,0 +1,36 @@
+"""
+test the synthetic data generator used by the benchmarks
+"""
+
+import unittest
+from benchmarks import generator
+
+
+class GenerateApcRows(unittest.TestCase):
+
+    def test_seeded(self):
+        """
+        check the same seed gives the same rows and another seed doesn't
+        """
+
+        a = list(generator.generate_apc_rows(100, seed=1, chunk_size=30))
+        b = list(generator.generate_apc_rows(100, seed=1, chunk_size=30))
+        c = list(generator.generate_apc_rows(100, seed=2, chunk_size=30))
+
+        self.assertEqual(a, b)
+        self.assertNotEqual(a, c)
+
+    def test_rows(self):
+        """
+        check every participant has at least one admission, with codes from
+        concept_codes.csv or the single digits the extraction filters out
+        """
+
+        rows = [x for chunk in generator.generate_apc_rows(1000, seed=1)
+                for x in chunk]
+        codes, p = generator.read_codes()
+
+        self.assertEqual(len(set(x[0] for x in rows)), 1000)
+        self.assertAlmostEqual(p.sum(), 1)
+        self.assertTrue(all(x[1] in codes or x[1] in '0123456789'
+                            for x in rows))
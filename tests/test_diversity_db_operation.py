@@ -2,29 +2,31 @@
 test the basic operation of diversity_db
 """
 
+import concurrent.futures
+import datetime
+import gzip
+import json
 import logging
+import os
+import tempfile
+import threading
 import unittest
 import time
 import sys
-from sqlalchemy import and_
+import pyarrow.parquet as pq
+from sqlalchemy import and_, text
 from config import ConfigFactory
-from modules import database, concept, log
+from modules import database, concept, log, bulk_load, run_state, \
+    best_ethnicity, resolver, bulk_reload, lookup, export, snapshot, changes, \
+    fingerprint
 from classes import diversity_db
+from etl import common, apc, dams
 
 c = ConfigFactory.factory()
 log.setup_logger(c)
 
 LOGGER = logging.getLogger(__name__)
 
-def reset_observed_classes():
-    # reset all the observed classes, otherwise invalid concept cids carried
-    # across between tests
-    diversity_db.ObservedParticipant.group_concept_codes = None
-    diversity_db.ObservedParticipant.programme_concept_codes = None
-    diversity_db.ObservedParticipant.participants_in_db = None
-    diversity_db.ObservedReportedEthnicity.ethnicity_concept_codes = None
-    diversity_db.ObservedReportedEthnicity.source_concept_codes = None
-
 def get_concept_cid(s, concept_code, codesystem):
 
     d = s.query(diversity_db.Concept.uid).filter(
@@ -35,17 +37,6 @@ def get_concept_cid(s, concept_code, codesystem):
 
     return d[0][0]
 
-def get_best_ethnicity_for_participant(pid):
-
-    sql = f"select v.best_ethnicity_code from ethnicity_store.vw_participant_ethnicity v where v.participant_id = '{pid}';"
-    e = database.get_engine(c.div_db_conn_str)
-    cr = database.run_sql_query(e, sql)
-    d = cr.mappings().all()
-
-    assert len(d) == 1, 'too many best ethnicities returned'
-
-    return d[0]['best_ethnicity_code']
-
 
 class DiversityDBOperation(unittest.TestCase):
 
@@ -63,8 +54,14 @@ class DiversityDBOperation(unittest.TestCase):
 
         database.drop_diversity_db(c)
 
-        reset_observed_classes()
-        
+    @property
+    def concepts(self):
+        """
+        the concept cache, loaded from the test db if it is empty
+        """
+
+        return concept.get_concept_cache(self.s)
+
     def test_insert(self):
         """
         test can write and retrieve from db
@@ -94,6 +91,38 @@ class DiversityDBOperation(unittest.TestCase):
 
         self.assertEqual(written_length, expected_length)
 
+    def test_concept_cache(self):
+        """
+        test the concept cache maps both ways and notices concept changes
+        """
+
+        # an empty table still has a version, so it isn't reloaded every time
+        cache = concept.ConceptCache().get(self.s)
+        self.assertIsNotNone(cache.version)
+
+        concept.populate_concept_table(self.s)
+
+        cache.check(self.s)
+        cid = get_concept_cid(self.s, 'hes_apc', 'source')
+
+        self.assertEqual(cache.get_uid('source', 'hes_apc'), cid)
+        self.assertEqual(cache.get_code(cid), 'hes_apc')
+        self.assertIsNone(cache.get_uid('source', 'missing'))
+
+        # unchanged table leaves the cache alone
+        version = cache.version
+        cache.check(self.s)
+        self.assertEqual(cache.version, version)
+
+        # a new concept is picked up by the version check
+        concept.create_concept_row(self.s, 'new_source', 'source', 'new')
+        cache.check(self.s)
+        self.assertNotEqual(cache.version, version)
+        self.assertIsNotNone(cache.get_uid('source', 'new_source'))
+
+        cache.invalidate()
+        self.assertEqual(cache.get_uids('source'), {})
+
     def test_participant_merge(self):
         """
         test participant data is updated as and when it changes
@@ -106,13 +135,13 @@ class DiversityDBOperation(unittest.TestCase):
              'group': '100k_ca',
              'in_ngrl': True,
              'programme': '100k'}
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
         # toggle in_ngrl and recreate participant
         d['in_ngrl'] = False
-        b = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        b = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
@@ -122,6 +151,34 @@ class DiversityDBOperation(unittest.TestCase):
         self.assertTrue(len(p) == 1)
         self.assertNotEqual(p[0].in_ngrl, d['in_ngrl'])
 
+    def test_participant_upsert(self):
+        """
+        test a participant written again is updated in place
+        """
+
+        concept.populate_concept_table(self.s)
+
+        d = {'id': '1',
+             'group': '100k_ca',
+             'in_ngrl': True,
+             'programme': '100k'}
+        diversity_db.ObservedParticipant.from_dict(self.concepts, d).\
+            add_to_db(self.s)
+        self.s.commit()
+
+        d['in_ngrl'] = False
+        diversity_db.ObservedParticipant.upsert(self.s, [
+            diversity_db.ObservedParticipant.from_dict(self.concepts, d),
+            diversity_db.ObservedParticipant.from_dict(self.concepts,
+                                                       {**d, 'id': '2'}),
+        ])
+        self.s.commit()
+
+        p = self.s.query(diversity_db.Participant).\
+            order_by(diversity_db.Participant.id).all()
+        self.assertEqual([x.id for x in p], ['1', '2'])
+        self.assertFalse(p[0].in_ngrl)
+
     def test_participant_ethnicity_creation(self):
         """
         check we can write a participant with ethnicity data
@@ -140,7 +197,7 @@ class DiversityDBOperation(unittest.TestCase):
              ]}
 
         # create participant and then write data
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
@@ -154,6 +211,639 @@ class DiversityDBOperation(unittest.TestCase):
         self.assertEqual(p.id, d['id'])
         self.assertEqual(p.in_ngrl, d['in_ngrl'])
 
+    def test_bulk_load(self):
+        """
+        check the staged loader ends in the same state as add_to_db and skips
+        rows already in the database
+        """
+
+        concept.populate_concept_table(self.s)
+
+        d = {'id': '1',
+             'group': '100k_ca',
+             'in_ngrl': True,
+             'programme': '100k',
+             'reported_ethnicities': [
+                 {'ethnicity_code': 'A',
+                  'source': 'dams',
+                  'source_date': '2000-01-01'},
+                 {'ethnicity_code': 'B',
+                  'source': 'hes_apc',
+                  'source_date': '1900-01-01'},
+             ]}
+
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
+        a.add_to_db(self.s)
+        self.s.commit()
+
+        rows = [{'id': '1', 'ethnicity_code': x,
+                 'source_date': datetime.date(1900, 1, 1)}
+                for x in ['B', 'C']]
+        n = bulk_load.load_source_rows(self.s, apc.SOURCE, rows, 1)
+        self.s.commit()
+
+        re = self.s.query(diversity_db.ReportedEthnicity).all()
+
+        self.assertEqual(n, 1)
+        self.assertEqual(len(re), 3)
+        self.assertEqual(len(self.s.query(diversity_db.Participant).all()), 1)
+
+    def test_load_staged_rows(self):
+        """
+        check staged rows load the same with inserts and with COPY, and rows
+        with unrecognised codes are skipped
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)},
+                {'id': '1', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2001, 1, 1)},
+                {'id': '2', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2002, 1, 1)},
+                {'id': '3', 'ethnicity_code': 'unknown',
+                 'source_date': datetime.date(2002, 1, 1)}]
+
+        mark = common.load_rows(c, self.s, apc.SOURCE, rows[:2], bulk=False)
+        n = bulk_load.load_source_rows(self.s, apc.SOURCE, rows, 2)
+        self.s.commit()
+
+        re = self.s.query(diversity_db.ReportedEthnicity).all()
+
+        self.assertEqual(mark, datetime.date(2001, 1, 1))
+        self.assertEqual(n, 1)
+        self.assertEqual(len(re), 3)
+        self.assertEqual(len(self.s.query(diversity_db.Participant).all()), 3)
+        self.assertEqual(set(x.source_cid for x in re),
+                         {get_concept_cid(self.s, 'hes_apc', 'source')})
+        self.assertEqual(
+            self.s.query(diversity_db.ReportedEthnicityStaging).count(), 0)
+
+    def test_hes_keeps_participant_group(self):
+        """
+        check a HES source doesn't overwrite the group of a participant
+        loaded from a registration source
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)}]
+        bulk_load.load_source_rows(self.s, dams.RARE_DISEASE_SOURCE, rows, 2)
+        bulk_load.load_source_rows(self.s, apc.SOURCE, rows, 2)
+        self.s.commit()
+
+        p = self.s.query(diversity_db.Participant).one()
+        group = self.s.query(diversity_db.Concept).get(p.group_cid)
+
+        self.assertEqual(group.concept_code, '100k_rd')
+        self.assertEqual(
+            len(self.s.query(diversity_db.ReportedEthnicity).all()), 2)
+
+    def test_reported_ethnicity_summary(self):
+        """
+        check the summary follows inserts, deletes, updates and truncates of
+        reported_ethnicity
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)},
+                {'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2001, 1, 1)},
+                {'id': '1', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2002, 1, 1)},
+                {'id': '2', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2003, 1, 1)}]
+
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+
+        con = database.get_div_db_connection(self.s)
+
+        def get_summary():
+
+            self.s.expire_all()
+            q = self.s.query(diversity_db.ReportedEthnicitySummary)
+
+            return sorted((x.participant_id, x.eth_count, x.max_source_date)
+                          for x in q)
+
+        self.assertEqual(get_summary(),
+                         [('1', 1, datetime.date(2002, 1, 1)),
+                          ('1', 2, datetime.date(2001, 1, 1)),
+                          ('2', 1, datetime.date(2003, 1, 1))])
+
+        # deleting the latest row moves the max date back, deleting the only
+        # row removes the triple
+        con.execute("""
+            delete from ethnicity_store.reported_ethnicity
+            where source_date in ('2001-01-01', '2003-01-01');""")
+        self.assertEqual(get_summary(),
+                         [('1', 1, datetime.date(2000, 1, 1)),
+                          ('1', 1, datetime.date(2002, 1, 1))])
+
+        con.execute("""
+            update ethnicity_store.reported_ethnicity
+            set source_date = '1999-01-01'
+            where source_date = '2002-01-01';""")
+        self.assertEqual(get_summary(),
+                         [('1', 1, datetime.date(1999, 1, 1)),
+                          ('1', 1, datetime.date(2000, 1, 1))])
+
+        con.execute('truncate ethnicity_store.reported_ethnicity;')
+        self.assertEqual(get_summary(), [])
+
+    def test_bulk_reload(self):
+        """
+        check a reloaded source is swapped in for its partition, with any
+        duplicate rows removed and the summary rebuilt
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)},
+                {'id': '2', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2001, 1, 1)},
+                {'id': '3', 'ethnicity_code': 'C',
+                 'source_date': datetime.date(2002, 1, 1)}]
+
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        self.s.commit()
+
+        tables = bulk_reload.create_load_tables(self.s, ['hes_apc'])
+
+        # without the primary key the same rows load twice
+        for i in range(2):
+
+            common.load_rows(c, self.s, apc.SOURCE, rows[:2], bulk=True,
+                             table=tables['hes_apc'])
+
+        self.s.commit()
+
+        bulk_reload.swap_source_partitions(c, tables)
+
+        con = database.get_div_db_connection(self.s)
+        partition = con.execute(
+            text(bulk_reload.PARTITION_SQL), {'source': 'hes_apc'}).scalar()
+
+        self.assertEqual(partition, 'reported_ethnicity_hes_apc')
+        self.assertEqual(
+            len(self.s.query(diversity_db.ReportedEthnicity).all()), 2)
+        self.assertEqual(
+            [x.eth_count for x in
+             self.s.query(diversity_db.ReportedEthnicitySummary)], [1, 1])
+
+        # and the partition can be swapped again
+        tables = bulk_reload.create_load_tables(self.s, ['hes_apc'])
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True,
+                         table=tables['hes_apc'])
+        self.s.commit()
+        bulk_reload.swap_source_partitions(c, tables)
+
+        self.assertEqual(
+            len(self.s.query(diversity_db.ReportedEthnicity).all()), 3)
+
+    def test_engine_registry(self):
+        """
+        check engines are reused and repeated queries reuse pooled
+        connections
+        """
+
+        e = database.get_engine(c.div_db_conn_str, c)
+        self.assertIs(e, database.get_engine(c.div_db_conn_str, c))
+
+        m = database.pool_metrics()[repr(e.url)]
+        connects, checkouts = m['connects'], m['checkouts']
+
+        for i in range(5):
+
+            database.run_sql_query(e, 'select 1;')
+
+        m = database.pool_metrics()[repr(e.url)]
+        self.assertEqual(m['checkouts'], checkouts + 5)
+        self.assertLessEqual(m['connects'], connects + 1)
+
+    def test_engine_registry_threads(self):
+        """
+        check threads asking for a new engine at once all get the same one
+        """
+
+        conn_str = f'{c.div_db_conn_str}?application_name=registry_test'
+        barrier = threading.Barrier(8)
+
+        def get():
+
+            barrier.wait()
+
+            return database.get_engine(conn_str, c)
+
+        with concurrent.futures.ThreadPoolExecutor(8) as executor:
+
+            engines = [x.result() for x in
+                       [executor.submit(get) for _ in range(8)]]
+
+        self.assertEqual(len(set(map(id, engines))), 1)
+        self.assertIs(engines[0], database.ENGINES[conn_str])
+
+    def test_high_water_mark(self):
+        """
+        check the high-water mark for a source can be recorded and moved on
+        """
+
+        concept.populate_concept_table(self.s)
+
+        self.assertIsNone(run_state.get_high_water_mark(self.s, 'hes_apc'))
+
+        run_state.set_high_water_mark(self.s, 'hes_apc',
+                                      datetime.date(2019, 1, 1))
+        self.s.commit()
+        run_state.set_high_water_mark(self.s, 'hes_apc',
+                                      datetime.date(2020, 1, 1))
+        self.s.commit()
+
+        self.assertEqual(run_state.get_high_water_mark(self.s, 'hes_apc'),
+                         datetime.date(2020, 1, 1))
+        self.assertIsNone(run_state.get_high_water_mark(self.s, 'dams'))
+
+        # as done when a rebuild fails to swap in its new data
+        run_state.set_high_water_mark(self.s, 'dams', datetime.date(2021, 1, 1))
+        run_state.restore_high_water_marks(
+            self.s, {'hes_apc': datetime.date(2019, 1, 1), 'dams': None})
+        self.s.commit()
+
+        self.assertEqual(run_state.get_high_water_mark(self.s, 'hes_apc'),
+                         datetime.date(2019, 1, 1))
+        self.assertIsNone(run_state.get_high_water_mark(self.s, 'dams'))
+
+    def test_best_ethnicity_refresh(self):
+        """
+        check the materialised best ethnicity only changes for the
+        participants that are refreshed
+        """
+
+        concept.populate_concept_table(self.s)
+
+        for pid in ['1', '2']:
+
+            d = {'id': pid,
+                 'group': '100k_ca',
+                 'in_ngrl': True,
+                 'programme': '100k',
+                 'reported_ethnicities': [
+                     {'ethnicity_code': 'A',
+                      'source': 'dams',
+                      'source_date': '2000-01-01'},
+                 ]}
+            diversity_db.ObservedParticipant.from_dict(self.concepts, d).\
+                add_to_db(self.s)
+
+        best_ethnicity.refresh(self.s)
+        self.s.commit()
+
+        # give both participants a more recent ethnicity but only refresh one
+        for pid in ['1', '2']:
+
+            diversity_db.ObservedReportedEthnicity(
+                self.concepts, pid, 'B', 'hes_apc', '2010-01-01').\
+                add_to_db(self.s)
+
+        best_ethnicity.refresh(self.s, ['1'])
+        self.s.commit()
+
+        self.assertEqual(best_ethnicity.get_best_ethnicity(self.s, '1'), 'B')
+        self.assertEqual(best_ethnicity.get_best_ethnicity(self.s, '2'), 'A')
+        self.assertEqual(lookup.lookup(self.s, ['2'], live=True), {'2': 'B'})
+        self.assertIsNone(best_ethnicity.get_best_ethnicity(self.s, '3'))
+
+    def test_lookup(self):
+        """
+        check a cohort lookup reads the materialised best ethnicities, with
+        unknown participants as None, and the cache is emptied by an ETL run
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': str(i), 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)} for i in range(3)]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        best_ethnicity.refresh(self.s)
+        self.s.commit()
+
+        cache = lookup.LookupCache(maxsize=2)
+        pids = ['0', '1', '2', 'missing']
+        d = lookup.lookup(self.s, pids, cache=cache)
+
+        self.assertEqual(d, {'0': 'A', '1': 'A', '2': 'A', 'missing': None})
+        self.assertEqual(list(cache.codes), ['2', 'missing'])
+
+        # a later run changes participant 2, which the cache still has
+        rows = [{'id': '2', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2001, 1, 1)}] * 2
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        best_ethnicity.refresh(self.s)
+        self.s.commit()
+
+        self.assertEqual(lookup.lookup(self.s, ['2'], cache=cache), {'2': 'A'})
+
+        run_state.finish_run(self.s, run_state.start_run(self.s))
+        self.s.commit()
+
+        self.assertEqual(lookup.lookup(self.s, ['2'], cache=cache), {'2': 'B'})
+
+    def test_best_ethnicity_changes(self):
+        """
+        check a run logs the participants whose best ethnicity it added,
+        changed or removed, and the feed pages through them from a run
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': str(i), 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)} for i in range(3)]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        first = run_state.start_run(self.s, [apc.SOURCE.code])
+        self.assertEqual(best_ethnicity.refresh(self.s, run_id=first), 3)
+        first_seq = run_state.finish_run(self.s, first)
+        self.s.commit()
+
+        # participant 1 changes, 2 loses its only reported ethnicity and 0
+        # is touched but doesn't change
+        rows = [{'id': '1', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2001, 1, 1)}] * 2
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        self.s.query(diversity_db.ReportedEthnicity).\
+            filter(diversity_db.ReportedEthnicity.participant_id == '2').\
+            delete(synchronize_session=False)
+        second = run_state.start_run(self.s, [apc.SOURCE.code], True)
+        self.assertEqual(best_ethnicity.refresh(self.s, ['0', '1', '2'],
+                                                second), 2)
+
+        # not in the feed until the run has finished
+        self.assertEqual(sum(len(x) for x in
+                             changes.get_changes(self.s, first_seq)), 0)
+
+        second_seq = run_state.finish_run(self.s, second)
+        self.s.commit()
+
+        pages = list(changes.get_changes(self.s, page_size=2))
+
+        self.assertEqual([len(x) for x in pages], [2, 2, 1])
+        d = [dict(x) for page in pages for x in page]
+
+        self.assertEqual([(x['finish_seq'], x['run_id'], x['change_type'])
+                          for x in d[:3]],
+                         [(first_seq, first, 'added')] * 3)
+        self.assertEqual(d[3:], [
+            {'finish_seq': second_seq, 'run_id': second,
+             'participant_id': '1', 'change_type': 'changed',
+             'old_best_ethnicity_code': 'A', 'new_best_ethnicity_code': 'B'},
+            {'finish_seq': second_seq, 'run_id': second,
+             'participant_id': '2', 'change_type': 'removed',
+             'old_best_ethnicity_code': 'A', 'new_best_ethnicity_code': None}])
+        self.assertEqual(len(list(changes.get_changes(self.s, second_seq))),
+                         0)
+        self.assertEqual(lookup.lookup(self.s, ['0', '1', '2'], cache=None),
+                         {'0': 'A', '1': 'B', '2': None})
+        self.assertEqual(run_state.get_latest_run_id(self.s), second)
+
+    def test_changes_in_finish_order(self):
+        """
+        check a run that finishes after a later run is still read by a
+        consumer that has read the later run's changes
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '0', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)}]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        earlier = run_state.start_run(self.s, [apc.SOURCE.code])
+        self.s.commit()
+
+        rows = [{'id': '1', 'ethnicity_code': 'B',
+                 'source_date': datetime.date(2000, 1, 1)}]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        later = run_state.start_run(self.s, [apc.SOURCE.code])
+        best_ethnicity.refresh(self.s, ['1'], later)
+        later_seq = run_state.finish_run(self.s, later)
+        self.s.commit()
+
+        self.assertEqual([x['run_id'] for page in
+                          changes.get_changes(self.s) for x in page], [later])
+
+        best_ethnicity.refresh(self.s, ['0'], earlier)
+        earlier_seq = run_state.finish_run(self.s, earlier)
+        self.s.commit()
+
+        self.assertGreater(earlier_seq, later_seq)
+        self.assertEqual([(x['run_id'], x['participant_id']) for page in
+                          changes.get_changes(self.s, later_seq)
+                          for x in page], [(earlier, '0')])
+        self.assertEqual(run_state.get_latest_run_id(self.s), earlier)
+
+    def test_fingerprint_skips_unchanged(self):
+        """
+        check a reload only passes on the participants whose rows have
+        changed, and a cleared source's participants are all reloaded
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': str(i), 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)} for i in range(3)]
+        changed, fingerprints = common.transform(self.s, apc.SOURCE, rows,
+                                                 True)
+        common.load_rows(c, self.s, apc.SOURCE, changed, True,
+                         fingerprints=fingerprints)
+
+        self.assertEqual(changed, rows)
+
+        rows.append({'id': '1', 'ethnicity_code': 'B',
+                     'source_date': datetime.date(2001, 1, 1)})
+        changed, fingerprints = common.transform(self.s, apc.SOURCE, rows,
+                                                 True)
+
+        self.assertEqual({x['id'] for x in changed}, {'1'})
+        self.assertEqual(len(changed), 2)
+        self.assertEqual(list(fingerprints), ['1'])
+
+        fingerprint.clear_fingerprints(self.s, [apc.SOURCE.code])
+        changed, _ = common.transform(self.s, apc.SOURCE, rows, True)
+
+        self.assertEqual(changed, rows)
+
+    def test_fingerprint_reloads_new_concept(self):
+        """
+        check rows skipped for an unrecognised code are loaded by a later
+        run once the code's concept is added, although the rows are the same
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': '0', 'ethnicity_code': x,
+                 'source_date': datetime.date(2000, 1, 1)} for x in 'AQ']
+
+        for i in range(2):
+
+            # the concept is added after the first run
+            if i:
+
+                concept.create_concept_row(self.s, 'Q',
+                                           'reported_ethnicity_code')
+                self.s.commit()
+
+            concept.CONCEPT_CACHE.check(self.s)
+            changed, fingerprints = common.transform(self.s, apc.SOURCE,
+                                                     rows, True)
+            common.load_rows(c, self.s, apc.SOURCE, changed, True,
+                             fingerprints=fingerprints)
+            self.s.commit()
+
+        codes = [concept.get_concept_cache(self.s).get_code(x.ethnicity_cid)
+                 for x in self.s.query(diversity_db.ReportedEthnicity)]
+
+        self.assertEqual(sorted(codes), ['A', 'Q'])
+
+    def test_export(self):
+        """
+        check the exports write every row, as compressed csv and parquet
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': str(i), 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1 + i)}
+                for i in range(3)]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        best_ethnicity.refresh(self.s)
+        self.s.commit()
+
+        with tempfile.TemporaryDirectory() as d:
+
+            fps = export.export(c, out_dir=d, compress=True)
+
+            with gzip.open(fps[0], 'rt') as f:
+
+                self.assertEqual(f.read().splitlines(),
+                                 ['participant_id,best_ethnicity_code',
+                                  '0,A', '1,A', '2,A'])
+
+            fps = export.export(c, ['reported_ethnicity'], d, 'parquet')
+            t = pq.read_table(fps[0])
+
+        self.assertEqual(t.column('source').to_pylist(),
+                         [apc.SOURCE.code] * 3)
+        self.assertEqual(t.column('source_date').to_pylist(),
+                         [x['source_date'] for x in rows])
+
+        with self.assertRaises(ValueError):
+
+            export.export(c, ['participant'])
+
+    def test_snapshot_restore(self):
+        """
+        check a restored snapshot has the same concepts, reported
+        ethnicities, summary and best ethnicities
+        """
+
+        concept.populate_concept_table(self.s)
+
+        rows = [{'id': str(i), 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1 + i)}
+                for i in range(3)]
+        common.load_rows(c, self.s, apc.SOURCE, rows, bulk=True)
+        best_ethnicity.refresh(self.s)
+        self.s.commit()
+
+        sql = """
+        select (select count(*)
+                from ethnicity_store.reported_ethnicity_summary)
+            ,(select string_agg(uid::text, ',' order by uid)
+              from ethnicity_store.concept)
+        """
+        con = database.get_div_db_connection(self.s)
+        expected = con.execute(sql).one()
+
+        with tempfile.TemporaryDirectory() as d:
+
+            snapshot_dir = snapshot.snapshot(c, d)
+            self.s.close()
+            database.drop_diversity_db(c)
+
+            snapshot.restore(c, snapshot_dir)
+
+        self.s = database.make_session(c)
+        con = database.get_div_db_connection(self.s)
+
+        self.assertEqual(con.execute(sql).one(), expected)
+        self.assertEqual(
+            self.s.query(diversity_db.ReportedEthnicity).count(), 3)
+        self.assertEqual(lookup.lookup(self.s, ['0', '2'], cache=None),
+                         {'0': 'A', '2': 'A'})
+
+    def test_restore_checks_concept_version(self):
+        """
+        check a snapshot whose concepts don't match its manifest's version
+        isn't restored
+        """
+
+        concept.populate_concept_table(self.s)
+
+        with tempfile.TemporaryDirectory() as d:
+
+            snapshot_dir = snapshot.snapshot(c, d)
+            fp = os.path.join(snapshot_dir, snapshot.MANIFEST_FILENAME)
+
+            with open(fp) as f:
+
+                manifest = json.load(f)
+
+            manifest['concept_version'] = 'x'
+
+            with open(fp, 'w') as f:
+
+                json.dump(manifest, f)
+
+            self.s.close()
+            database.drop_diversity_db(c)
+
+            with self.assertRaisesRegex(ValueError, 'manifest gives x'):
+
+                snapshot.restore(c, snapshot_dir)
+
+        self.s = database.make_session(c)
+
+    def test_resolver_cross_check(self):
+        """
+        check the in-process resolver agrees with the view
+        """
+
+        concept.populate_concept_table(self.s)
+
+        codes = ['A', 'B', 'C', 'S', 'Z', '99', 'J', 'X']
+        sources = ['hes_apc', 'dams']
+
+        for i in range(50):
+
+            d = {'id': str(i),
+                 'group': '100k_ca',
+                 'in_ngrl': True,
+                 'programme': '100k',
+                 'reported_ethnicities': [
+                     {'ethnicity_code': codes[(i * j) % len(codes)],
+                      'source': sources[(i + j) % len(sources)],
+                      'source_date': f'{1990 + (i + j) % 3}-01-01'}
+                     for j in range(i % 5 + 1)]}
+            diversity_db.ObservedParticipant.from_dict(self.concepts, d).\
+                add_to_db(self.s)
+
+        self.s.commit()
+
+        self.assertEqual(len(resolver.cross_check(self.s)), 0)
+
     def test_best_ethnicity_view_a(self):
 
         concept.populate_concept_table(self.s)
@@ -174,11 +864,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be A as all ethnicities equally common but A is
         # more recent
@@ -204,11 +894,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be A as most common (despite being oldest)
         self.assertEqual(be, 'A')
@@ -233,11 +923,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be B as all equally common and recent so take APC
         # more recent
@@ -263,11 +953,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be C as all equally common and recent from same
         # source but C most common in population
@@ -293,11 +983,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be J as is next most common non-other ethnic group
         self.assertEqual(be, 'J')
@@ -322,11 +1012,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be S as there are no other non-other ethnic groups
         # to choose from
@@ -352,11 +1042,11 @@ class DiversityDBOperation(unittest.TestCase):
                   'source_date': '1900-01-01'},
              ]}
 
-        a = diversity_db.ObservedParticipant.from_dict(self.s, d)
+        a = diversity_db.ObservedParticipant.from_dict(self.concepts, d)
         a.add_to_db(self.s)
         self.s.commit()
 
-        be = get_best_ethnicity_for_participant(d['id'])
+        be = lookup.lookup(self.s, [d['id']], live=True)[d['id']]
 
         # this case should be 99 as no valid ethnic group available
         self.assertEqual(be, '99')
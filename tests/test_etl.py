@@ -0,0 +1,181 @@
+"""
+test the source independent parts of the etl
+"""
+
+import datetime
+import unittest
+from classes.staging import StagedRow
+from modules import fingerprint
+from etl import common, runner, apc, pipeline
+
+
+class ChunkByParticipant(unittest.TestCase):
+
+    def test_participant_not_split(self):
+        """
+        check a participant's rows are never split across chunks
+        """
+
+        rows = [{'id': x} for x in ['1', '1', '2', '2', '2', '3', '4', '4']]
+        chunks = [rows[i:i + 3] for i in range(0, len(rows), 3)]
+
+        d = list(common.chunk_by_participant(chunks))
+
+        self.assertEqual(sum(len(x) for x in d), len(rows))
+
+        for x in d:
+
+            others = [y for y in d if y is not x]
+            ids = set(r['id'] for r in x)
+            self.assertFalse(any(r['id'] in ids for y in others for r in y))
+
+    def test_single_participant_larger_than_chunk(self):
+        """
+        check a participant with more rows than the chunk size stays whole
+        """
+
+        rows = [{'id': '1'}] * 5 + [{'id': '2'}]
+        chunks = [rows[i:i + 2] for i in range(0, len(rows), 2)]
+
+        d = list(common.chunk_by_participant(chunks))
+
+        self.assertEqual([len(x) for x in d], [5, 1])
+
+
+class Fingerprints(unittest.TestCase):
+
+    def test_fingerprint_ignores_order_and_duplicates(self):
+        """
+        check a participant's fingerprint only depends on their distinct
+        (code, date) pairs
+        """
+
+        rows = [{'id': '1', 'ethnicity_code': x,
+                 'source_date': datetime.date(2000, 1, i)}
+                for i, x in enumerate(['A', 'B', 'C'], 1)]
+
+        self.assertEqual(fingerprint.get_fingerprint(rows),
+                         fingerprint.get_fingerprint(rows[::-1] + rows[:1]))
+        self.assertNotEqual(fingerprint.get_fingerprint(rows),
+                            fingerprint.get_fingerprint(rows[:2]))
+        self.assertEqual(
+            fingerprint.get_fingerprints(rows + [{**rows[0], 'id': '2'}]),
+            {'1': fingerprint.get_fingerprint(rows),
+             '2': fingerprint.get_fingerprint(rows[:1])})
+
+    def test_unfingerprinted_rows_pass_through(self):
+        """
+        check rows that may not hold all of a participant's rows are loaded
+        without a fingerprint
+        """
+
+        rows = [{'id': '1', 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, 1)}]
+
+        self.assertEqual(common.transform(None, apc.SOURCE, rows, False),
+                         (rows, {}))
+
+
+class StagedRows(unittest.TestCase):
+
+    def test_staged_rows_read_as_mappings(self):
+        """
+        check staged rows are read by column name, as the row mappings they
+        replace are, and give the same results
+        """
+
+        rows = [{'id': x, 'ethnicity_code': 'A',
+                 'source_date': datetime.date(2000, 1, i)}
+                for i, x in enumerate(['1', '1', '2'], 1)]
+        staged = [StagedRow(*x.values()) for x in rows]
+
+        self.assertEqual(staged[0]['ethnicity_code'], 'A')
+        self.assertEqual(staged[0][0], '1')
+        self.assertEqual(fingerprint.get_fingerprints(staged),
+                         fingerprint.get_fingerprints(rows))
+        self.assertEqual(common.get_max_date(staged),
+                         datetime.date(2000, 1, 3))
+        self.assertEqual(list(common.chunk_by_participant([staged[:1],
+                                                           staged[1:]])),
+                         [staged[:2], staged[2:]])
+
+
+class GetSources(unittest.TestCase):
+
+    def test_all_sources(self):
+        """
+        check every source module is run by default
+        """
+
+        self.assertEqual(
+            set(x.code for x in runner.get_sources()),
+            {'hes_apc', 'hes_op', 'hes_ae', 'dams', 'dams_rd'})
+
+    def test_unknown_source(self):
+        """
+        check an unknown source is rejected before anything is run
+        """
+
+        with self.assertRaises(ValueError):
+
+            runner.get_sources(['hes_apc', 'hes_xyz'])
+
+
+class Partitions(unittest.TestCase):
+
+    def test_date_partitions_cover_all_dates(self):
+        """
+        check date partitions are contiguous and open at either end
+        """
+
+        d = common.date_partitions(datetime.date(2000, 1, 1), 4)
+
+        self.assertEqual(len(d), 4)
+        self.assertIsNone(d[0]['range_start'])
+        self.assertIsNone(d[-1]['range_end'])
+
+        for a, b in zip(d, d[1:]):
+
+            self.assertEqual(a['range_end'], b['range_start'])
+
+    def test_partition_query(self):
+        """
+        check partition filters are added to the source's query
+        """
+
+        q, params = apc.SOURCE.get_query(datetime.date(2020, 1, 1),
+                                         n_partitions=4, partition=1)
+
+        self.assertIn('admidate::date >= :since', q)
+        self.assertIn('hashtext(participant_id)', q)
+        self.assertEqual(params, {'since': datetime.date(2020, 1, 1),
+                                  'n_partitions': 4, 'partition': 1})
+
+        self.assertEqual(apc.SOURCE.get_query(), (apc.SOURCE.sql.format(
+            filter=''), None))
+
+
+class PipelineQuery(unittest.TestCase):
+
+    def test_bind_parameters_numbered(self):
+        """
+        check :name parameters become $n, in order of first use, and casts
+        are left alone
+        """
+
+        sql, args = pipeline.to_asyncpg_query(
+            'select a::date from t where a >= :since and b = :x '
+            'and c < :since', {'since': 1, 'x': 2})
+
+        self.assertEqual(sql, 'select a::date from t where a >= $1 and '
+                              'b = $2 and c < $1')
+        self.assertEqual(args, [1, 2])
+
+    def test_dsn(self):
+        """
+        check the driver is dropped from the connection string
+        """
+
+        self.assertEqual(
+            pipeline.get_dsn('postgresql+psycopg2://u:p@h:5432/db'),
+            'postgresql://u:p@h:5432/db')
@@ -0,0 +1,87 @@
+"""
+test the queue based logging set up
+"""
+
+import logging
+import os
+import queue
+import tempfile
+import unittest
+from types import SimpleNamespace
+from modules import log
+
+
+class QueueLogging(unittest.TestCase):
+
+    def test_debug_rate_filter(self):
+        """
+        check debug records over the rate are dropped, per logger, and other
+        levels always pass
+        """
+
+        f = log.DebugRateFilter(2)
+
+        def record(name, level):
+
+            r = logging.LogRecord(name, level, __file__, 0, 'x', None, None)
+            r.created = 1000.5
+
+            return r
+
+        passed = [f.filter(record('a', logging.DEBUG)) for _ in range(4)]
+
+        self.assertEqual(passed, [True, True, False, False])
+        self.assertTrue(f.filter(record('b', logging.DEBUG)))
+        self.assertTrue(f.filter(record('a', logging.INFO)))
+        self.assertEqual(f.dropped, 2)
+
+    def test_file_written_by_listener(self):
+        """
+        check records reach the log file once the listener is stopped, with
+        lazy arguments formatted
+        """
+
+        with tempfile.TemporaryDirectory() as d:
+
+            c = SimpleNamespace(log_folder=d, log_filename='test_logs',
+                                console_logging=False, file_logging=True,
+                                debug=True, log_level='DEBUG',
+                                log_debug_rate=0)
+            log.setup_logger(c)
+
+            logging.getLogger('test').info('loaded %d rows', 3)
+            log.stop_logger()
+
+            with open(os.path.join(d, 'test_logs')) as f:
+
+                self.assertIn('test - INFO - loaded 3 rows', f.read())
+
+    def test_message_merged_when_queued(self):
+        """
+        check a record's message is merged with its args as it is queued,
+        and records below every handler's level are never queued
+        """
+
+        q = queue.SimpleQueue()
+        qh = log.LazyQueueHandler(q)
+        ids = ['1', '2']
+
+        qh.handle(logging.LogRecord('test', logging.INFO, __file__, 0,
+                                    'loading %s', (ids,), None))
+        ids.append('3')
+
+        r = q.get_nowait()
+        self.assertEqual((r.msg, r.args), ("loading ['1', '2']", None))
+
+        with tempfile.TemporaryDirectory() as d:
+
+            c = SimpleNamespace(log_folder=d, log_filename='test_logs',
+                                console_logging=True, file_logging=False,
+                                debug=False, log_level='DEBUG',
+                                log_debug_rate=0)
+            log.setup_logger(c)
+
+            self.assertEqual(logging.getLogger().handlers[0].level,
+                             logging.INFO)
+
+            log.stop_logger()
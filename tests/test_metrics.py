@@ -0,0 +1,85 @@
+"""
+test the run metrics
+"""
+
+import json
+import os
+import tempfile
+import threading
+import unittest
+from modules import metrics
+
+
+class RunMetrics(unittest.TestCase):
+
+    def test_stages(self):
+        """
+        check stages add up their calls and rows, and timed chunks are
+        counted as rows out
+        """
+
+        m = metrics.RunMetrics()
+
+        with m.stage('load', 3) as st:
+
+            st['rows_out'] = 2
+            m.add_round_trips(4)
+
+        with m.stage('load', 5):
+
+            pass
+
+        chunks = list(m.timed('extract', [[1, 2], [3]]))
+
+        d = m.summary()
+
+        self.assertEqual(chunks, [[1, 2], [3]])
+        self.assertEqual(d['stages']['load']['calls'], 2)
+        self.assertEqual(d['stages']['load']['rows_in'], 8)
+        self.assertEqual(d['stages']['load']['rows_out'], 7)
+        self.assertEqual(d['stages']['load']['round_trips'], 4)
+        self.assertEqual(d['stages']['extract']['calls'], 3)
+        self.assertEqual(d['stages']['extract']['rows_out'], 3)
+        self.assertGreater(d['peak_rss_mb'], 0)
+
+    def test_stage_round_trips_per_thread(self):
+        """
+        check a stage only counts the statements sent by its own thread,
+        while the run counts every thread's
+        """
+
+        m = metrics.RunMetrics()
+
+        with m.stage('load'):
+
+            m.add_round_trips(2)
+            t = threading.Thread(target=m.add_round_trips, args=(5,))
+            t.start()
+            t.join()
+
+        d = m.summary()
+
+        self.assertEqual(d['stages']['load']['round_trips'], 2)
+        self.assertEqual(d['round_trips'], 7)
+
+    def test_write(self):
+        """
+        check each run appends a line of JSON to the metrics file
+        """
+
+        m = metrics.start_run()
+        metrics.count('rows.hes_apc', 2)
+
+        with tempfile.TemporaryDirectory() as d:
+
+            fp = os.path.join(d, 'metrics.jsonl')
+            m.write(fp, arguments={'bulk': True})
+            m.write(fp)
+
+            with open(fp) as f:
+
+                lines = [json.loads(x) for x in f]
+
+        self.assertEqual(len(lines), 2)
+        self.assertEqual(lines[0]['arguments'], {'bulk': True})
+        self.assertEqual(lines[0]['counters'], {'rows.hes_apc': 2})
@@ -0,0 +1,117 @@
+"""
+test the in-process best ethnicity resolver gives the same answers as
+vw_participant_ethnicity
+"""
+
+import unittest
+import numpy as np
+import pandas as pd
+from modules import resolver
+
+
+def make_reported_ethnicity(pid, rows):
+
+    return pd.DataFrame(
+        [{'participant_id': pid, 'ethnicity_code': e, 'source': s,
+          'source_date': d} for (e, s, d) in rows])
+
+
+def get_best_ethnicity(rows):
+
+    d = resolver.resolve(make_reported_ethnicity('1', rows))
+
+    assert len(d) == 1, 'too many best ethnicities returned'
+
+    return d['best_ethnicity_code'][0]
+
+
+class Resolver(unittest.TestCase):
+
+    def test_most_recent(self):
+        """
+        all ethnicities equally common but A is more recent
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('A', 'dams', '2000-01-01'),
+            ('B', 'hes_apc', '1900-01-01'),
+            ('C', 'hes_apc', '1900-01-01')]), 'A')
+
+    def test_source_priority(self):
+        """
+        all equally common and recent so take APC
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('A', 'dams', '1900-01-01'),
+            ('B', 'hes_apc', '1900-01-01'),
+            ('C', 'dams', '1900-01-01')]), 'B')
+
+    def test_most_common(self):
+        """
+        B is the most common despite not being the most recent
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('A', 'dams', '2000-01-01'),
+            ('B', 'dams', '1900-01-01'),
+            ('B', 'dams', '1901-01-01')]), 'B')
+
+    def test_population_rank(self):
+        """
+        all equally common and recent from the same source but C is most
+        common in the population
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('H', 'dams', '1900-01-01'),
+            ('C', 'dams', '1900-01-01'),
+            ('J', 'dams', '1900-01-01')]), 'C')
+
+    def test_other_skipped(self):
+        """
+        duplicate rows count once and S is passed over for J
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('S', 'dams', '1900-01-01'),
+            ('S', 'dams', '1900-01-01'),
+            ('J', 'dams', '1900-01-01')]), 'J')
+
+    def test_other_fallback(self):
+        """
+        S as there are no other usable ethnic groups
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('S', 'dams', '1900-01-01'),
+            ('Z', 'dams', '1900-01-01')]), 'S')
+
+    def test_unknown(self):
+        """
+        99 as no valid ethnic group is available
+        """
+
+        self.assertEqual(get_best_ethnicity([
+            ('99', 'dams', '1900-01-01'),
+            ('X', 'dams', '1900-01-01'),
+            ('Z', 'dams', '1900-01-01')]), '99')
+
+    def test_many_participants(self):
+        """
+        check participants are resolved independently of each other
+        """
+
+        d = pd.concat([
+            make_reported_ethnicity('1', [('A', 'dams', '1900-01-01')]),
+            make_reported_ethnicity('2', [('Z', 'dams', '1900-01-01')]),
+            make_reported_ethnicity('3', [('S', 'dams', '1900-01-01'),
+                                          ('B', 'hes_apc', '1900-01-01')]),
+        ])
+
+        r = resolver.resolve(d.iloc[np.random.default_rng(1).
+                                    permutation(len(d))])
+
+        self.assertEqual(dict(zip(r['participant_id'],
+                                  r['best_ethnicity_code'])),
+                         {'1': 'A', '2': '99', '3': 'B'})
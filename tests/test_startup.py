@@ -0,0 +1,42 @@
+"""
+test the CLI starts without loading the db, ETL or analysis modules
+"""
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# modules only the commands that use them should load
+DEFERRED_MODULES = ['sqlalchemy', 'sqlparse', 'numpy', 'pandas', 'config',
+                    'classes.diversity_db', 'modules.database', 'etl.common',
+                    'pyarrow']
+
+# cumulative import time of diversity.py, fire included, in microseconds
+STARTUP_BUDGET_US = 500000
+
+
+class Startup(unittest.TestCase):
+
+    def test_import_within_budget(self):
+        """
+        check importing diversity.py, in a fresh interpreter, loads none of
+        the deferred modules and stays within the startup budget
+        """
+
+        code = ('import sys, diversity; '
+                f'print(",".join(x for x in {DEFERRED_MODULES!r} '
+                'if x in sys.modules))')
+        res = subprocess.run([sys.executable, '-X', 'importtime', '-c', code],
+                             cwd=ROOT, capture_output=True, text=True,
+                             check=True)
+
+        # the last importtime line for diversity has the cumulative time
+        us = [int(x.split('|')[1]) for x in res.stderr.splitlines()
+              if x.startswith('import time:') and
+              x.split('|')[2].strip() == 'diversity'][-1]
+
+        self.assertEqual(res.stdout.strip(), '')
+        self.assertLess(us, STARTUP_BUDGET_US)